@@ -0,0 +1,373 @@
+"""HTTP API системы учета договоров Fastland.
+
+Запуск: uvicorn api:app --host 0.0.0.0 --port 8000
+Используется та же база данных и тот же сервисный слой, что и в настольном приложении (main.py).
+"""
+import asyncio
+import base64
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from pydantic import BaseModel
+
+import main as core
+
+# Чтения идут параллельно (не больше соединений пула PostgreSQL), все изменения — через один поток
+API_READ_WORKERS = int(os.getenv("API_READ_WORKERS", str(min(8, core.PG_POOL_MAX))))
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", "5"))
+API_CACHE_MAX_ENTRIES = int(os.getenv("API_CACHE_MAX_ENTRIES", "1000"))
+API_AUTH_TTL = float(os.getenv("API_AUTH_TTL", "60"))
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+read_executor = ThreadPoolExecutor(max_workers=API_READ_WORKERS, thread_name_prefix="api-read")
+write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-write")
+# Очередь назначений общая для всех запросов и используется только из потока записи
+auto_assign_service = core.AutoAssignService()
+
+app = FastAPI(title="Fastland API")
+security = HTTPBasic()
+
+
+# ======================= КЭШ ОТВЕТОВ =======================
+class ResponseCache:
+    """Общий кэш чтений: записи живут TTL секунд и сбрасываются любой записью через API.
+
+    Ключи включают текст поиска, курсоры и пользователей, поэтому число записей ограничено
+    max_entries (вытесняются давно не читанные), а истекшие записи периодически удаляются.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = API_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation = 0
+        self._entries = OrderedDict()  # ключ -> (поколение, истекает, ответ), от давно читанных к недавним
+        self._locks = {}  # ключ -> [блокировка загрузки, число ожидающих]
+        self._swept = time.monotonic()
+
+    def invalidate(self):
+        self.generation += 1
+        self._entries.clear()
+        self._locks.clear()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != self.generation or entry[1] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, value):
+        now = time.monotonic()
+        if now - self._swept >= self.ttl:
+            for stale in [cached for cached, entry in self._entries.items() if entry[1] <= now]:
+                del self._entries[stale]
+            self._swept = now
+        self._entries[key] = (self.generation, now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_load(self, key, loader):
+        entry = self._get(key)
+        if entry:
+            return entry[2]
+
+        # Одновременные одинаковые запросы ждут одну загрузку, а не идут в базу каждый;
+        # блокировка живет, пока ее кто-то держит или ждет
+        slot = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                entry = self._get(key)
+                if entry:
+                    return entry[2]
+                generation = self.generation
+                value = await run_read(loader)
+                # Ответ, прочитанный до записи, в кэш не попадает
+                if generation == self.generation:
+                    self._put(key, value)
+                return value
+        finally:
+            slot[1] -= 1
+            if not slot[1] and self._locks.get(key) is slot:
+                del self._locks[key]
+
+
+cache = ResponseCache(API_CACHE_TTL)
+_auth_cache = {}
+
+
+async def run_read(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(read_executor, func, *args)
+
+
+async def run_write(func, *args):
+    """Единственный путь изменения данных: последовательно в потоке записи, затем сброс кэша"""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(write_executor, func, *args)
+    finally:
+        cache.invalidate()
+
+
+# ======================= ПОЛЬЗОВАТЕЛЬ И ОШИБКИ =======================
+class ApiUser:
+    def __init__(self, user_id, full_name, roles, department):
+        self.id = user_id
+        self.full_name = full_name
+        self.roles = roles
+        self.department = department
+        self.is_admin = core.is_admin_role(roles)
+        self.is_director = core.is_director_role(roles)
+
+    @property
+    def sees_all(self) -> bool:
+        return self.is_admin or self.is_director
+
+
+async def current_user(credentials: HTTPBasicCredentials = Depends(security)) -> ApiUser:
+    key = (credentials.username, core.hash_password(credentials.password))
+    cached = _auth_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    result = await run_read(core.authenticate_user, credentials.username, credentials.password)
+    if not result:
+        raise HTTPException(status_code=401, detail="Неверный логин или пароль",
+                            headers={"WWW-Authenticate": "Basic"})
+    user = ApiUser(*result)
+    _auth_cache[key] = (time.monotonic() + API_AUTH_TTL, user)
+    return user
+
+
+def require_manager(user: ApiUser = Depends(current_user)) -> ApiUser:
+    if not user.sees_all:
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+    return user
+
+
+@app.exception_handler(core.WorkflowError)
+async def workflow_error_handler(request, exc):
+    if isinstance(exc, core.NotFoundError):
+        status_code = 404
+    elif isinstance(exc, core.AccessDeniedError):
+        status_code = 403
+    else:
+        status_code = 409
+    return JSONResponse(status_code=status_code, content={"detail": str(exc)})
+
+
+async def guarded_write(func, *args):
+    try:
+        return await run_write(func, *args)
+    except core.DB_INTEGRITY_ERRORS as e:
+        raise HTTPException(status_code=409, detail=f"Нарушение целостности данных: {e}")
+
+
+# ======================= ПАГИНАЦИЯ =======================
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    return values
+
+
+def page(rows, columns, limit, cursor_of) -> dict:
+    """Страница ответа: строки как словари и курсор на следующую (None — данных больше нет)"""
+    items = [dict(zip(columns, row[:len(columns)])) for row in rows]
+    next_cursor = encode_cursor(cursor_of(rows[-1])) if len(rows) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+CONTRACT_FIELDS = ("id", "contract_number", "title", "counterparty_name", "amount", "status",
+                   "department", "file_path", "priority", "deadline_at")
+TASK_FIELDS = ("id", "contract_number", "title", "step_order", "role_name", "status", "deadline_at", "file_path")
+TIMELINE_INSTANCE_FIELDS = ("id", "flow_name", "status", "started_at", "finished_at")
+TIMELINE_TASK_FIELDS = ("step_order", "role_name", "assignee", "status", "completed_at", "comment", "assigned_at",
+                        "deadline_at")
+ORGANIZATION_FIELDS = ("id", "name", "organization_type", "inn", "kpp", "ogrn", "legal_address", "phone", "email")
+
+
+# ======================= ДОГОВОРЫ И ЗАДАЧИ =======================
+@app.get("/contracts")
+async def list_contracts(status: Optional[str] = None, department: Optional[str] = None,
+                         search: Optional[str] = None, cursor: Optional[str] = None,
+                         limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+                         user: ApiUser = Depends(current_user)):
+    after = decode_cursor(cursor)
+    # Видимость зависит от пользователя, поэтому ключ кэша включает его самого
+    key = ("contracts", user.id, user.department, user.sees_all, status, department, search,
+           tuple(after) if after else None, limit)
+    rows = await cache.get_or_load(key, lambda: core.fetch_contracts(
+        user.id, user.department, user.sees_all, status=status, contract_department=department,
+        search=search, after=after, limit=limit, with_created_at=True))
+    # Последняя колонка — created_at: она нужна только для курсора и в ответ не попадает
+    return page(rows, CONTRACT_FIELDS, limit, lambda row: (row[-1], row[0]))
+
+
+@app.get("/tasks")
+async def list_tasks(cursor: Optional[str] = None, limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+                     user: ApiUser = Depends(current_user)):
+    after = decode_cursor(cursor)
+    key = ("tasks", user.id, user.is_admin, tuple(after) if after else None, limit)
+    rows = await cache.get_or_load(key, lambda: core.fetch_tasks(user.id, user.is_admin, after=after, limit=limit))
+    return page(rows, TASK_FIELDS, limit, lambda row: (row[6], row[0]))
+
+
+@app.post("/contracts/{contract_id}/approval")
+async def send_for_approval(contract_id: int, user: ApiUser = Depends(current_user)):
+    if not await run_read(core.contract_visible_to, contract_id, user.id, user.department, user.sees_all):
+        raise HTTPException(status_code=404, detail="Договор не найден")
+    number = await guarded_write(core.start_approval, contract_id, user.id, auto_assign_service)
+    return {"contract_number": number, "status": "На согласовании"}
+
+
+@app.get("/contracts/{contract_id}/timeline")
+async def approval_timeline(contract_id: int, user: ApiUser = Depends(current_user)):
+    if not await run_read(core.contract_visible_to, contract_id, user.id, user.department, user.sees_all):
+        raise HTTPException(status_code=404, detail="Договор не найден")
+    # Кэш истории ведет core.get_approval_timeline: он сверяется с версией договора и переживает записи
+    timeline = await run_read(core.get_approval_timeline, contract_id)
+    return {"contract_id": contract_id, "instances": [
+        dict(zip(TIMELINE_INSTANCE_FIELDS, instance),
+             tasks=[dict(zip(TIMELINE_TASK_FIELDS, task)) for task in tasks])
+        for instance, tasks in timeline
+    ]}
+
+
+class TaskDecision(BaseModel):
+    comment: str = ""
+
+
+async def _decide(task_id: int, approve: bool, decision: TaskDecision, user: ApiUser):
+    number = await guarded_write(core.complete_task, task_id, user.id, approve, decision.comment.strip(),
+                                 auto_assign_service, user.is_admin)
+    return {"task_id": task_id, "contract_number": number, "status": "approved" if approve else "rejected"}
+
+
+@app.post("/tasks/{task_id}/approve")
+async def approve_task(task_id: int, decision: TaskDecision, user: ApiUser = Depends(current_user)):
+    return await _decide(task_id, True, decision, user)
+
+
+@app.post("/tasks/{task_id}/reject")
+async def reject_task(task_id: int, decision: TaskDecision, user: ApiUser = Depends(current_user)):
+    return await _decide(task_id, False, decision, user)
+
+
+class DeadlineChange(BaseModel):
+    priority: str = "standard"
+    deadline: Optional[str] = None
+
+
+@app.put("/contracts/{contract_id}/deadline")
+async def change_contract_deadline(contract_id: int, change: DeadlineChange, user: ApiUser = Depends(require_manager)):
+    try:
+        deadline_str = core.compute_deadline(change.priority, change.deadline)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Неверный формат даты: {e}")
+    except core.WorkflowError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    number = await guarded_write(core.set_contract_deadline, contract_id, change.priority, deadline_str)
+    return {"contract_number": number, "priority": change.priority, "deadline_at": deadline_str}
+
+
+# ======================= ПОИСК =======================
+SEARCH_FIELDS = ("kind", "id", "contract_id", "title", "snippet", "score")
+
+
+@app.get("/search")
+async def search(q: str = Query(..., min_length=1), offset: int = Query(0, ge=0),
+                 limit: int = Query(core.SEARCH_PAGE_SIZE, ge=1, le=API_PAGE_SIZE),
+                 user: ApiUser = Depends(current_user)):
+    # Выдача упорядочена по релевантности, поэтому страницы листаются смещением, а не курсором
+    key = ("search", user.id, user.department, user.sees_all, q, offset, limit)
+    rows = await cache.get_or_load(key, lambda: core.search_documents(
+        q, user.id, user.department, user.sees_all, limit=limit, offset=offset))
+    return {"items": [dict(zip(SEARCH_FIELDS, row)) for row in rows],
+            "next_offset": offset + limit if len(rows) == limit else None}
+
+
+# ======================= ОРГАНИЗАЦИИ =======================
+class Organization(BaseModel):
+    name: str
+    organization_type: str = "legal"
+    inn: str
+    kpp: Optional[str] = None
+    ogrn: Optional[str] = None
+    legal_address: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+
+
+async def _store_organization(org_id, organization: Organization) -> dict:
+    fields = (organization.name.strip(), organization.organization_type, organization.inn.strip(),
+              organization.kpp, organization.ogrn, organization.legal_address, organization.phone,
+              organization.email)
+    error = core.validate_organization(fields[0], fields[1], fields[2], fields[3], fields[4], fields[6], fields[7])
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    org_id = await guarded_write(core.store_organization, org_id, *fields)
+    return dict(zip(ORGANIZATION_FIELDS, (org_id,) + fields))
+
+
+@app.get("/organizations")
+async def list_organizations(cursor: Optional[str] = None,
+                             limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+                             user: ApiUser = Depends(require_manager)):
+    after = decode_cursor(cursor)
+    key = ("organizations", tuple(after) if after else None, limit)
+    rows = await cache.get_or_load(key, lambda: core.list_organizations(after=after, limit=limit))
+    return page(rows, ORGANIZATION_FIELDS, limit, lambda row: (row[1], row[0]))
+
+
+@app.get("/organizations/{org_id}")
+async def get_organization(org_id: int, user: ApiUser = Depends(require_manager)):
+    row = await cache.get_or_load(("organization", org_id), lambda: core.get_organization(org_id))
+    return dict(zip(ORGANIZATION_FIELDS + ("created_at",), row))
+
+
+@app.post("/organizations", status_code=201)
+async def create_organization(organization: Organization, user: ApiUser = Depends(require_manager)):
+    return await _store_organization(None, organization)
+
+
+@app.put("/organizations/{org_id}")
+async def update_organization(org_id: int, organization: Organization, user: ApiUser = Depends(require_manager)):
+    return await _store_organization(org_id, organization)
+
+
+@app.delete("/organizations/{org_id}", status_code=204)
+async def delete_organization(org_id: int, user: ApiUser = Depends(require_manager)):
+    await guarded_write(core.remove_organization, org_id)
+
+
+@app.on_event("startup")
+def startup():
+    core.init_database()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    read_executor.shutdown(wait=True)
+    write_executor.shutdown(wait=True)
+    core.db.close_all()
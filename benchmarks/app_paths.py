@@ -0,0 +1,450 @@
+"""Замеры путей данных за окном FastlandApp на сгенерированных базах разного размера.
+
+Для каждого размера база создается заново (generate_dataset с заданным числом договоров), и каждый
+путь — load_contracts, apply_contracts_filter, send_for_approval, _process_task, check_task_deadlines,
+show_statistics — меряется на двух уровнях:
+  data — функции сервисного слоя, которые метод окна выполняет в фоновом потоке;
+  ui   — метод FastlandApp целиком: от вызова до момента, когда фоновые запросы завершены
+         и таблицы обновлены. Окно настоящее; без DISPLAY запускается Xvfb.
+Для каждого пути считаются перцентили задержки, число SQL-операторов на вызов (переданных в sqlite3:
+executemany — один оператор, операторы триггеров не считаются) и пик памяти Python (tracemalloc, отдельным вызовом — он замедляет код). Результат пишется
+в JSON; с --baseline он сравнивается с сохраненным прогоном, и при ухудшении отслеживаемой метрики
+больше порога скрипт завершается с кодом 1.
+
+Запуск: python benchmarks/app_paths.py [--sizes 1000,10000,100000,1000000] [--repeat 10]
+        [--output app_paths.json] [--baseline baseline.json] [--threshold 0.25] [--update-baseline]
+        [--cache-dir DIR] [--no-ui]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+# База создается заново во временном каталоге, рабочая не затрагивается
+_cwd = os.getcwd()
+_tmp = tempfile.mkdtemp(prefix="fastland-bench-")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_FILE"] = os.path.join(_tmp, "bench.db")
+os.chdir(_tmp)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as core  # noqa: E402
+
+# Запросы фильтра по очереди: слово из названий, префикс номера, фраза, форма собственности, пустой фильтр
+SEARCH_QUERIES = ("поставка", "ГЕН-00012", "молочной продукции", "ООО", "")
+# Отслеживаемые метрики и допуск в абсолютных единицах: мелкие значения не считаются регрессией из-за шума
+TRACKED = (("p50_ms", 1.0), ("p90_ms", 2.0), ("queries", 0), ("peak_kb", 256))
+
+
+class QueryCounter:
+    """Число SQL-операторов, выполненных всеми соединениями базы.
+
+    Считаются вызовы execute/executemany/executescript курсоров. Трассировка sqlite3
+    (set_trace_callback) не подходит: программы триггеров она сообщает с текстом
+    внешнего оператора, и их не отличить от самостоятельных запросов.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def attach(self, database):
+        counter = self
+
+        class CountingCursor(sqlite3.Cursor):
+            def execute(self, *args):
+                counter.add()
+                return super().execute(*args)
+
+            def executemany(self, *args):
+                counter.add()
+                return super().executemany(*args)
+
+            def executescript(self, *args):
+                counter.add()
+                return super().executescript(*args)
+
+        class CountingConnection(sqlite3.Connection):
+            def cursor(self, factory=CountingCursor):
+                return super().cursor(factory)
+
+            # Сокращения Connection.execute* создают курсор в обход cursor()
+            def execute(self, *args):
+                return self.cursor().execute(*args)
+
+            def executemany(self, *args):
+                return self.cursor().executemany(*args)
+
+            def executescript(self, *args):
+                return self.cursor().executescript(*args)
+
+        database.connection_factory = CountingConnection
+        database.close_all()  # открытые соединения переоткроются уже со счетчиком
+
+
+def start_virtual_display():
+    """Запустить Xvfb на свободном дисплее, если DISPLAY не задан; вернуть процесс или None"""
+    if os.environ.get("DISPLAY"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        sys.exit("Для замеров окна нужен X-сервер: задайте DISPLAY, установите Xvfb или запустите с --no-ui")
+    # Xvfb сам выбирает свободный номер и пишет его в -displayfd, когда готов принимать клиентов
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen([xvfb, "-displayfd", str(write_fd), "-screen", "0", "1280x1024x24", "-nolisten", "tcp"],
+                               pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        display = pipe.readline().strip()
+    if not display:
+        process.kill()
+        sys.exit("Xvfb не запустился")
+    os.environ["DISPLAY"] = f":{display}"
+    return process
+
+
+def prepare(size: int, args) -> dict:
+    """Пересоздать базу на size договоров (или взять ее из кэша); вернуть число строк по таблицам"""
+    core.db.drop_all(core.APP_TABLES)
+    # Даты данных отсчитываются от начала суток: в течение дня кэшированная база та же
+    anchor = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    cached = None
+    if args.cache_dir:
+        cached = os.path.join(args.cache_dir, f"fastland-{size}-seed{args.seed}-{anchor:%Y%m%d}.db")
+    if cached and os.path.exists(cached):
+        shutil.copyfile(cached, core.DB_FILE)
+        core.init_database()
+    else:
+        core.init_database()
+        core.generate_dataset(size, args.seed, anchor)
+        if cached:
+            core.db.close_all()  # checkpoint: вся база в одном файле
+            os.makedirs(args.cache_dir, exist_ok=True)
+            shutil.copyfile(core.DB_FILE, cached)
+    core.flow_registry.invalidate()
+    core.clear_timeline_cache()
+    return {table: core.db.fetchvalue(f"SELECT COUNT(*) FROM {table}") for table in core.DATASET_TABLES}
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def measure(setup, run, counter, args) -> dict:
+    """run(setup()) warmup + repeat раз; setup готовит вход вызова вне замера"""
+    times, queries = [], []
+    for iteration in range(args.warmup + args.repeat):
+        value = setup()
+        before = counter.count
+        started = time.perf_counter()
+        run(value)
+        elapsed = time.perf_counter() - started
+        if iteration >= args.warmup:
+            times.append(elapsed * 1000)
+            queries.append(counter.count - before)
+
+    value = setup()
+    tracemalloc.start()
+    try:
+        run(value)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return {"n": len(times), "mean_ms": round(sum(times) / len(times), 3),
+            "p50_ms": round(percentile(times, 50), 3), "p90_ms": round(percentile(times, 90), 3),
+            "p99_ms": round(percentile(times, 99), 3), "max_ms": round(times[-1], 3),
+            "queries": round(sum(queries) / len(queries), 1), "peak_kb": round(peak / 1024)}
+
+
+class Workload:
+    """Входы изменяющих путей: черновики для отправки, ожидающие задачи, просрочки для уведомлений"""
+
+    def __init__(self, user_id, overdue: int):
+        self.overdue = overdue
+        self.drafts = iter([row[0] for row in core.db.fetchall(
+            "SELECT id FROM contracts WHERE status = 'Черновик' ORDER BY id")])
+        self.tasks = iter([task[0] for task in core.fetch_tasks(user_id, True)])
+
+    def next_draft(self):
+        draft = next(self.drafts, None)
+        if draft is None:
+            raise RuntimeError("В базе закончились черновики: уменьшите --repeat или увеличьте размер")
+        return draft
+
+    def next_task(self):
+        task = next(self.tasks, None)
+        if task is None:
+            raise RuntimeError("В базе закончились ожидающие задачи: уменьшите --repeat или увеличьте размер")
+        return task
+
+    def reset_overdue(self):
+        """Снять отметку об уведомлении с нескольких просроченных задач — следующая проверка найдет их снова"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with core.db.transaction() as cur:
+            cur.execute('''
+                UPDATE approval_tasks SET deadline_notified = 0
+                WHERE id IN (SELECT id FROM approval_tasks
+                             WHERE status = 'pending' AND deadline_at < ? AND assigned_user_id IS NOT NULL
+                             ORDER BY id LIMIT ?)
+            ''', (now, self.overdue))
+
+
+def data_cases(user, workload):
+    """Пути уровня data: (имя, setup, run)"""
+    user_id, _, roles, department = user
+    assigner = core.AutoAssignService()
+    index = core.ContractSearchIndex()
+    queries = iter(SEARCH_QUERIES * 1000)
+
+    def load_contracts(_):
+        # Как fetch в FastlandApp.load_contracts плюс синхронизация индекса поиска из _show_contracts
+        contracts = core.fetch_contracts(user_id, department, True)
+        deadlines = {contract[0]: (contract[5], core.parse_deadline(contract[9])) for contract in contracts}
+        index.load(contracts)
+        return contracts, deadlines
+
+    return [
+        ("load_contracts", lambda: None, load_contracts),
+        ("apply_contracts_filter", lambda: next(queries), index.search),
+        ("send_for_approval", workload.next_draft,
+         lambda draft: core.start_approvals([draft], user_id, assigner)),
+        ("_process_task", workload.next_task,
+         lambda task: core.complete_tasks([task], user_id, True, "ок", assigner, is_admin=core.is_admin_role(roles))),
+        ("check_task_deadlines", workload.reset_overdue, lambda _: core.notify_overdue_tasks()),
+        ("show_statistics", lambda: None, lambda _: core.fetch_statistics()),
+    ]
+
+
+class Dialogs:
+    """Окна сообщений не ждут ответа: на вопросы — «да», предупреждения и ошибки запоминаются"""
+
+    def __init__(self):
+        self.problems = []
+        core.messagebox.showinfo = lambda *args, **kwargs: "ok"
+        core.messagebox.askyesno = lambda *args, **kwargs: True
+        core.messagebox.showwarning = core.messagebox.showerror = self._problem
+
+    def _problem(self, title, message=None, **kwargs):
+        self.problems.append(f"{title}: {message}")
+        return "ok"
+
+    def check(self, case):
+        if self.problems:
+            problems, self.problems = self.problems, []
+            raise RuntimeError(f"{case}: {'; '.join(problems)}")
+
+
+def wait_idle(root):
+    """Крутить цикл событий Tk, пока у db_executor есть незавершенные запросы, и дорисовать окно"""
+    while core.db_executor._pending:
+        root.update()
+        time.sleep(0.001)
+    root.update()
+
+
+def invoke_in_new_dialog(window, before, text):
+    """Нажать кнопку text в окне, открытом после снимка before дочерних окон"""
+    def find(widget):
+        for child in widget.winfo_children():
+            if isinstance(child, core.ttk.Button) and str(child.cget("text")) == text:
+                return child
+            found = find(child)
+            if found is not None:
+                return found
+        return None
+
+    for dialog in window.winfo_children():
+        if dialog not in before and isinstance(dialog, core.tk.Toplevel):
+            button = find(dialog)
+            if button is not None:
+                button.invoke()
+                return
+    raise RuntimeError(f"Не найдено окно с кнопкой «{text}»")
+
+
+def ui_cases(root, app, workload, dialogs):
+    """Пути уровня ui: (имя, setup, run); каждый run ждет окончания фоновых запросов"""
+    window = app.root
+    queries = iter(SEARCH_QUERIES * 1000)
+
+    def run(method):
+        def call(_):
+            method()
+            wait_idle(root)
+        return call
+
+    def select(tree, next_key):
+        def setup():
+            if tree is app.contracts_tree:
+                # Фильтр снимается, чтобы нужная строка была в таблице
+                app.apply_contracts_filter("")
+            key = next_key()
+            tree.selection_set(str(key))
+            return key
+        return setup
+
+    def checked(name, call):
+        # После вызова проверяем, что окно не показало ошибку или предупреждение
+        def run_checked(value):
+            call(value)
+            dialogs.check(name)
+        return run_checked
+
+    def process_task(_):
+        before = set(window.winfo_children())
+        app._process_task(True)
+        invoke_in_new_dialog(window, before, "✅ Утвердить")
+        wait_idle(root)
+
+    cases = [
+        ("load_contracts", lambda: None, run(app.load_contracts)),
+        ("apply_contracts_filter", lambda: next(queries), app.apply_contracts_filter),
+        ("send_for_approval", select(app.contracts_tree, workload.next_draft), run(app.send_for_approval)),
+        ("_process_task", select(app.tasks_tree, workload.next_task), process_task),
+        ("check_task_deadlines", workload.reset_overdue, run(app.check_task_deadlines)),
+        ("show_statistics", lambda: None, run(app.show_statistics)),
+    ]
+    return [(name, setup, checked(name, call)) for name, setup, call in cases]
+
+
+def bench_size(size, args, counter, dialogs, out) -> dict:
+    print(f"Договоров {size}: подготовка базы...", file=out, flush=True)
+    started = time.perf_counter()
+    rows = prepare(size, args)
+    result = {"rows": rows, "prepare_s": round(time.perf_counter() - started, 1)}
+    user = core.authenticate_user("admin", "admin")
+    workload = Workload(user[0], args.overdue)
+
+    result["data"] = {name: measure(setup, run, counter, args) for name, setup, run in data_cases(user, workload)}
+
+    if not args.no_ui:
+        root = core.tk.Tk()
+        root.withdraw()
+        window = core.tk.Toplevel(root)
+        app = core.FastlandApp(window, *user)
+        wait_idle(root)
+        try:
+            result["ui"] = {name: measure(setup, run, counter, args)
+                            for name, setup, run in ui_cases(root, app, workload, dialogs)}
+        finally:
+            wait_idle(root)
+            root.destroy()
+    return result
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Регрессии относительно baseline: метрика выросла больше чем в 1 + threshold раз (с допуском)"""
+    problems = []
+    for size, result in current["results"].items():
+        base = baseline.get("results", {}).get(size)
+        if base is None:
+            continue
+        for layer in ("data", "ui"):
+            for name, metrics in result.get(layer, {}).items():
+                old = base.get(layer, {}).get(name)
+                if old is None:
+                    continue
+                for metric, slack in TRACKED:
+                    if metrics[metric] > old[metric] * (1 + threshold) + slack:
+                        problems.append(f"{size} {layer}.{name} {metric}: {old[metric]} -> {metrics[metric]}")
+    return problems
+
+
+def print_report(results, out):
+    for size, result in results.items():
+        print(f"\nДоговоров {size} (строк: {sum(result['rows'].values())}, подготовка {result['prepare_s']} с)", file=out)
+        print(f"{'путь':<30}{'p50, мс':>10}{'p90, мс':>10}{'p99, мс':>10}{'макс, мс':>10}"
+              f"{'запросов':>10}{'пик, КБ':>10}", file=out)
+        for layer in ("data", "ui"):
+            for name, m in result.get(layer, {}).items():
+                print(f"{layer + '.' + name:<30}{m['p50_ms']:>10.2f}{m['p90_ms']:>10.2f}{m['p99_ms']:>10.2f}"
+                      f"{m['max_ms']:>10.2f}{m['queries']:>10}{m['peak_kb']:>10}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="размеры баз в договорах через запятую (полный набор: 1000,10000,100000,1000000)")
+    parser.add_argument("--repeat", type=int, default=10, help="замеряемых вызовов каждого пути")
+    parser.add_argument("--warmup", type=int, default=1, help="вызовов до замеров (прогрев кэшей)")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора данных")
+    parser.add_argument("--overdue", type=int, default=20,
+                        help="сколько просроченных задач находит каждая проверка дедлайнов")
+    parser.add_argument("--output", default="app_paths.json", help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="допустимый относительный рост метрики относительно baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="записать результаты в --baseline")
+    parser.add_argument("--cache-dir", help="каталог для сгенерированных баз: повторные прогоны не генерируют заново")
+    parser.add_argument("--no-ui", action="store_true", help="только уровень data, без окна и X-сервера")
+    args = parser.parse_args()
+    for name in ("output", "baseline", "cache_dir"):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(_cwd, getattr(args, name)))
+
+    out = sys.stdout
+    display = None if args.no_ui else start_virtual_display()
+    counter = QueryCounter()
+    counter.attach(core.db)
+    # Результаты фоновых запросов забираются сразу, а не раз в 25 мс
+    core.db_executor.POLL_MS = 1
+    dialogs = Dialogs()
+    results = {}
+    try:
+        # Журнал приложения (log_message) не смешивается с отчетом
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            for size in (int(value) for value in args.sizes.split(",")):
+                results[str(size)] = bench_size(size, args, counter, dialogs, out)
+    finally:
+        core.db_executor.shutdown()
+        core.db.close_all()
+        if display is not None:
+            display.terminate()
+            display.wait()
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "settings": {"repeat": args.repeat, "warmup": args.warmup, "seed": args.seed, "overdue": args.overdue},
+        "results": results,
+    }
+    print_report(results, out)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты: {args.output}", file=out)
+
+    if args.baseline and args.update_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline обновлен: {args.baseline}", file=out)
+    elif args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.threshold)
+        if problems:
+            print(f"Регрессии (порог {args.threshold:.0%}):", file=out)
+            for problem in problems:
+                print(f"  {problem}", file=out)
+            sys.exit(1)
+        print(f"Регрессий относительно {args.baseline} нет", file=out)
+
+
+if __name__ == "__main__":
+    main()
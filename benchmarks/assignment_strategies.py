@@ -0,0 +1,145 @@
+"""Сравнение стратегий назначения исполнителей по времени ожидания задач в очереди.
+
+Моделируется роль «Юрист» из нескольких пользователей с разной скоростью работы.
+Задачи поступают с нескольких рабочих мест (у каждого свой AutoAssignService),
+рабочие места время от времени перезапускаются. Назначение и учет нагрузки идут
+через настоящие AutoAssignService и триггеры на approval_tasks во временной базе SQLite.
+
+Запуск: python benchmarks/assignment_strategies.py [--ticks 5000] [--rate 0.9] ...
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+
+# База создается заново во временном каталоге, рабочая не затрагивается
+_tmp = tempfile.mkdtemp(prefix="fastland-bench-")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_FILE"] = os.path.join(_tmp, "bench.db")
+os.chdir(_tmp)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as core  # noqa: E402
+
+ROLE = "Юрист"
+
+
+class ProcessRoundRobinStrategy(core.AssignmentStrategy):
+    """Прежнее поведение: счетчик очереди в памяти процесса, после перезапуска — с нуля"""
+    name = "round_robin (в памяти)"
+
+    def __init__(self):
+        self.counter = 0
+
+    def choose(self, cur, role_name, users):
+        user_id = users[self.counter % len(users)]
+        self.counter += 1
+        return user_id
+
+
+def prepare(extra_users: int) -> int:
+    """Создать базу, добавить юристов и экземпляр согласования для задач; вернуть id экземпляра"""
+    core.init_database()
+    with core.db.transaction() as cur:
+        role_id = cur.execute("SELECT id FROM roles WHERE name = ?", (ROLE,)).fetchone()[0]
+        for k in range(extra_users):
+            user_id = core.db.insert(cur, '''
+                INSERT INTO users (username, full_name, password, department, is_active)
+                VALUES (?, ?, '-', 'Юридический', 1)
+            ''', (f"bench_lawyer{k}", f"Юрист {k + 2}"))
+            cur.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (user_id, role_id))
+        core.bump_data_version(cur, core.DATA_VERSION_ROLES)
+        contract_id, flow_id = cur.execute("SELECT c.id, f.id FROM contracts c, approval_flows f LIMIT 1").fetchone()
+        return core.db.insert(cur, "INSERT INTO approval_instances (contract_id, flow_id, status) VALUES (?, ?, 'active')",
+                              (contract_id, flow_id))
+
+
+def simulate(make_strategy, instance_id, speeds, args) -> dict:
+    """Прогнать модель; вернуть времена ожидания (в тактах), стоимость выбора и пиковые очереди"""
+    with core.db.transaction() as cur:
+        cur.execute("DELETE FROM approval_tasks")
+        cur.execute("DELETE FROM user_task_load")
+        cur.execute("DELETE FROM assignment_cursors")
+
+    arrivals, work = random.Random(args.seed), random.Random(args.seed + 1)
+    clients = [core.AutoAssignService(make_strategy()) for _ in range(args.clients)]
+    users = clients[0]._role_members()[ROLE]
+    speed = dict(zip(users, speeds))
+    queues = {user_id: deque() for user_id in users}  # (id задачи, такт создания), по порядку поступления
+    waits, choose_time, peak = [], 0.0, {user_id: 0 for user_id in users}
+
+    for tick in range(args.ticks):
+        if args.restart_every and tick and tick % args.restart_every == 0:
+            restarted = arrivals.randrange(args.clients)
+            clients[restarted] = core.AutoAssignService(make_strategy())
+
+        with core.db.transaction() as cur:
+            for user_id, queue in queues.items():
+                if queue and work.random() < speed[user_id]:
+                    task_id, created = queue.popleft()
+                    cur.execute("UPDATE approval_tasks SET status = 'approved' WHERE id = ?", (task_id,))
+                    waits.append(tick - created)
+
+            if arrivals.random() < args.rate:
+                client = clients[arrivals.randrange(args.clients)]
+                started = time.perf_counter()
+                user_id = client.get_next_user(ROLE, cur)
+                choose_time += time.perf_counter() - started
+                task_id = core.db.insert(cur, '''
+                    INSERT INTO approval_tasks (instance_id, step_order, role_name, assigned_user_id, status)
+                    VALUES (?, 1, ?, ?, 'pending')
+                ''', (instance_id, ROLE, user_id))
+                queues[user_id].append((task_id, tick))
+                peak[user_id] = max(peak[user_id], len(queues[user_id]))
+
+    assigned = len(waits) + sum(len(queue) for queue in queues.values())
+    return {"waits": sorted(waits), "choose_us": choose_time / max(assigned, 1) * 1e6,
+            "peak": [peak[user_id] for user_id in users], "left": sum(len(queue) for queue in queues.values())}
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ticks", type=int, default=5000, help="длительность модели, тактов")
+    parser.add_argument("--rate", type=float, default=0.9, help="вероятность поступления задачи за такт")
+    parser.add_argument("--speeds", default="0.5,0.35,0.25,0.15",
+                        help="вероятность закрыть задачу за такт для каждого юриста")
+    parser.add_argument("--clients", type=int, default=3, help="число рабочих мест")
+    parser.add_argument("--restart-every", type=int, default=200,
+                        help="раз в сколько тактов перезапускается одно из рабочих мест (0 — никогда)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    speeds = [float(value) for value in args.speeds.split(",")]
+    instance_id = prepare(len(speeds) - 1)
+    strategies = [
+        ProcessRoundRobinStrategy,
+        core.RoundRobinStrategy,
+        core.LeastLoadedStrategy,
+    ]
+
+    print(f"Юристов: {len(speeds)} (скорости {args.speeds}), поток задач {args.rate}/такт, "
+          f"рабочих мест: {args.clients}, тактов: {args.ticks}")
+    print(f"{'стратегия':<24}{'закрыто':>9}{'среднее':>9}{'p50':>6}{'p90':>6}{'p99':>6}{'макс':>7}"
+          f"{'осталось':>10}{'выбор, мкс':>12}  пиковые очереди")
+    for strategy in strategies:
+        result = simulate(strategy, instance_id, speeds, args)
+        waits = result["waits"]
+        mean = sum(waits) / len(waits) if waits else 0
+        print(f"{strategy.name:<24}{len(waits):>9}{mean:>9.1f}{percentile(waits, 50):>6}"
+              f"{percentile(waits, 90):>6}{percentile(waits, 99):>6}{waits[-1] if waits else 0:>7}"
+              f"{result['left']:>10}{result['choose_us']:>12.1f}  {result['peak']}")
+
+    core.db.close_all()
+
+
+if __name__ == "__main__":
+    main()
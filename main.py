@@ -6,18 +6,60 @@
 
 import os
 import re
+import sys
+import argparse
 import sqlite3
 import hashlib
+import io
+import gzip
+import zlib
 import json
+import functools
+import bisect
+import itertools
+import heapq
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime, timedelta
 from typing import Optional
 import subprocess
 import platform
+import threading
+import queue
+import time
+import random
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import tkinter.font as tkfont
 
+# Необязательные зависимости: настройки из .env, драйвер PostgreSQL и сжатие бэкапов zstd
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+# Блокировка файлов средствами ОС: fcntl в Linux и macOS, msvcrt в Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 
 # noinspection PyBroadException
 class TextShortcutsMixin:
@@ -346,10 +388,434 @@ class HoverTooltip:
         self._tw = None
 
 
+def _stable_positions(positions):
+    """Индексы наибольшей возрастающей подпоследовательности positions: эти элементы можно не двигать"""
+    tails, tail_indexes, previous = [], [], [-1] * len(positions)
+    for index, position in enumerate(positions):
+        k = bisect.bisect_left(tails, position)
+        if k == len(tails):
+            tails.append(position)
+            tail_indexes.append(index)
+        else:
+            tails[k] = position
+            tail_indexes[k] = index
+        previous[index] = tail_indexes[k - 1] if k else -1
+
+    result = set()
+    index = tail_indexes[-1] if tail_indexes else -1
+    while index >= 0:
+        result.add(index)
+        index = previous[index]
+    return result
+
+
+def reconcile_treeview(tree, rows):
+    """Привести строки Treeview к rows — последовательности (key, values, tags) — по ключам.
+
+    Вместо удаления и вставки всех строк выполняются только нужные delete/insert/item/move:
+    неизменившиеся строки не трогаются, поэтому выделение и прокрутка сохраняются.
+    """
+    native = ttk.Treeview  # в обход переопределений VirtualTreeview
+    rendered = getattr(tree, "_rendered_rows", None)
+    if rendered is None:
+        rendered = tree._rendered_rows = {}
+
+    wanted = [(str(key), tuple(values), tuple(tags)) for key, values, tags in rows]
+    wanted_keys = {key for key, _, _ in wanted}
+    current = native.get_children(tree)
+    selection = native.selection(tree)
+
+    stale = [iid for iid in current if iid not in wanted_keys]
+    if stale:
+        native.delete(tree, *stale)
+        for iid in stale:
+            rendered.pop(iid, None)
+        current = [iid for iid in current if iid in wanted_keys]
+
+    # Строки, уже стоящие в нужном относительном порядке, остаются на месте; остальные временно отсоединяются
+    old_positions = {iid: index for index, iid in enumerate(current)}
+    kept = [key for key, _, _ in wanted if key in old_positions]
+    stable = {kept[index] for index in _stable_positions([old_positions[key] for key in kept])}
+    moving = [iid for iid in current if iid not in stable]
+    if moving:
+        native.detach(tree, *moving)
+
+    # Первые index детей дерева всегда совпадают с wanted[:index]
+    for index, (key, values, tags) in enumerate(wanted):
+        if key not in old_positions:
+            native.insert(tree, "", index, iid=key, values=values, tags=tags)
+            rendered[key] = (values, tags)
+            continue
+        if key not in stable:
+            native.move(tree, key, "", index)
+        if rendered.get(key) != (values, tags):
+            native.item(tree, key, values=values, tags=tags)
+            rendered[key] = (values, tags)
+
+    if moving:
+        native.selection_set(tree, [iid for iid in selection if iid in wanted_keys])
+
+
+class VirtualTreeview(ttk.Treeview):
+    """Treeview для больших списков: строки хранятся в модели, в виджете — только помещающиеся на экране.
+
+    Поддерживает привычный API (insert/delete/item/get_children/selection/see), iid строки — ее ключ
+    (значение колонки key_column). Полоса прокрутки управляется числом строк модели, а не виджета.
+    """
+
+    def __init__(self, master=None, key_column=0, **kw):
+        self._yscroll = kw.pop("yscrollcommand", None)
+        super().__init__(master, **kw)
+        self._key_column = key_column
+        self._rows = {}  # iid -> [values, tags] в порядке отображения
+        self._order = []
+        self._positions = None
+        self._order_dirty = False
+        self._first = 0  # индекс первой видимой строки
+        self._page = int(kw.get("height", 10))
+        self._shown = []  # строки, материализованные в виджете
+        self._shown_set = set()
+        self._rendered_rows = {}  # состояние строк в виджете для reconcile_treeview
+        self._selected = set()
+        self._cursor = None
+        self._anchor = None  # начало диапазона для Shift+щелчка
+        self._render_id = None
+
+        self.bind("<Configure>", lambda e: self._schedule_render(), add="+")
+        self.bind("<MouseWheel>", self._on_wheel, add="+")
+        self.bind("<Button-4>", self._on_wheel, add="+")
+        self.bind("<Button-5>", self._on_wheel, add="+")
+        self.bind("<ButtonPress-1>", self._on_press, add="+")
+        for sequence in ("<Up>", "<Down>", "<Prior>", "<Next>", "<Home>", "<End>"):
+            self.bind(sequence, self._on_key)
+
+    # ---------- модель ----------
+    def _order_list(self):
+        if self._order_dirty:
+            self._order = list(self._rows)
+            self._positions = None
+            self._order_dirty = False
+        return self._order
+
+    def _index_of(self, iid):
+        order = self._order_list()
+        if self._positions is None:
+            self._positions = {key: index for index, key in enumerate(order)}
+        return self._positions[iid]
+
+    def _changed(self):
+        self._order_dirty = True
+        self._schedule_render()
+
+    def set_rows(self, rows):
+        """Заменить содержимое: rows — последовательность (values, tags). Выделение и прокрутка сохраняются."""
+        self._harvest_selection()
+        key_column = self._key_column
+        self._rows = {str(values[key_column]): [tuple(values), tuple(tags)] for values, tags in rows}
+        self._selected &= self._rows.keys()
+        self._order_dirty = True
+        self._render()
+
+    def insert(self, parent, index, iid=None, **kw):
+        values = tuple(kw.get("values", ()))
+        iid = str(values[self._key_column] if iid is None else iid)
+        if iid in self._rows:
+            raise tk.TclError(f"Item {iid} already exists")
+        tags = kw.get("tags", ())
+        row = [values, (tags,) if isinstance(tags, str) else tuple(tags)]
+        if index == "end" or int(index) >= len(self._rows):
+            self._rows[iid] = row
+        else:
+            items = list(self._rows.items())
+            items.insert(max(int(index), 0), (iid, row))
+            self._rows = dict(items)
+        self._changed()
+        return iid
+
+    def delete(self, *items):
+        shown = []
+        for iid in map(str, items):
+            if self._rows.pop(iid, None) is not None:
+                self._selected.discard(iid)
+                if iid in self._shown_set:
+                    shown.append(iid)
+        if shown:
+            super().delete(*shown)
+            for iid in shown:
+                self._rendered_rows.pop(iid, None)
+            self._shown_set.difference_update(shown)
+            self._shown = [iid for iid in self._shown if iid in self._shown_set]
+        self._changed()
+
+    def set_tags(self, tags):
+        """Обновить теги строк по словарю {iid: tags}: в виджет попадают только изменившиеся видимые строки"""
+        for iid, new_tags in tags.items():
+            iid = str(iid)
+            row = self._rows.get(iid)
+            if row is None or row[1] == new_tags:
+                continue
+            row[1] = new_tags
+            if iid in self._shown_set:
+                super().item(iid, tags=new_tags)
+                self._rendered_rows[iid] = tuple(row)
+
+    def get_children(self, item=None):
+        return tuple(self._order_list())
+
+    def exists(self, item):
+        return str(item) in self._rows
+
+    def index(self, item):
+        return self._index_of(str(item))
+
+    def item(self, item, option=None, **kw):
+        iid = str(item)
+        row = self._rows.get(iid)
+        if row is None:
+            raise tk.TclError(f"Item {iid} not found")
+        if kw:
+            if "values" in kw:
+                row[0] = tuple(kw["values"])
+            if "tags" in kw:
+                tags = kw["tags"]
+                row[1] = (tags,) if isinstance(tags, str) else tuple(tags)
+            if iid in self._shown_set:
+                super().item(iid, **kw)
+                self._rendered_rows[iid] = tuple(row)
+            return None
+        data = {"text": "", "image": "", "values": list(row[0]), "open": 0, "tags": list(row[1])}
+        return data[option] if option else data
+
+    # ---------- выделение ----------
+    def _harvest_selection(self):
+        """Перенести выделение, сделанное пользователем в виджете, в выделение модели"""
+        if self._shown:
+            self._selected = (self._selected - self._shown_set) | set(super().selection())
+
+    def _sync_selection(self):
+        super().selection_set([iid for iid in self._shown if iid in self._selected])
+
+    @staticmethod
+    def _flatten(items):
+        if len(items) == 1 and isinstance(items[0], (list, tuple)):
+            items = items[0]
+        return {str(iid) for iid in items}
+
+    def selection(self):
+        self._harvest_selection()
+        if len(self._selected) <= 1:
+            return tuple(self._selected)
+        return tuple(sorted(self._selected, key=self._index_of))
+
+    def selection_set(self, *items):
+        self._selected = self._flatten(items) & self._rows.keys()
+        self._sync_selection()
+
+    def selection_add(self, *items):
+        self._harvest_selection()
+        self._selected |= self._flatten(items) & self._rows.keys()
+        self._sync_selection()
+
+    def selection_remove(self, *items):
+        self._harvest_selection()
+        self._selected -= self._flatten(items)
+        self._sync_selection()
+
+    # ---------- прокрутка и отрисовка ----------
+    def configure(self, cnf=None, **kw):
+        if "yscrollcommand" in kw:
+            self._yscroll = kw.pop("yscrollcommand")
+            self._update_scrollbar()
+            if not kw and cnf is None:
+                return None
+        return super().configure(cnf, **kw)
+
+    config = configure
+
+    def yview(self, *args):
+        total = len(self._rows)
+        if not args:
+            return self._fractions(total)
+        if args[0] == "moveto":
+            self._first = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            self._first += int(args[1]) * (self._page if str(args[2]).startswith("page") else 1)
+        self._render()
+        return None
+
+    def yview_moveto(self, fraction):
+        self.yview("moveto", fraction)
+
+    def yview_scroll(self, number, what):
+        self.yview("scroll", number, what)
+
+    def see(self, item):
+        position = self._index_of(str(item))
+        if position < self._first:
+            self._first = position
+        elif position >= self._first + self._page:
+            self._first = position - self._page + 1
+        else:
+            return
+        self._render()
+
+    def _fractions(self, total):
+        if not total:
+            return 0.0, 1.0
+        return self._first / total, min(1.0, (self._first + self._page) / total)
+
+    def _update_scrollbar(self):
+        if self._yscroll:
+            self._yscroll(*self._fractions(len(self._rows)))
+
+    def _visible_rows(self):
+        """Сколько строк целиком помещается в видимой области виджета"""
+        if self._shown and self.winfo_ismapped():
+            bbox = self.bbox(self._shown[0])
+            if bbox:
+                return max(1, (self.winfo_height() - bbox[1] - 2) // bbox[3])
+        return self._page
+
+    def _schedule_render(self):
+        if self._render_id is None:
+            self._render_id = self.after_idle(self._render)
+
+    def _render(self):
+        if self._render_id is not None:
+            self.after_cancel(self._render_id)
+            self._render_id = None
+        if not self.winfo_exists():
+            return
+        self._harvest_selection()
+
+        # Материализуем только окно [first, first + page): стоимость не зависит от размера модели
+        order = self._order_list()
+        page = self._visible_rows()
+        self._page = page
+        self._first = max(0, min(self._first, len(order) - page))
+        window = order[self._first:self._first + page]
+
+        reconcile_treeview(self, ((iid, *self._rows[iid]) for iid in window))
+        self._shown = window
+        self._shown_set = set(window)
+
+        self._sync_selection()
+        if self._cursor in self._shown_set:
+            self.focus(self._cursor)
+        # Все строки окна помещаются целиком: собственная прокрутка виджета всегда в начале
+        self.tk.call(self._w, "yview", "moveto", 0)
+        self._update_scrollbar()
+        if self._visible_rows() != page:
+            self._schedule_render()
+
+    def _on_wheel(self, event):
+        if event.num == 4:
+            step = -3
+        elif event.num == 5:
+            step = 3
+        else:
+            step = -3 if event.delta > 0 else 3
+        self.yview("scroll", step, "units")
+
+    def _on_press(self, event):
+        if self.identify_region(event.x, event.y) not in ("cell", "tree"):
+            return None
+        row = self.identify_row(event.y)
+        if row and event.state & 0x0001 and self._anchor in self._rows:
+            # Shift: диапазон по модели, в том числе строки, прокрученные за пределы экрана
+            start, end = sorted((self._index_of(self._anchor), self._index_of(row)))
+            extra = self._selected if event.state & 0x0004 else set()
+            self._selected = set(self._order_list()[start:end + 1]) | extra
+            self._cursor = row
+            self._sync_selection()
+            self.focus(row)
+            return "break"
+        self._cursor = row or self._cursor
+        if row:
+            self._anchor = row
+        # Щелчок без Shift/Ctrl заменяет выделение, в том числе ушедшее за пределы экрана
+        if not event.state & 0x0005:
+            self._selected &= self._shown_set
+        return None
+
+    def _on_key(self, event):
+        order = self._order_list()
+        if not order:
+            return "break"
+        if self._cursor in self._rows:
+            position = self._index_of(self._cursor)
+        else:
+            position = self._first - 1 if event.keysym == "Down" else self._first
+        moves = {"Up": position - 1, "Down": position + 1, "Prior": position - self._page,
+                 "Next": position + self._page, "Home": 0, "End": len(order) - 1}
+        position = max(0, min(moves[event.keysym], len(order) - 1))
+
+        self._cursor = self._anchor = order[position]
+        self.see(self._cursor)
+        self.selection_set(self._cursor)
+        self.focus(self._cursor)
+        return "break"
+
+    def destroy(self):
+        if self._render_id is not None:
+            self.after_cancel(self._render_id)
+            self._render_id = None
+        super().destroy()
+
+
 # ======================= КОНФИГУРАЦИЯ =======================
-DB_FILE = "contracts.db"
+# Значения по умолчанию переопределяются переменными окружения или файлом .env
+if load_dotenv is not None:
+    load_dotenv()
+
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").strip().lower()  # sqlite | postgres
+DB_FILE = os.getenv("DB_FILE", "contracts.db")
 LOG_FILE = "app_log.txt"
 BACKUP_DIR = "backups"
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip").strip().lower()  # none | gzip | zstd (пакет zstandard)
+BACKUP_PAGES_PER_STEP = 1024  # страниц SQLite за шаг копирования; между шагами запись в базу не блокируется
+BACKUP_CHUNK = 1024 * 1024  # размер блока при сжатии и проверке файла бэкапа, байт
+PG_DUMP = os.getenv("PG_DUMP", "pg_dump")
+PG_RESTORE = os.getenv("PG_RESTORE", "pg_restore")
+
+# Инкрементальные снимки SQLite: блоки по хэшу содержимого хранятся один раз, снимок — список блоков
+BACKUP_STORE_DIR = os.path.join(BACKUP_DIR, "store")
+BACKUP_STORE_CHUNK = 256 * 1024  # размер блока, байт; кратен любому размеру страницы SQLite
+BACKUP_SNAPSHOT_INTERVAL = int(os.getenv("BACKUP_SNAPSHOT_INTERVAL", "60"))  # минут между автоснимками, 0 — выкл.
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))  # сколько последних часов хранить по снимку
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))  # ... дней
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY", "8"))  # ... недель
+
+# Совместная работа нескольких клиентов с одним файлом БД
+# WAL: читатели не блокируются писателем, но нужна общая память — на сетевых дисках только DELETE
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL").strip().upper()  # WAL | DELETE | TRUNCATE | PERSIST
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # сколько SQLite сам ждет снятия блокировки
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()  # в режиме WAL NORMAL надежен и быстрее FULL
+DB_WAL_AUTOCHECKPOINT = int(os.getenv("DB_WAL_AUTOCHECKPOINT", "1000"))  # checkpoint каждые N страниц, 0 — выкл.
+DB_BUSY_RETRIES = 5  # повторные попытки при SQLITE_BUSY сверх busy_timeout
+DB_BUSY_RETRY_DELAY = 0.1  # начальная пауза между попытками, сек (удваивается)
+
+# PostgreSQL (DB_BACKEND=postgres)
+PG_DSN = os.getenv("PG_DSN", "")  # пусто — параметры libpq из PGHOST, PGDATABASE, PGUSER, PGPASSWORD
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_STREAM_BATCH = 2000  # строк за одно обращение серверного курсора
+BULK_BATCH = 500  # строк в одной странице пакетной вставки и id в одном IN (...) при массовых операциях
+BULK_LOAD_CACHE_KB = 256 * 1024  # страничный кэш SQLite на время массовой загрузки, КБ
+DATASET_BATCH = 20000  # строк в одной пачке записи генератора тестовых данных
+
+# Фоновые потоки чтения БД в интерфейсе (изменения всегда идут одним отдельным потоком)
+DB_WORKERS = int(os.getenv("DB_WORKERS", "2"))
+
+# Фильтр таблицы договоров
+SEARCH_DEBOUNCE_MS = int(os.getenv("SEARCH_DEBOUNCE_MS", "200"))  # пауза в наборе, после которой запускается фильтр
+SEARCH_THREAD_THRESHOLD = int(os.getenv("SEARCH_THREAD_THRESHOLD", "20000"))  # с какого числа договоров фильтр идет в фоне
+
+# Выбор исполнителя задачи согласования: least_loaded — с наименьшим числом ожидающих задач,
+# round_robin — по очереди (позиция очереди хранится в БД и общая для всех клиентов)
+ASSIGNMENT_STRATEGY = os.getenv("ASSIGNMENT_STRATEGY", "least_loaded")
+
+APPROVAL_TIMELINE_CACHE_SIZE = 256  # сколько историй согласования договоров держать в памяти
 
 
 # ======================= УТИЛИТАРНЫЕ ФУНКЦИИ =======================
@@ -501,6 +967,39 @@ def center_window_with_size(win, width, height):
     win.geometry(f"{width}x{height}+{x}+{y}")
 
 
+def show_bulk_report(parent, title, summary, results, item_header="Договор"):
+    """Итог массовой операции: сводка и результат по каждому элементу [(элемент, результат, успех)]"""
+    dialog = tk.Toplevel(parent)
+    dialog.title(title)
+    dialog.transient(parent)
+    dialog.grab_set()
+
+    main_frame = ttk.Frame(dialog, padding=15)
+    main_frame.pack(fill="both", expand=True)
+    ttk.Label(main_frame, text=summary, font=('Arial', 10, 'bold')).pack(anchor="w", pady=(0, 10))
+
+    tree_frame = ttk.Frame(main_frame)
+    tree_frame.pack(fill="both", expand=True)
+    tree = ttk.Treeview(tree_frame, columns=("item", "result"), show="headings",
+                        height=min(15, max(5, len(results))))
+    tree.heading("item", text=item_header)
+    tree.heading("result", text="Результат")
+    tree.column("item", width=220)
+    tree.column("result", width=420)
+    tree.tag_configure('failed', background='#f8d7da')
+    # Неудачные элементы показываются первыми
+    for item, result, ok in sorted(results, key=lambda row: row[2]):
+        tree.insert("", "end", values=(item, result), tags=() if ok else ('failed',))
+
+    scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=tree.yview)
+    tree.configure(yscrollcommand=scrollbar.set)
+    tree.pack(side="left", fill="both", expand=True)
+    scrollbar.pack(side="right", fill="y")
+
+    ttk.Button(main_frame, text="Закрыть", command=dialog.destroy).pack(pady=(10, 0))
+    center_window(dialog)
+
+
 def log_message(message: str):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     log_entry = f"[{timestamp}] {message}\n"
@@ -678,48 +1177,836 @@ class PhoneEntry(ttk.Entry):
             self._has_initial_format = True
 
 
-# ======================= СЕРВИС АВТОМАТИЧЕСКОГО НАЗНАЧЕНИЯ =======================
-class AutoAssignService:
-    def __init__(self):
-        self.user_assignments = {}
-        log_message("Сервис автоматического назначения инициализирован")
+# ======================= ПОДКЛЮЧЕНИЕ К БАЗЕ ДАННЫХ =======================
+class BusyRetryPolicy:
+    """Повтор операций при SQLITE_BUSY/SQLITE_LOCKED с экспоненциальной паузой"""
+
+    def __init__(self, retries: int = DB_BUSY_RETRIES, delay: float = DB_BUSY_RETRY_DELAY, max_delay: float = 2.0):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def is_busy(error: Exception) -> bool:
+        if not isinstance(error, sqlite3.OperationalError):
+            return False
+        code = getattr(error, "sqlite_errorcode", None)
+        if code is not None:
+            # Расширенные коды (например, SQLITE_BUSY_SNAPSHOT) содержат базовый в младшем байте
+            return (code & 0xFF) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+        message = str(error).lower()
+        return "locked" in message or "busy" in message
+
+    def run(self, func, *args, **kwargs):
+        """Выполнить func, повторяя вызов, пока база занята другим клиентом"""
+        delay = self.delay
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt >= self.retries or not self.is_busy(e):
+                    raise
+                log_message(f"База данных занята, повтор {attempt + 1}/{self.retries}: {e}")
+                # Случайная добавка разводит клиентов, упершихся в одну блокировку
+                time.sleep(delay + random.uniform(0, delay))
+                delay = min(delay * 2, self.max_delay)
+
+
+# Ошибки драйверов обоих движков: ими ловятся сбои запросов в интерфейсе
+if psycopg2 is None:
+    DB_ERRORS = (sqlite3.Error,)
+    DB_INTEGRITY_ERRORS = (sqlite3.IntegrityError,)
+else:
+    DB_ERRORS = (sqlite3.Error, psycopg2.Error)
+    DB_INTEGRITY_ERRORS = (sqlite3.IntegrityError, psycopg2.IntegrityError)
+
+
+def _split_sql_script(script: str) -> list:
+    """Разбить скрипт на отдельные операторы (с учетом ';' внутри триггеров)"""
+    statements, buffer = [], ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ""
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+
+class Database:
+    """Общий интерфейс хранилища: движки отличаются подключением и диалектом SQL.
+
+    Запросы пишутся в стиле sqlite3 (параметры '?'), строки возвращаются кортежами.
+    """
+
+    backend = None
+
+    def connection(self):
+        raise NotImplementedError
+
+    def transaction(self):
+        raise NotImplementedError
+
+    @staticmethod
+    @contextmanager
+    def savepoint(cur, name: str):
+        """Часть открытой транзакции cur, которую можно откатить, не прерывая саму транзакцию.
 
-    def get_next_user_by_round_robin(self, role_name: str) -> Optional[int]:
-        """Получить следующего пользователя по принципу round-robin"""
+        После ошибки в PostgreSQL вся транзакция помечается прерванной; откат к точке сохранения
+        снимает это, и вызывающий может продолжить работу в той же транзакции.
+        """
+        cur.execute(f"SAVEPOINT {name}")
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT u.id FROM users u
-                JOIN user_roles ur ON u.id = ur.user_id
-                JOIN roles r ON ur.role_id = r.id
-                WHERE r.name = ? AND u.is_active = 1
-                ORDER BY u.id
-            ''', (role_name,))
-            users = [row[0] for row in cur.fetchall()]
+            yield cur
+        except BaseException:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            cur.execute(f"RELEASE SAVEPOINT {name}")
+            raise
+        cur.execute(f"RELEASE SAVEPOINT {name}")
+
+    def execute(self, sql: str, params=()):
+        raise NotImplementedError
+
+    def fetchall(self, sql: str, params=()) -> list:
+        return self.execute(sql, params).fetchall()
+
+    def fetchone(self, sql: str, params=()):
+        return self.execute(sql, params).fetchone()
+
+    def fetchvalue(self, sql: str, params=(), default=None):
+        """Первое поле первой строки результата"""
+        row = self.fetchone(sql, params)
+        return row[0] if row else default
+
+    def stream(self, sql: str, params=(), batch_size: int = PG_STREAM_BATCH):
+        """Построчное чтение большой выборки без загрузки ее целиком в память драйвера"""
+        cur = self.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
 
-            if not users:
-                return None
+    @staticmethod
+    def insert(cur, sql: str, params=()) -> int:
+        """INSERT, возвращающий id новой строки (RETURNING понимают оба движка)"""
+        # fetchall дочитывает оператор до конца, иначе SQLite не даст зафиксировать транзакцию
+        return cur.execute(f"{sql} RETURNING id", params).fetchall()[0][0]
+
+    @staticmethod
+    def executescript(cur, script: str):
+        """Выполнить несколько операторов внутри текущей транзакции"""
+        for statement in _split_sql_script(script):
+            cur.execute(statement)
+
+    @staticmethod
+    def group_concat(expr: str, separator: str = ", ") -> str:
+        """SQL-выражение: значения группы через разделитель"""
+        raise NotImplementedError
+
+    @staticmethod
+    def casefold(expr: str) -> str:
+        """SQL-выражение: значение в нижнем регистре (с кириллицей) для поиска без учета регистра"""
+        raise NotImplementedError
+
+    @staticmethod
+    def add_days(timestamp_expr: str, days_expr: str) -> str:
+        """SQL-выражение: момент 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' плюс целое число дней"""
+        raise NotImplementedError
+
+    def lock_schema(self, cur):
+        """Не давать параллельно стартующим клиентам одновременно менять схему"""
+
+    def schema_version(self, cur) -> int:
+        raise NotImplementedError
+
+    def set_schema_version(self, cur, version: int):
+        raise NotImplementedError
+
+    def query_plan(self, sql: str, params=()) -> list:
+        """Строки плана выполнения запроса"""
+        raise NotImplementedError
+
+    @staticmethod
+    def is_full_scan(plan_line: str) -> bool:
+        raise NotImplementedError
+
+    def drop_all(self, tables):
+        """Удалить все данные приложения (сброс базы)"""
+        raise NotImplementedError
+
+    def bulk_load(self, cur, tables):
+        """Контекст массовой загрузки в tables внутри транзакции cur; отдает write(таблица, колонки, строки).
+
+        Пользовательские триггеры этих таблиц не срабатывают: производные данные (полнотекстовый
+        индекс, нагрузку исполнителей, версии согласования) вызывающий пересчитывает сам
+        """
+        raise NotImplementedError
+
+    def close_all(self):
+        raise NotImplementedError
+
+
+class SqliteDatabase(Database):
+    """Менеджер подключений: одно долгоживущее соединение SQLite на поток"""
+
+    backend = "sqlite"
+
+    # Настройки, применяемые к каждому новому соединению
+    PRAGMAS = (
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",  # ~16 МБ страничного кэша
+    )
+    # Допустимые значения DB_JOURNAL_MODE и DB_SYNCHRONOUS (MEMORY и OFF теряют данные при сбое)
+    JOURNAL_MODES = ("WAL", "DELETE", "TRUNCATE", "PERSIST")
+    SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+    # Класс соединения (sqlite3.connect(factory=...)); подкласс может, например, считать запросы
+    connection_factory = sqlite3.Connection
+
+    def __init__(self, path: str, cached_statements: int = 256, journal_mode: str = DB_JOURNAL_MODE,
+                 busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS, synchronous: str = DB_SYNCHRONOUS,
+                 wal_autocheckpoint: int = DB_WAL_AUTOCHECKPOINT, retry_policy: Optional[BusyRetryPolicy] = None):
+        journal_mode, synchronous = journal_mode.upper(), synchronous.upper()
+        if journal_mode not in self.JOURNAL_MODES:
+            raise ValueError(f"Неизвестный режим журнала: {journal_mode!r} "
+                             f"(ожидается {', '.join(self.JOURNAL_MODES)})")
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Неизвестный уровень synchronous: {synchronous!r} "
+                             f"(ожидается {', '.join(self.SYNCHRONOUS_LEVELS)})")
+        if busy_timeout_ms < 0 or wal_autocheckpoint < 0:
+            raise ValueError("DB_BUSY_TIMEOUT_MS и DB_WAL_AUTOCHECKPOINT не могут быть отрицательными")
+        self.path = path
+        self.cached_statements = cached_statements
+        self.journal_mode = journal_mode
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.retry_policy = retry_policy or BusyRetryPolicy()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.generation != self._generation:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.generation = self._generation
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: транзакциями управляем сами через transaction()
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.cached_statements,
+                               factory=self.connection_factory)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        self._set_journal_mode(conn)
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        if self.journal_mode == "WAL":
+            conn.execute(f"PRAGMA wal_autocheckpoint = {int(self.wal_autocheckpoint)}")
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        conn.create_function("py_casefold", 1, lambda value: value.casefold() if isinstance(value, str) else value,
+                             deterministic=True)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _set_journal_mode(self, conn: sqlite3.Connection):
+        """Режим журнала хранится в самом файле, поэтому переключаем его только при расхождении"""
+        current = conn.execute("PRAGMA journal_mode").fetchone()[0].upper()
+        if current == self.journal_mode:
+            return
+        try:
+            mode = self.retry_policy.run(
+                lambda: conn.execute(f"PRAGMA journal_mode = {self.journal_mode}").fetchone()[0])
+            if mode.upper() != self.journal_mode:
+                log_message(f"Не удалось включить режим журнала {self.journal_mode}, используется {mode}")
+        except sqlite3.OperationalError as e:
+            # Другой клиент держит базу — останемся в текущем режиме до следующего подключения
+            log_message(f"Не удалось переключить режим журнала на {self.journal_mode}: {e}")
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция: commit при успехе, rollback при ошибке.
+
+        Блокировка записи берется сразу (BEGIN IMMEDIATE) с повтором при занятой базе,
+        поэтому писатели не упираются в SQLITE_BUSY посреди транзакции.
+        Вложенный вызов присоединяется к уже открытой транзакции потока.
+        """
+        conn = self.connection()
+        cur = conn.cursor()
+        if conn.in_transaction:
+            yield cur
+            return
 
-            if role_name not in self.user_assignments:
-                self.user_assignments[role_name] = 0
+        self.retry_policy.run(cur.execute, "BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            try:
+                # COMMIT после SQLITE_BUSY можно безопасно повторить — транзакция остается открытой
+                self.retry_policy.run(conn.commit)
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        conn = self.connection()
+        if conn.in_transaction:
+            return conn.execute(sql, params)
+        # Одиночный запрос вне транзакции можно повторить целиком
+        return self.retry_policy.run(conn.execute, sql, params)
+
+    @staticmethod
+    def group_concat(expr: str, separator: str = ", ") -> str:
+        return f"GROUP_CONCAT({expr}, '{separator}')"
+
+    @staticmethod
+    def casefold(expr: str) -> str:
+        # Встроенная LOWER в SQLite понимает только латиницу
+        return f"py_casefold({expr})"
+
+    @staticmethod
+    def add_days(timestamp_expr: str, days_expr: str) -> str:
+        return f"datetime({timestamp_expr}, '+' || ({days_expr}) || ' days')"
+
+    def schema_version(self, cur) -> int:
+        return cur.execute("PRAGMA user_version").fetchone()[0]
 
-            user_id = users[self.user_assignments[role_name] % len(users)]
-            self.user_assignments[role_name] += 1
+    def set_schema_version(self, cur, version: int):
+        cur.execute(f"PRAGMA user_version = {int(version)}")
 
-            return user_id
+    def query_plan(self, sql: str, params=()) -> list:
+        lines = [row[-1] for row in self.fetchall(f"EXPLAIN QUERY PLAN {sql}", params)]
+        # Обход уже вычисленного подзапроса (WITH ... AS (VALUES ...)) помечаем, как в старых версиях SQLite
+        derived = {match.group(1) for match in map(re.compile(r"(?:MATERIALIZE|CO-ROUTINE) (\w+)$").match, lines)
+                   if match}
+        return [f"SCAN SUBQUERY {line[5:]}" if line.startswith("SCAN ") and line[5:] in derived else line
+                for line in lines]
+
+    @staticmethod
+    def is_full_scan(plan_line: str) -> bool:
+        # "SCAN t" без индекса — полный перебор; "SCAN t USING INDEX ..." — упорядоченный обход индекса;
+        # перебор строк VALUES и подзапросов таблицу не читает
+        return (bool(re.match(r"SCAN (?:TABLE )?\w+", plan_line)) and "USING" not in plan_line
+                and not re.match(r"SCAN (?:CONSTANT ROW|SUBQUERY)", plan_line))
+
+    def checkpoint(self, mode: str = "PASSIVE"):
+        """Перенос журнала WAL в основной файл; возвращает (busy, log, checkpointed)"""
+        if self.journal_mode != "WAL":
+            return None
+        try:
+            return self.connection().execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
         except sqlite3.Error as e:
-            log_message(f"Ошибка в round-robin назначении: {e}")
+            log_message(f"Ошибка checkpoint журнала WAL: {e}")
             return None
 
+    @contextmanager
+    def bulk_load(self, cur, tables):
+        # Отключить триггеры в SQLite нельзя: удаляем и создаем заново в той же транзакции,
+        # другие соединения базу без триггеров не увидят. Вторичные индексы тоже пересоздаются:
+        # построить индекс по готовой таблице быстрее, чем обновлять его на каждой вставке
+        objects = cur.execute(f'''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('trigger', 'index') AND sql IS NOT NULL AND tbl_name IN ({", ".join("?" * len(tables))})
+        ''', tuple(tables)).fetchall()
+        for object_type, name, _ in objects:
+            cur.execute(f'DROP {object_type.upper()} "{name}"')
+        cur.execute(f"PRAGMA cache_size = -{BULK_LOAD_CACHE_KB}")
+
+        def write(table, columns, rows):
+            cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                            rows)
 
-# ======================= ИНИЦИАЛИЗАЦИЯ БД =======================
-def init_database():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
+        try:
+            yield write
+        finally:
+            for _, _, sql in objects:
+                cur.execute(sql)
+            for pragma in self.PRAGMAS:
+                cur.execute(pragma)
+
+    def drop_all(self, tables):
+        # Вся база — один файл: удаляем его вместе с журналом WAL
+        self.close_all()
+        for path in (self.path, self.path + "-wal", self.path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close_all(self):
+        """Закрыть все соединения (перед удалением или заменой файла БД)"""
+        # Сворачиваем журнал, чтобы рядом с базой не оставался разросшийся -wal файл
+        if getattr(self._local, "conn", None) is not None and self._local.generation == self._generation:
+            self.checkpoint("TRUNCATE")
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+# Литералы, комментарии и маркеры, которые надо переписать для psycopg2
+_PG_TOKEN_RE = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|--[^\n]*|\?|%")
+
+
+@functools.lru_cache(maxsize=1024)
+def _pg_sql(sql: str) -> str:
+    """Запрос в стиле sqlite3 -> psycopg2: '?' становится %s, символ % экранируется"""
+    return _PG_TOKEN_RE.sub(lambda m: "%s" if m.group(0) == "?" else m.group(0).replace("%", "%%"), sql)
+
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_text(value) -> str:
+    """Значение поля для COPY ... FROM STDIN в текстовом формате"""
+    if value is None:
+        return "\\N"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+class _PgCursor:
+    """Курсор psycopg2 с поведением sqlite3: параметры '?' и execute(), возвращающий курсор"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql: str, params=()):
+        self._cursor.execute(_pg_sql(sql), tuple(params))
+        return self
+
+    def executemany(self, sql: str, seq_of_params):
+        # executemany psycopg2 ходит на сервер за каждой строкой, execute_batch — страницами;
+        # rowcount после него относится только к последней странице
+        psycopg2.extras.execute_batch(self._cursor, _pg_sql(sql), [tuple(params) for params in seq_of_params],
+                                      page_size=BULK_BATCH)
+        return self
+
+    def copy_expert(self, sql: str, file):
+        self._cursor.copy_expert(sql, file)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size: int = 1):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class PostgresDatabase(Database):
+    """PostgreSQL через ThreadedConnectionPool: за каждым потоком закреплено соединение пула"""
+
+    backend = "postgres"
+
+    SCHEMA_LOCK_ID = 7703234453  # ключ advisory-блокировки на время создания и миграции схемы
+
+    def __init__(self, dsn: str = PG_DSN, minconn: int = PG_POOL_MIN, maxconn: int = PG_POOL_MAX):
+        if psycopg2 is None:
+            raise RuntimeError("Для DB_BACKEND=postgres нужен пакет psycopg2-binary (см. requirements.txt)")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+        self._prepared = {}
+        self._stream_ids = iter(range(1, 1 << 62))
+        # Значения возвращаются так же, как из SQLite: время — строкой, суммы — float
+        self._typecasters = (
+            psycopg2.extensions.new_type((1114,), "FASTLAND_TIMESTAMP", lambda value, cur: value),
+            psycopg2.extensions.new_type(
+                (1700,), "FASTLAND_NUMERIC", lambda value, cur: None if value is None else float(value)),
+        )
+
+    def _get_pool(self):
+        # Пул создается при первом запросе: импорт модуля не требует доступного сервера
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        return self._pool
+
+    def connection(self):
+        """Соединение пула, закрепленное за текущим потоком"""
+        pool = self._get_pool()
+        key = threading.get_ident()
+        conn = pool.getconn(key)
+        if conn.closed:
+            # Соединение оборвано (например, сервер перезапущен) — берем новое
+            pool.putconn(conn, key, close=True)
+            conn = pool.getconn(key)
+        if self._prepared.get(id(conn)) is not conn:
+            self._prepare(conn)
+            self._prepared[id(conn)] = conn
+        return conn
+
+    def _prepare(self, conn):
+        # Как и в SQLite, транзакции открываются явно в transaction(), а одиночные чтения не висят в "idle in transaction"
+        conn.autocommit = True
+        for typecaster in self._typecasters:
+            psycopg2.extensions.register_type(typecaster, conn)
+        with conn.cursor() as cur:
+            # CURRENT_TIMESTAMP в UTC и формат 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' — как у SQLite
+            cur.execute("SET TIME ZONE 'UTC'")
+            cur.execute("SET datestyle TO ISO")
 
-    # Создание таблиц
-    cur.executescript('''
+    @staticmethod
+    def _in_transaction(conn) -> bool:
+        return conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    @staticmethod
+    def _rollback(conn):
+        if conn.closed:
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute("ROLLBACK")
+        except psycopg2.Error as e:
+            log_message(f"Ошибка отката транзакции PostgreSQL: {e}")
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция: commit при успехе, rollback при ошибке; вложенный вызов присоединяется к открытой"""
+        conn = self.connection()
+        cur = _PgCursor(conn.cursor())
+        if self._in_transaction(conn):
+            yield cur
+            return
+
+        cur.execute("BEGIN")
+        try:
+            yield cur
+        except BaseException:
+            self._rollback(conn)
+            raise
+        else:
+            try:
+                cur.execute("COMMIT")
+            except BaseException:
+                self._rollback(conn)
+                raise
+
+    def execute(self, sql: str, params=()) -> _PgCursor:
+        return _PgCursor(self.connection().cursor()).execute(sql, params)
+
+    def stream(self, sql: str, params=(), batch_size: int = PG_STREAM_BATCH):
+        """Чтение серверным курсором (DECLARE/FETCH): клиент держит в памяти не больше batch_size строк"""
+        conn = self.connection()
+        cur = _PgCursor(conn.cursor())
+        name = f"fastland_stream_{next(self._stream_ids)}"
+        # Серверный курсор живет только внутри транзакции
+        own_transaction = not self._in_transaction(conn)
+        if own_transaction:
+            cur.execute("BEGIN READ ONLY")
+        try:
+            cur.execute(f"DECLARE {name} NO SCROLL CURSOR FOR {sql}", params)
+            while True:
+                rows = cur.execute(f"FETCH FORWARD {int(batch_size)} FROM {name}").fetchall()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            if not conn.closed:
+                failed = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR
+                # Завершение собственной транзакции закрывает и курсор
+                if own_transaction and failed:
+                    self._rollback(conn)
+                elif own_transaction:
+                    cur.execute("COMMIT")
+                elif not failed:
+                    cur.execute(f"CLOSE {name}")
+
+    @staticmethod
+    def group_concat(expr: str, separator: str = ", ") -> str:
+        return f"STRING_AGG({expr}, '{separator}')"
+
+    @staticmethod
+    def casefold(expr: str) -> str:
+        return f"LOWER({expr})"
+
+    @staticmethod
+    def add_days(timestamp_expr: str, days_expr: str) -> str:
+        return f"CAST({timestamp_expr} AS TIMESTAMP) + ({days_expr}) * INTERVAL '1 day'"
+
+    def lock_schema(self, cur):
+        cur.execute("SELECT pg_advisory_xact_lock(?)", (self.SCHEMA_LOCK_ID,))
+
+    def schema_version(self, cur) -> int:
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        return cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def set_schema_version(self, cur, version: int):
+        cur.execute("DELETE FROM schema_version")
+        cur.execute("INSERT INTO schema_version (version) VALUES (?)", (int(version),))
+
+    def query_plan(self, sql: str, params=()) -> list:
+        with self.transaction() as cur:
+            # С запретом seq scan планировщик берет индекс, если тот вообще применим
+            cur.execute("SET LOCAL enable_seqscan = off")
+            return [row[0] for row in cur.execute(f"EXPLAIN {sql}", params).fetchall()]
+
+    @staticmethod
+    def is_full_scan(plan_line: str) -> bool:
+        return "Seq Scan" in plan_line
+
+    @contextmanager
+    def bulk_load(self, cur, tables):
+        # Блокировка до конца транзакции: чужие вставки не займут id, выданные вызывающим
+        cur.execute(f"LOCK TABLE {', '.join(tables)} IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("SET LOCAL synchronous_commit = off")
+        # Вторичные индексы (кроме индексов ограничений) строятся заново после загрузки
+        indexes = cur.execute(f'''
+            SELECT i.indexname, i.indexdef FROM pg_indexes i
+            WHERE i.schemaname = current_schema() AND i.tablename IN ({", ".join("?" * len(tables))})
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = (quote_ident(i.indexname))::regclass)
+        ''', tuple(tables)).fetchall()
+        for name, _ in indexes:
+            cur.execute(f'DROP INDEX "{name}"')
+        for table in tables:
+            cur.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")
+
+        def write(table, columns, rows):
+            # COPY в текстовом формате: в разы быстрее пакетов INSERT
+            data = io.StringIO()
+            for row in rows:
+                data.write("\t".join(_copy_text(value) for value in row))
+                data.write("\n")
+            data.seek(0)
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", data)
+
+        try:
+            yield write
+        finally:
+            for _, sql in indexes:
+                cur.execute(sql)
+            for table in tables:
+                cur.execute(f"ALTER TABLE {table} ENABLE TRIGGER USER")
+                # Последовательность догоняет явно вставленные id
+                cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                            f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)")
+
+    def drop_all(self, tables):
+        with self.transaction() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {', '.join(tables)} CASCADE")
+
+    def close_all(self):
+        """Закрыть все соединения пула"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._prepared.clear()
+        if pool is not None:
+            pool.closeall()
+
+
+def create_database(backend: str = DB_BACKEND) -> Database:
+    """Хранилище по настройке DB_BACKEND"""
+    if backend == "sqlite":
+        return SqliteDatabase(DB_FILE)
+    if backend in ("postgres", "postgresql"):
+        return PostgresDatabase(PG_DSN)
+    raise ValueError(f"Неизвестный движок БД: {backend!r} (ожидается sqlite или postgres)")
+
+
+db = create_database()
+
+
+# ======================= СЕРВИС АВТОМАТИЧЕСКОГО НАЗНАЧЕНИЯ =======================
+DATA_VERSION_ROLES = "user_roles"  # пользователи, роли и их связи
+DATA_VERSION_FLOWS = "approval_flows"  # маршруты согласования (увеличивают триггеры на approval_flows)
+
+
+def bump_data_version(cur, name: str):
+    """Отметить изменение справочных данных: клиенты с кэшем перечитают их при следующем обращении"""
+    cur.execute('''
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1
+    ''', (name,))
+
+
+class AssignmentStrategy:
+    """Стратегия выбора исполнителя среди активных пользователей роли"""
+    name = None
+
+    def choose(self, cur, role_name: str, users: list) -> int:
+        """Вернуть id исполнителя; users — непустой список id по возрастанию, cur — текущая транзакция"""
+        raise NotImplementedError
+
+    def choose_many(self, cur, role_name: str, users: list, count: int) -> list:
+        """Исполнители для count задач роли, создаваемых одним пакетом"""
+        return [self.choose(cur, role_name, users) for _ in range(count)]
+
+
+class RoundRobinStrategy(AssignmentStrategy):
+    """По очереди. Счетчик выданных задач роли хранится в assignment_cursors,
+    поэтому очередь не начинается заново при перезапуске клиента и общая для всех рабочих мест."""
+    name = "round_robin"
+
+    def choose(self, cur, role_name, users):
+        issued = cur.execute('''
+            INSERT INTO assignment_cursors (role_name, issued) VALUES (?, 1)
+            ON CONFLICT (role_name) DO UPDATE SET issued = assignment_cursors.issued + 1
+            RETURNING issued
+        ''', (role_name,)).fetchall()[0][0]
+        return users[(issued - 1) % len(users)]
+
+    def choose_many(self, cur, role_name, users, count):
+        # Позиция очереди сдвигается на весь пакет одним запросом
+        issued = cur.execute('''
+            INSERT INTO assignment_cursors (role_name, issued) VALUES (?, ?)
+            ON CONFLICT (role_name) DO UPDATE SET issued = assignment_cursors.issued + excluded.issued
+            RETURNING issued
+        ''', (role_name, count)).fetchall()[0][0]
+        return [users[position % len(users)] for position in range(issued - count, issued)]
+
+
+TASK_LOAD_SQL = "SELECT user_id, pending FROM user_task_load WHERE user_id IN ({placeholders})"
+
+
+class LeastLoadedStrategy(AssignmentStrategy):
+    """Пользователь с наименьшим числом ожидающих задач, при равенстве — с меньшим id.
+
+    Число задач берется из user_task_load, которую ведут триггеры на approval_tasks,
+    поэтому выбор стоит одного чтения по первичному ключу, а не COUNT(*) по задачам.
+    Задача, созданная в той же транзакции, сразу учитывается при следующем выборе.
+    """
+    name = "least_loaded"
+
+    def choose(self, cur, role_name, users):
+        load = dict(cur.execute(TASK_LOAD_SQL.format(placeholders=", ".join("?" * len(users))), users).fetchall())
+        return min(users, key=lambda user_id: (load.get(user_id, 0), user_id))
+
+    def choose_many(self, cur, role_name, users, count):
+        # Задачи пакета еще не вставлены и в user_task_load не видны, поэтому нагрузка
+        # досчитывается в памяти: каждая следующая задача достается наименее загруженному
+        load = dict(cur.execute(TASK_LOAD_SQL.format(placeholders=", ".join("?" * len(users))), users).fetchall())
+        heap = [(load.get(user_id, 0), user_id) for user_id in users]
+        heapq.heapify(heap)
+        chosen = []
+        for _ in range(count):
+            pending, user_id = heapq.heappop(heap)
+            chosen.append(user_id)
+            heapq.heappush(heap, (pending + 1, user_id))
+        return chosen
+
+
+ASSIGNMENT_STRATEGIES = {strategy.name: strategy for strategy in (LeastLoadedStrategy, RoundRobinStrategy)}
+
+
+def create_assignment_strategy(name: str = ASSIGNMENT_STRATEGY) -> AssignmentStrategy:
+    """Стратегия назначения по настройке ASSIGNMENT_STRATEGY"""
+    if name not in ASSIGNMENT_STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия назначения: {name!r} "
+                         f"(ожидается {' или '.join(ASSIGNMENT_STRATEGIES)})")
+    return ASSIGNMENT_STRATEGIES[name]()
+
+
+class AutoAssignService:
+    """Назначение исполнителей по ролям; кого выбрать, решает стратегия (AssignmentStrategy).
+
+    Состав ролей держится в памяти целиком и перечитывается, только когда меняется версия
+    DATA_VERSION_ROLES в data_versions. В одной транзакции версия сверяется один раз,
+    дальше все назначения разрешаются в памяти.
+    """
+
+    def __init__(self, strategy: Optional[AssignmentStrategy] = None):
+        self.strategy = strategy or create_assignment_strategy()
+        self._role_users = None  # роль -> [id активных пользователей] по возрастанию id
+        self._roles_version = None
+        self._checked_cur = None  # транзакция, в которой версия уже сверена
+        log_message(f"Сервис автоматического назначения инициализирован ({self.strategy.name})")
+
+    def invalidate(self):
+        """Сбросить кэш ролей (например, после пересоздания базы)"""
+        self._role_users = self._roles_version = self._checked_cur = None
+
+    def _role_members(self, cur=None) -> dict:
+        if cur is not None and cur is self._checked_cur:
+            return self._role_users
+
+        def query(sql, params=()):
+            return cur.execute(sql, params).fetchall() if cur is not None else db.fetchall(sql, params)
+
+        rows = query("SELECT version FROM data_versions WHERE name = ?", (DATA_VERSION_ROLES,))
+        version = rows[0][0] if rows else 0
+        if self._role_users is None or version != self._roles_version:
+            role_users = {}
+            for role_name, user_id in query('''
+                SELECT r.name, u.id FROM users u
+                JOIN user_roles ur ON u.id = ur.user_id
+                JOIN roles r ON ur.role_id = r.id
+                WHERE u.is_active = 1
+                ORDER BY r.name, u.id
+            '''):
+                role_users.setdefault(role_name, []).append(user_id)
+            self._role_users, self._roles_version = role_users, version
+        self._checked_cur = cur
+        return self._role_users
+
+    def get_next_user(self, role_name: str, cur=None) -> Optional[int]:
+        """Выбрать исполнителя для задачи роли (cur — текущая транзакция)"""
+        if cur is None:
+            with db.transaction() as cur:
+                return self.get_next_user(role_name, cur)
+        # Сбой назначения не должен прерывать транзакцию вызывающего: задача останется без исполнителя
+        try:
+            with db.savepoint(cur, "auto_assign"):
+                users = self._role_members(cur).get(role_name)
+
+                if not users:
+                    return None
+
+                return self.strategy.choose(cur, role_name, users)
+        except DB_ERRORS as e:
+            log_message(f"Ошибка автоматического назначения ({self.strategy.name}): {e}")
+            return None
+
+    def get_next_users(self, role_name: str, count: int, cur=None) -> list:
+        """Исполнители для count задач роли, создаваемых одним пакетом (None — назначить некого)"""
+        if cur is None:
+            with db.transaction() as cur:
+                return self.get_next_users(role_name, count, cur)
+        try:
+            with db.savepoint(cur, "auto_assign"):
+                users = self._role_members(cur).get(role_name)
+
+                if not users or count <= 0:
+                    return [None] * count
+
+                return self.strategy.choose_many(cur, role_name, users, count)
+        except DB_ERRORS as e:
+            log_message(f"Ошибка автоматического назначения ({self.strategy.name}): {e}")
+            return [None] * count
+
+
+# ======================= ИНИЦИАЛИЗАЦИЯ БД =======================
+# Схема для SQLite; даты хранятся строками 'ГГГГ-ММ-ДД ЧЧ:ММ:СС'
+SQLITE_SCHEMA = '''
         CREATE TABLE IF NOT EXISTS organizations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -776,7 +2063,7 @@ def init_database():
             name TEXT NOT NULL,
             description TEXT,
             department TEXT,
-            steps TEXT  -- JSON: [{"step":1, "role":"Юрист", "deadline_days":2}, ...]
+            steps TEXT  -- JSON: [{"step":1, "role":"Юрист", "deadline_days":2}, ...]; с миграции 6 — approval_flow_steps
         );
 
         CREATE TABLE IF NOT EXISTS approval_instances (
@@ -814,366 +2101,1169 @@ def init_database():
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(id)
         );
-    ''')
 
-    # Добавление тестовых данных
-    try:
-        # Организация
-        if cur.execute("SELECT COUNT(*) FROM organizations").fetchone()[0] == 0:
-            # Основная организация
-            cur.execute(
-                "INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                ("ООО 'ФАСТЛЭНД'", "legal", "7703234453", "770301001", "1027739292448",
-                 "123242, Г.МОСКВА, ВН.ТЕР.Г. МУНИЦИПАЛЬНЫЙ ОКРУГ ПРЕСНЕНСКИЙ, УЛ БОЛЬШАЯ ГРУЗИНСКАЯ, Д. 20, ПОМЕЩ. 3/П",
-                 "+7 (495) 785-81-11", "fastland@cafemumu.ru")
-            )
-
-            # 20 тестовых организаций
-            test_organizations = [
-                ("ООО 'Поставщик+'", "legal", "3328450239", "772501001", "1073328002846",
-                 "115470, Г.МОСКВА, УЛ. СУДОСТРОИТЕЛЬНАЯ, Д.25, К.2",
-                 "+7 (495) 123-45-67", "info@postavchik.ru"),
-                ("ТК 'Ашан'", "legal", "7703270067", "502901001", "1027739329408",
-                 "141031, МОСКОВСКАЯ ОБЛАСТЬ, Г.О. МЫТИЩИ, Г МЫТИЩИ, Ш ОСТАШКОВСКОЕ, Д. 1",
-                 "+7 (495) 234-56-78", "contracts@auchan.ru"),
-                ("ООО 'СервисПро'", "legal", "772708432703", "772701001", "1237700891119",
-                 "117461, Г.МОСКВА, ВН.ТЕР.Г. МУНИЦИПАЛЬНЫЙ ОКРУГ ЗЮЗИНО, УЛ ХЕРСОНСКАЯ, Д. 5, К. 2, ПОМЕЩ. 1Н",
-                 "+7 (495) 345-67-89", "office@servicepro.ru"),
-                ("ИП Иванова И.В.", "individual", "500300703103", "", "323774600494380",
-                 "125373, г.Москва, Походный проезд, домовладение 3, стр.2",
-                 "+7 (495) 456-78-90", "ivanov@mail.ru"),
-                ("ООО 'МеталлТрейд'", "legal", "7708123456", "770801001", "1157746123456",
-                 "109428, г.Москва, Рязанский проспект, д.8А, стр.1",
-                 "+7 (495) 567-89-01", "metal@metalltrade.ru"),
-                ("АО 'СтройМатериалы'", "legal", "7711223344", "771101001", "1167745678901",
-                 "127015, г.Москва, ул.Бутырская, д.86, офис 305",
-                 "+7 (495) 678-90-12", "info@stroymat.ru"),
-                ("ООО 'ТехноПрофи'", "legal", "7733445566", "773301001", "1177756789012",
-                 "115201, г.Москва, Каширское шоссе, д.31, корп.1А",
-                 "+7 (495) 789-01-23", "order@technoprofi.ru"),
-                ("ЗАО 'Пищепром'", "legal", "7744556677", "774401001", "1187767890123",
-                 "115114, г.Москва, ул.Летниковская, д.10, стр.4",
-                 "+7 (495) 890-12-34", "sales@foodprom.ru"),
-                ("ООО 'ЛогистикГрупп'", "legal", "7755667788", "775501001", "1197778901234",
-                 "125040, г.Москва, ул.Правды, д.15, офис 210",
-                 "+7 (495) 901-23-45", "logist@logisticgroup.ru"),
-                ("ИП Петров С.М.", "individual", "500400803204", "", "320774600567891",
-                 "119361, г.Москва, ул.Озерная, д.42, кв.15",
-                 "+7 (495) 012-34-56", "petrov@mail.ru"),
-                ("ООО 'ЭкоПродукт'", "legal", "7766778899", "776601001", "1207789012345",
-                 "121096, г.Москва, ул.Барклая, д.8, стр.3",
-                 "+7 (495) 123-45-67", "eco@ecoproduct.ru"),
-                ("АО 'ТрансАвто'", "legal", "7777889900", "777701001", "1217790123456",
-                 "109316, г.Москва, Волгоградский проспект, д.47",
-                 "+7 (495) 234-56-78", "trans@transauto.ru"),
-                ("ООО 'ИТСервис'", "legal", "7788990011", "778801001", "1227801234567",
-                 "123557, г.Москва, ул.Краснопресненская, д.12",
-                 "+7 (495) 345-67-89", "support@itservice.ru"),
-                ("ИП Сидорова А.К.", "individual", "500500903305", "", "321774600678902",
-                 "127273, г.Москва, ул.Яблочкова, д.21, кв.8",
-                 "+7 (495) 456-78-90", "sidorova@mail.ru"),
-                ("ООО 'МедТехника'", "legal", "7799001122", "779901001", "1237812345678",
-                 "117218, г.Москва, ул.Кржижановского, д.15, корп.2",
-                 "+7 (495) 567-89-01", "med@medtech.ru"),
-                ("ЗАО 'СтройИнвест'", "legal", "7800112233", "780001001", "1247823456789",
-                 "125190, г.Москва, ул.Космонавта Волкова, д.10",
-                 "+7 (495) 678-90-12", "invest@stroinvest.ru"),
-                ("ООО 'АгроПродукт'", "legal", "7811223344", "781101001", "1257834567890",
-                 "115533, г.Москва, проспект Андропова, д.18",
-                 "+7 (495) 789-01-23", "agro@agroproduct.ru"),
-                ("ИП Козлов В.П.", "individual", "500600100406", "", "322774600789013",
-                 "119634, г.Москва, ул.Авиаторов, д.7, кв.23",
-                 "+7 (495) 890-12-34", "kozlov@mail.ru"),
-                ("ООО 'Безопасность+'", "legal", "7822334455", "782201001", "1267845678901",
-                 "127006, г.Москва, ул.Долгоруковская, д.6",
-                 "+7 (495) 901-23-45", "security@securityplus.ru"),
-                ("АО 'ФинансКонсалт'", "legal", "7833445566", "783301001", "1277856789012",
-                 "125009, г.Москва, ул.Тверская, д.22А",
-                 "+7 (495) 012-34-56", "finance@finconsult.ru")
-            ]
-
-            # ИСПРАВЛЕННЫЙ ЗАПРОС - добавлен organization_type
-            cur.executemany(
-                "INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                test_organizations
-            )
-
-        # Роли
-        if cur.execute("SELECT COUNT(*) FROM roles").fetchone()[0] == 0:
-            roles = [
-                ("Генеральный директор", "Руководитель организации"),
-                ("Финансовый директор", "Руководитель финансового отдела"),
-                ("Юрист", "Юридическая экспертиза"),
-                ("Начальник отдела закупок", "Руководитель отдела закупок"),
-                ("Начальник отдела продаж", "Руководитель отдела продаж"),
-                ("Коммерческий директор", "Руководитель коммерческой деятельности"),
-                ("Администратор", "Администратор системы"),
-                ("Служба безопасности", "Проверка контрагентов"),
-                ("Отдел логистики", "Логистическая экспертиза")
-            ]
-            cur.executemany("INSERT INTO roles (name, description) VALUES (?, ?)", roles)
-
-        # Пользователи
-        if cur.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
-            users_data = [
-                ("admin", "Администратор Системы", hash_password("admin"), "ИТ", "Администратор", 1),
-                ("gen_dir", "Иванов Иван Иванович", hash_password("123"), "Руководство", "Генеральный директор", 1),
-                ("finance", "Петров Петр Петрович", hash_password("123"), "Финансы", "Финансовый директор", 1),
-                ("lawyer", "Сидорова Мария Ивановна", hash_password("123"), "Юридический", "Юрист", 1),
-                ("sales", "Козлов Алексей Владимирович", hash_password("123"), "Продажи", "Начальник отдела продаж", 1),
-                ("purchase", "Николаев Дмитрий Сергеевич", hash_password("123"), "Закупки", "Начальник отдела закупок",
-                 1),
-                ("commercial", "Федорова Ольга Петровна", hash_password("123"), "Коммерция", "Коммерческий директор",
-                 1),
-                ("security", "Алексеев Сергей Викторович", hash_password("123"), "Безопасность", "Начальник СБ", 1),
-                ("logistics", "Орлов Михаил Петрович", hash_password("123"), "Логистика", "Начальник отдела логистики",
-                 1)
-            ]
-
-            for user in users_data:
-                cur.execute(
-                    "INSERT INTO users (username, full_name, password, department, position, is_active) VALUES (?, ?, ?, ?, ?, ?)",
-                    user
-                )
-                user_id = cur.lastrowid
-
-                # Назначение ролей
-                username = user[0]
-                role_map = {
-                    "admin": "Администратор",
-                    "gen_dir": "Генеральный директор",
-                    "finance": "Финансовый директор",
-                    "lawyer": "Юрист",
-                    "sales": "Начальник отдела продаж",
-                    "purchase": "Начальник отдела закупок",
-                    "commercial": "Коммерческий директор",
-                    "security": "Служба безопасности",
-                    "logistics": "Отдел логистики"
-                }
-
-                if username in role_map:
-                    role_name = role_map[username]
-                    cur.execute("SELECT id FROM roles WHERE name = ?", (role_name,))
-                    role_result = cur.fetchone()
-                    if role_result:
-                        cur.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)",
-                                    (user_id, role_result[0]))
-
-        # Маршруты согласования - обновлены согласно бизнес-процессу
-        if cur.execute("SELECT COUNT(*) FROM approval_flows").fetchone()[0] == 0:
-            flows = [
-                ("Закупки", "Маршрут для договоров закупок", "Закупки",
-                 '[{"step": 1, "role": "Юрист", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Финансовый директор", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Служба безопасности", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Отдел логистики", "deadline_days": 2}, '
-                 '{"step": 2, "role": "Коммерческий директор", "deadline_days": 2}, '
-                 '{"step": 3, "role": "Генеральный директор", "deadline_days": 3}]'),
-
-                ("Продажи", "Маршрут для договоров продаж", "Продажи",
-                 '[{"step": 1, "role": "Начальник отдела продаж", "deadline_days": 3}, '
-                 '{"step": 2, "role": "Юрист", "deadline_days": 2}, '
-                 '{"step": 2, "role": "Финансовый директор", "deadline_days": 2}, '
-                 '{"step": 2, "role": "Служба безопасности", "deadline_days": 2}, '
-                 '{"step": 2, "role": "Отдел логистики", "deadline_days": 2}, '
-                 '{"step": 3, "role": "Коммерческий директор", "deadline_days": 2}, '
-                 '{"step": 4, "role": "Генеральный директор", "deadline_days": 3}]'),
-
-                ("Общий", "Общий маршрут согласования", "Общий",
-                 '[{"step": 1, "role": "Юрист", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Финансовый директор", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Служба безопасности", "deadline_days": 2}, '
-                 '{"step": 1, "role": "Отдел логистики", "deadline_days": 2}, '
-                 '{"step": 2, "role": "Коммерческий директор", "deadline_days": 2}, '
-                 '{"step": 3, "role": "Генеральный директор", "deadline_days": 3}]')
-            ]
-
-            cur.executemany(
-                "INSERT INTO approval_flows (name, description, department, steps) VALUES (?, ?, ?, ?)",
-                flows
-            )
-
-        # 50 тестовых договоров
-        if cur.execute("SELECT COUNT(*) FROM contracts").fetchone()[0] == 0:
-            # Создаем словарь для сопоставления названий организаций с их ID
-            org_name_to_id = {}
-            cur.execute("SELECT id, name FROM organizations")
-            for org_id, org_name in cur.fetchall():
-                org_name_to_id[org_name] = org_id
-
-            # Получаем ID пользователей
-            user_ids = {}
-            cur.execute("SELECT id, username FROM users")
-            for user_id, username in cur.fetchall():
-                user_ids[username] = user_id
-
-            test_contracts = [
-                # Договоры закупок (20 шт.)
-                ("Д-2025-001", "Поставка сырья для производства", org_name_to_id.get("ООО 'Поставщик+'"), 1500000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-002", "Закупка оборудования для цеха", org_name_to_id.get("ООО 'МеталлТрейд'"), 2500000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-003", "Поставка упаковочных материалов", org_name_to_id.get("ООО 'СервисПро'"), 500000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-004", "Закупка спецодежды для сотрудников", org_name_to_id.get("ИП Иванова И.В."), 250000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-005", "Поставка электронных компонентов", org_name_to_id.get("ООО 'ТехноПрофи'"), 1800000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-006", "Закупка продуктов питания", org_name_to_id.get("ЗАО 'Пищепром'"), 1200000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-007", "Поставка логистических услуг", org_name_to_id.get("ООО 'ЛогистикГрупп'"), 800000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-008", "Закупка экологичной продукции", org_name_to_id.get("ООО 'ЭкоПродукт'"), 950000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "custom", None),
-                ("Д-2025-009", "Поставка автотранспорта", org_name_to_id.get("АО 'ТрансАвто'"), 3500000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-010", "Закупка IT оборудования", org_name_to_id.get("ООО 'ИТСервис'"), 1200000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-011", "Поставка медицинского оборудования", org_name_to_id.get("ООО 'МедТехника'"), 2800000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-012", "Закупка строительных материалов", org_name_to_id.get("ЗАО 'СтройИнвест'"), 3200000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-013", "Поставка сельхозпродукции", org_name_to_id.get("ООО 'АгроПродукт'"), 750000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-014", "Закупка систем безопасности", org_name_to_id.get("ООО 'Безопасность+'"), 1600000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "custom", None),
-                ("Д-2025-015", "Поставка финансовых услуг", org_name_to_id.get("АО 'ФинансКонсалт'"), 600000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-016", "Закупка канцелярских товаров", org_name_to_id.get("ИП Петров С.М."), 180000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-017", "Поставка химических реактивов", org_name_to_id.get("ООО 'Поставщик+'"), 890000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-018", "Закупка мебели для офиса", org_name_to_id.get("АО 'СтройМатериалы'"), 1450000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-                ("Д-2025-019", "Поставка промышленного оборудования", org_name_to_id.get("ООО 'ТехноПрофи'"), 4200000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
-                ("Д-2025-020", "Закупка программного обеспечения", org_name_to_id.get("ООО 'ИТСервис'"), 950000.0,
-                 user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
-
-                # Договоры продаж (20 шт.)
-                ("Д-2025-021", "Реализация готовой продукции", org_name_to_id.get("ТК 'Ашан'"), 2500000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-022", "Продажа полуфабрикатов оптом", org_name_to_id.get("ООО 'Поставщик+'"), 1800000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
-                ("Д-2025-023", "Экспорт продукции в ЕС", org_name_to_id.get("ЗАО 'Пищепром'"), 4800000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
-                ("Д-2025-024", "Реализация замороженных продуктов", org_name_to_id.get("ИП Козлов В.П."), 920000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-025", "Продажа кондитерских изделий", org_name_to_id.get("ТК 'Ашан'"), 1650000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
-                ("Д-2025-026", "Реализация мясной продукции", org_name_to_id.get("ООО 'ЭкоПродукт'"), 2100000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-027", "Продажа молочной продукции", org_name_to_id.get("ИП Сидорова А.К."), 1350000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-028", "Реализация хлебобулочных изделий", org_name_to_id.get("ООО 'АгроПродукт'"), 980000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
-                ("Д-2025-029", "Продажа напитков и соков", org_name_to_id.get("ТК 'Ашан'"), 1250000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-030", "Реализация детского питания", org_name_to_id.get("ООО 'Поставщик+'"), 1850000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
-                ("Д-2025-031", "Продажа диетических продуктов", org_name_to_id.get("ООО 'ЭкоПродукт'"), 760000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-032", "Реализация бакалейных товаров", org_name_to_id.get("ИП Петров С.М."), 540000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-033", "Продажа замороженных полуфабрикатов", org_name_to_id.get("ЗАО 'Пищепром'"), 1980000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
-                ("Д-2025-034", "Реализация консервированной продукции", org_name_to_id.get("ТК 'Ашан'"), 1120000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-035", "Продажа специй и приправ", org_name_to_id.get("ИП Иванова И.В."), 320000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
-                ("Д-2025-036", "Реализация кофе и чая", org_name_to_id.get("ООО 'АгроПродукт'"), 870000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-037", "Продажа алкогольной продукции", org_name_to_id.get("ТК 'Ашан'"), 2450000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
-                ("Д-2025-038", "Реализация табачных изделий", org_name_to_id.get("ООО 'Поставщик+'"), 1890000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-039", "Продажа кормов для животных", org_name_to_id.get("ООО 'ЭкоПродукт'"), 680000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
-                ("Д-2025-040", "Реализация бытовой химии", org_name_to_id.get("ИП Козлов В.П."), 450000.0,
-                 user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
-
-                # Общие договоры (10 шт.)
-                ("Д-2025-041", "Обслуживание оборудования", org_name_to_id.get("ООО 'СервисПро'"), 500000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "custom", None),
-                ("Д-2025-042", "Аренда складских помещений", org_name_to_id.get("ЗАО 'СтройИнвест'"), 1200000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
-                ("Д-2025-043", "Услуги охраны объекта", org_name_to_id.get("ООО 'Безопасность+'"), 680000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
-                ("Д-2025-044", "IT аутсорсинг", org_name_to_id.get("ООО 'ИТСервис'"), 950000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "urgent", None),
-                ("Д-2025-045", "Юридическое сопровождение", org_name_to_id.get("АО 'ФинансКонсалт'"), 420000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
-                ("Д-2025-046", "Транспортные услуги", org_name_to_id.get("АО 'ТрансАвто'"), 780000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "custom", None),
-                ("Д-2025-047", "Маркетинговые услуги", org_name_to_id.get("ООО 'ТехноПрофи'"), 560000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
-                ("Д-2025-048", "Консалтинговые услуги", org_name_to_id.get("АО 'ФинансКонсалт'"), 320000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "urgent", None),
-                ("Д-2025-049", "Ремонт офисных помещений", org_name_to_id.get("АО 'СтройМатериалы'"), 890000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
-                ("Д-2025-050", "Уборка производственных помещений", org_name_to_id.get("ИП Сидорова А.К."), 280000.0,
-                 user_ids.get("commercial"), "Общий", "Черновик", "custom", None)
-            ]
-
-            # Фильтруем договоры, для которых нашли организации
-            valid_contracts = [contract for contract in test_contracts if contract[2] is not None]
-
-            if valid_contracts:
-                cur.executemany(
-                    "INSERT INTO contracts (contract_number, title, counterparty, amount, owner_id, department, status, priority, deadline_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    valid_contracts
-                )
-                log_message(f"Создано {len(valid_contracts)} тестовых договоров")
-            else:
-                log_message("Не удалось создать тестовые договоры - организации не найдены")
-
-        conn.commit()
-        log_message("База данных успешно инициализирована с тестовыми данными")
+        -- Версии справочных данных, которые клиенты держат в кэше (например, состав ролей)
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+'''
 
-    except sqlite3.Error as e:
-        conn.rollback()
-        log_message(f"Ошибка при инициализации БД: {e}")
-        raise
-    finally:
-        conn.close()
+# Та же схема для PostgreSQL: SERIAL вместо AUTOINCREMENT, TIMESTAMP и NUMERIC вместо TEXT и REAL
+POSTGRES_SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS organizations (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            organization_type TEXT DEFAULT 'legal',  -- 'legal' или 'individual'
+            inn TEXT, kpp TEXT, ogrn TEXT,
+            legal_address TEXT, phone TEXT, email TEXT,
+            created_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc')
+        );
 
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            full_name TEXT NOT NULL,
+            password TEXT NOT NULL,
+            department TEXT,
+            position TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc')
+        );
 
-# ======================= АВТОРИЗАЦИЯ =======================
-def get_active_users_with_roles():
-    """Получить список активных пользователей с ролями"""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT u.id, u.full_name, u.username, u.is_active, u.department,
-                   GROUP_CONCAT(r.name, ', ') as roles
-            FROM users u
-            LEFT JOIN user_roles ur ON u.id = ur.user_id
-            LEFT JOIN roles r ON ur.role_id = r.id
-            WHERE u.is_active = 1
-            GROUP BY u.id
-            ORDER BY u.full_name
-        ''')
-        users = cur.fetchall()
-        conn.close()
-        return users
-    except sqlite3.Error as e:
-        log_message(f"Ошибка получения пользователей: {e}")
-        return []
+        CREATE TABLE IF NOT EXISTS roles (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT
+        );
 
+        CREATE TABLE IF NOT EXISTS user_roles (
+            user_id INTEGER REFERENCES users(id),
+            role_id INTEGER REFERENCES roles(id),
+            PRIMARY KEY(user_id, role_id)
+        );
 
-def get_user_roles(user_id):
-    """Получить роли пользователя"""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT r.name FROM roles r JOIN user_roles ur ON r.id = ur.role_id WHERE ur.user_id = ?",
-                    (user_id,))
-        roles = [row[0] for row in cur.fetchall()]
-        conn.close()
-        return roles
-    except sqlite3.Error as e:
-        log_message(f"Ошибка получения ролей: {e}")
+        CREATE TABLE IF NOT EXISTS contracts (
+            id SERIAL PRIMARY KEY,
+            contract_number TEXT UNIQUE,
+            title TEXT NOT NULL,
+            counterparty INTEGER REFERENCES organizations(id),
+            amount NUMERIC(15, 2) DEFAULT 0,
+            status TEXT DEFAULT 'Черновик',
+            owner_id INTEGER REFERENCES users(id),
+            department TEXT,
+            file_path TEXT,
+            priority TEXT DEFAULT 'standard',
+            deadline_at TIMESTAMP(0),
+            created_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc'),
+            updated_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc')
+        );
+
+        CREATE TABLE IF NOT EXISTS approval_flows (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            department TEXT,
+            steps TEXT  -- JSON: [{"step":1, "role":"Юрист", "deadline_days":2}, ...]; с миграции 6 — approval_flow_steps
+        );
+
+        CREATE TABLE IF NOT EXISTS approval_instances (
+            id SERIAL PRIMARY KEY,
+            contract_id INTEGER REFERENCES contracts(id),
+            flow_id INTEGER REFERENCES approval_flows(id),
+            status TEXT DEFAULT 'running',
+            started_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc'),
+            finished_at TIMESTAMP(0)
+        );
+
+        CREATE TABLE IF NOT EXISTS approval_tasks (
+            id SERIAL PRIMARY KEY,
+            instance_id INTEGER REFERENCES approval_instances(id),
+            step_order INTEGER,
+            role_name TEXT,
+            assigned_user_id INTEGER REFERENCES users(id),
+            status TEXT DEFAULT 'pending',
+            assigned_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc'),
+            completed_at TIMESTAMP(0),
+            comment TEXT,
+            deadline_at TIMESTAMP(0),
+            deadline_notified INTEGER DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id),
+            action TEXT,
+            details TEXT,
+            created_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc')
+        );
+
+        -- Версии справочных данных, которые клиенты держат в кэше (например, состав ролей)
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+'''
+
+SCHEMA_DDL = {"sqlite": SQLITE_SCHEMA, "postgres": POSTGRES_SCHEMA}
+
+# Все таблицы приложения (для сброса базы на сервере)
+APP_TABLES = ("audit_log", "approval_tasks", "approval_instances", "approval_flow_steps", "approval_flows", "contracts",
+              "user_roles", "roles", "users", "organizations", "data_versions", "user_task_load",
+              "assignment_cursors", "schema_version")
+
+
+def init_database():
+    try:
+        with db.transaction() as cur:
+            # Параллельно стартующие клиенты создают схему по очереди
+            db.lock_schema(cur)
+            db.executescript(cur, SCHEMA_DDL[db.backend])
+
+            # Добавление тестовых данных
+            # Организация
+            if cur.execute("SELECT COUNT(*) FROM organizations").fetchone()[0] == 0:
+                # Основная организация
+                cur.execute(
+                    "INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ("ООО 'ФАСТЛЭНД'", "legal", "7703234453", "770301001", "1027739292448",
+                     "123242, Г.МОСКВА, ВН.ТЕР.Г. МУНИЦИПАЛЬНЫЙ ОКРУГ ПРЕСНЕНСКИЙ, УЛ БОЛЬШАЯ ГРУЗИНСКАЯ, Д. 20, ПОМЕЩ. 3/П",
+                     "+7 (495) 785-81-11", "fastland@cafemumu.ru")
+                )
+
+                # 20 тестовых организаций
+                test_organizations = [
+                    ("ООО 'Поставщик+'", "legal", "3328450239", "772501001", "1073328002846",
+                     "115470, Г.МОСКВА, УЛ. СУДОСТРОИТЕЛЬНАЯ, Д.25, К.2",
+                     "+7 (495) 123-45-67", "info@postavchik.ru"),
+                    ("ТК 'Ашан'", "legal", "7703270067", "502901001", "1027739329408",
+                     "141031, МОСКОВСКАЯ ОБЛАСТЬ, Г.О. МЫТИЩИ, Г МЫТИЩИ, Ш ОСТАШКОВСКОЕ, Д. 1",
+                     "+7 (495) 234-56-78", "contracts@auchan.ru"),
+                    ("ООО 'СервисПро'", "legal", "772708432703", "772701001", "1237700891119",
+                     "117461, Г.МОСКВА, ВН.ТЕР.Г. МУНИЦИПАЛЬНЫЙ ОКРУГ ЗЮЗИНО, УЛ ХЕРСОНСКАЯ, Д. 5, К. 2, ПОМЕЩ. 1Н",
+                     "+7 (495) 345-67-89", "office@servicepro.ru"),
+                    ("ИП Иванова И.В.", "individual", "500300703103", "", "323774600494380",
+                     "125373, г.Москва, Походный проезд, домовладение 3, стр.2",
+                     "+7 (495) 456-78-90", "ivanov@mail.ru"),
+                    ("ООО 'МеталлТрейд'", "legal", "7708123456", "770801001", "1157746123456",
+                     "109428, г.Москва, Рязанский проспект, д.8А, стр.1",
+                     "+7 (495) 567-89-01", "metal@metalltrade.ru"),
+                    ("АО 'СтройМатериалы'", "legal", "7711223344", "771101001", "1167745678901",
+                     "127015, г.Москва, ул.Бутырская, д.86, офис 305",
+                     "+7 (495) 678-90-12", "info@stroymat.ru"),
+                    ("ООО 'ТехноПрофи'", "legal", "7733445566", "773301001", "1177756789012",
+                     "115201, г.Москва, Каширское шоссе, д.31, корп.1А",
+                     "+7 (495) 789-01-23", "order@technoprofi.ru"),
+                    ("ЗАО 'Пищепром'", "legal", "7744556677", "774401001", "1187767890123",
+                     "115114, г.Москва, ул.Летниковская, д.10, стр.4",
+                     "+7 (495) 890-12-34", "sales@foodprom.ru"),
+                    ("ООО 'ЛогистикГрупп'", "legal", "7755667788", "775501001", "1197778901234",
+                     "125040, г.Москва, ул.Правды, д.15, офис 210",
+                     "+7 (495) 901-23-45", "logist@logisticgroup.ru"),
+                    ("ИП Петров С.М.", "individual", "500400803204", "", "320774600567891",
+                     "119361, г.Москва, ул.Озерная, д.42, кв.15",
+                     "+7 (495) 012-34-56", "petrov@mail.ru"),
+                    ("ООО 'ЭкоПродукт'", "legal", "7766778899", "776601001", "1207789012345",
+                     "121096, г.Москва, ул.Барклая, д.8, стр.3",
+                     "+7 (495) 123-45-67", "eco@ecoproduct.ru"),
+                    ("АО 'ТрансАвто'", "legal", "7777889900", "777701001", "1217790123456",
+                     "109316, г.Москва, Волгоградский проспект, д.47",
+                     "+7 (495) 234-56-78", "trans@transauto.ru"),
+                    ("ООО 'ИТСервис'", "legal", "7788990011", "778801001", "1227801234567",
+                     "123557, г.Москва, ул.Краснопресненская, д.12",
+                     "+7 (495) 345-67-89", "support@itservice.ru"),
+                    ("ИП Сидорова А.К.", "individual", "500500903305", "", "321774600678902",
+                     "127273, г.Москва, ул.Яблочкова, д.21, кв.8",
+                     "+7 (495) 456-78-90", "sidorova@mail.ru"),
+                    ("ООО 'МедТехника'", "legal", "7799001122", "779901001", "1237812345678",
+                     "117218, г.Москва, ул.Кржижановского, д.15, корп.2",
+                     "+7 (495) 567-89-01", "med@medtech.ru"),
+                    ("ЗАО 'СтройИнвест'", "legal", "7800112233", "780001001", "1247823456789",
+                     "125190, г.Москва, ул.Космонавта Волкова, д.10",
+                     "+7 (495) 678-90-12", "invest@stroinvest.ru"),
+                    ("ООО 'АгроПродукт'", "legal", "7811223344", "781101001", "1257834567890",
+                     "115533, г.Москва, проспект Андропова, д.18",
+                     "+7 (495) 789-01-23", "agro@agroproduct.ru"),
+                    ("ИП Козлов В.П.", "individual", "500600100406", "", "322774600789013",
+                     "119634, г.Москва, ул.Авиаторов, д.7, кв.23",
+                     "+7 (495) 890-12-34", "kozlov@mail.ru"),
+                    ("ООО 'Безопасность+'", "legal", "7822334455", "782201001", "1267845678901",
+                     "127006, г.Москва, ул.Долгоруковская, д.6",
+                     "+7 (495) 901-23-45", "security@securityplus.ru"),
+                    ("АО 'ФинансКонсалт'", "legal", "7833445566", "783301001", "1277856789012",
+                     "125009, г.Москва, ул.Тверская, д.22А",
+                     "+7 (495) 012-34-56", "finance@finconsult.ru")
+                ]
+
+                # ИСПРАВЛЕННЫЙ ЗАПРОС - добавлен organization_type
+                cur.executemany(
+                    "INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    test_organizations
+                )
+
+            # Роли
+            if cur.execute("SELECT COUNT(*) FROM roles").fetchone()[0] == 0:
+                roles = [
+                    ("Генеральный директор", "Руководитель организации"),
+                    ("Финансовый директор", "Руководитель финансового отдела"),
+                    ("Юрист", "Юридическая экспертиза"),
+                    ("Начальник отдела закупок", "Руководитель отдела закупок"),
+                    ("Начальник отдела продаж", "Руководитель отдела продаж"),
+                    ("Коммерческий директор", "Руководитель коммерческой деятельности"),
+                    ("Администратор", "Администратор системы"),
+                    ("Служба безопасности", "Проверка контрагентов"),
+                    ("Отдел логистики", "Логистическая экспертиза")
+                ]
+                cur.executemany("INSERT INTO roles (name, description) VALUES (?, ?)", roles)
+
+            # Пользователи
+            if cur.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+                users_data = [
+                    ("admin", "Администратор Системы", hash_password("admin"), "ИТ", "Администратор", 1),
+                    ("gen_dir", "Иванов Иван Иванович", hash_password("123"), "Руководство", "Генеральный директор", 1),
+                    ("finance", "Петров Петр Петрович", hash_password("123"), "Финансы", "Финансовый директор", 1),
+                    ("lawyer", "Сидорова Мария Ивановна", hash_password("123"), "Юридический", "Юрист", 1),
+                    ("sales", "Козлов Алексей Владимирович", hash_password("123"), "Продажи", "Начальник отдела продаж", 1),
+                    ("purchase", "Николаев Дмитрий Сергеевич", hash_password("123"), "Закупки", "Начальник отдела закупок",
+                     1),
+                    ("commercial", "Федорова Ольга Петровна", hash_password("123"), "Коммерция", "Коммерческий директор",
+                     1),
+                    ("security", "Алексеев Сергей Викторович", hash_password("123"), "Безопасность", "Начальник СБ", 1),
+                    ("logistics", "Орлов Михаил Петрович", hash_password("123"), "Логистика", "Начальник отдела логистики",
+                     1)
+                ]
+
+                for user in users_data:
+                    user_id = db.insert(
+                        cur,
+                        "INSERT INTO users (username, full_name, password, department, position, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+                        user
+                    )
+
+                    # Назначение ролей
+                    username = user[0]
+                    role_map = {
+                        "admin": "Администратор",
+                        "gen_dir": "Генеральный директор",
+                        "finance": "Финансовый директор",
+                        "lawyer": "Юрист",
+                        "sales": "Начальник отдела продаж",
+                        "purchase": "Начальник отдела закупок",
+                        "commercial": "Коммерческий директор",
+                        "security": "Служба безопасности",
+                        "logistics": "Отдел логистики"
+                    }
+
+                    if username in role_map:
+                        role_name = role_map[username]
+                        cur.execute("SELECT id FROM roles WHERE name = ?", (role_name,))
+                        role_result = cur.fetchone()
+                        if role_result:
+                            cur.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)",
+                                        (user_id, role_result[0]))
+                bump_data_version(cur, DATA_VERSION_ROLES)
+
+            # Маршруты согласования - обновлены согласно бизнес-процессу
+            if cur.execute("SELECT COUNT(*) FROM approval_flows").fetchone()[0] == 0:
+                flows = [
+                    ("Закупки", "Маршрут для договоров закупок", "Закупки",
+                     '[{"step": 1, "role": "Юрист", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Финансовый директор", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Служба безопасности", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Отдел логистики", "deadline_days": 2}, '
+                     '{"step": 2, "role": "Коммерческий директор", "deadline_days": 2}, '
+                     '{"step": 3, "role": "Генеральный директор", "deadline_days": 3}]'),
+
+                    ("Продажи", "Маршрут для договоров продаж", "Продажи",
+                     '[{"step": 1, "role": "Начальник отдела продаж", "deadline_days": 3}, '
+                     '{"step": 2, "role": "Юрист", "deadline_days": 2}, '
+                     '{"step": 2, "role": "Финансовый директор", "deadline_days": 2}, '
+                     '{"step": 2, "role": "Служба безопасности", "deadline_days": 2}, '
+                     '{"step": 2, "role": "Отдел логистики", "deadline_days": 2}, '
+                     '{"step": 3, "role": "Коммерческий директор", "deadline_days": 2}, '
+                     '{"step": 4, "role": "Генеральный директор", "deadline_days": 3}]'),
+
+                    ("Общий", "Общий маршрут согласования", "Общий",
+                     '[{"step": 1, "role": "Юрист", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Финансовый директор", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Служба безопасности", "deadline_days": 2}, '
+                     '{"step": 1, "role": "Отдел логистики", "deadline_days": 2}, '
+                     '{"step": 2, "role": "Коммерческий директор", "deadline_days": 2}, '
+                     '{"step": 3, "role": "Генеральный директор", "deadline_days": 3}]')
+                ]
+
+                cur.executemany(
+                    "INSERT INTO approval_flows (name, description, department, steps) VALUES (?, ?, ?, ?)",
+                    flows
+                )
+
+            # 50 тестовых договоров
+            if cur.execute("SELECT COUNT(*) FROM contracts").fetchone()[0] == 0:
+                # Создаем словарь для сопоставления названий организаций с их ID
+                org_name_to_id = {}
+                cur.execute("SELECT id, name FROM organizations")
+                for org_id, org_name in cur.fetchall():
+                    org_name_to_id[org_name] = org_id
+
+                # Получаем ID пользователей
+                user_ids = {}
+                cur.execute("SELECT id, username FROM users")
+                for user_id, username in cur.fetchall():
+                    user_ids[username] = user_id
+
+                test_contracts = [
+                    # Договоры закупок (20 шт.)
+                    ("Д-2025-001", "Поставка сырья для производства", org_name_to_id.get("ООО 'Поставщик+'"), 1500000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-002", "Закупка оборудования для цеха", org_name_to_id.get("ООО 'МеталлТрейд'"), 2500000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-003", "Поставка упаковочных материалов", org_name_to_id.get("ООО 'СервисПро'"), 500000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-004", "Закупка спецодежды для сотрудников", org_name_to_id.get("ИП Иванова И.В."), 250000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-005", "Поставка электронных компонентов", org_name_to_id.get("ООО 'ТехноПрофи'"), 1800000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-006", "Закупка продуктов питания", org_name_to_id.get("ЗАО 'Пищепром'"), 1200000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-007", "Поставка логистических услуг", org_name_to_id.get("ООО 'ЛогистикГрупп'"), 800000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-008", "Закупка экологичной продукции", org_name_to_id.get("ООО 'ЭкоПродукт'"), 950000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "custom", None),
+                    ("Д-2025-009", "Поставка автотранспорта", org_name_to_id.get("АО 'ТрансАвто'"), 3500000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-010", "Закупка IT оборудования", org_name_to_id.get("ООО 'ИТСервис'"), 1200000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-011", "Поставка медицинского оборудования", org_name_to_id.get("ООО 'МедТехника'"), 2800000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-012", "Закупка строительных материалов", org_name_to_id.get("ЗАО 'СтройИнвест'"), 3200000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-013", "Поставка сельхозпродукции", org_name_to_id.get("ООО 'АгроПродукт'"), 750000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-014", "Закупка систем безопасности", org_name_to_id.get("ООО 'Безопасность+'"), 1600000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "custom", None),
+                    ("Д-2025-015", "Поставка финансовых услуг", org_name_to_id.get("АО 'ФинансКонсалт'"), 600000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-016", "Закупка канцелярских товаров", org_name_to_id.get("ИП Петров С.М."), 180000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-017", "Поставка химических реактивов", org_name_to_id.get("ООО 'Поставщик+'"), 890000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-018", "Закупка мебели для офиса", org_name_to_id.get("АО 'СтройМатериалы'"), 1450000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+                    ("Д-2025-019", "Поставка промышленного оборудования", org_name_to_id.get("ООО 'ТехноПрофи'"), 4200000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "urgent", None),
+                    ("Д-2025-020", "Закупка программного обеспечения", org_name_to_id.get("ООО 'ИТСервис'"), 950000.0,
+                     user_ids.get("purchase"), "Закупки", "Черновик", "standard", None),
+
+                    # Договоры продаж (20 шт.)
+                    ("Д-2025-021", "Реализация готовой продукции", org_name_to_id.get("ТК 'Ашан'"), 2500000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-022", "Продажа полуфабрикатов оптом", org_name_to_id.get("ООО 'Поставщик+'"), 1800000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
+                    ("Д-2025-023", "Экспорт продукции в ЕС", org_name_to_id.get("ЗАО 'Пищепром'"), 4800000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
+                    ("Д-2025-024", "Реализация замороженных продуктов", org_name_to_id.get("ИП Козлов В.П."), 920000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-025", "Продажа кондитерских изделий", org_name_to_id.get("ТК 'Ашан'"), 1650000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
+                    ("Д-2025-026", "Реализация мясной продукции", org_name_to_id.get("ООО 'ЭкоПродукт'"), 2100000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-027", "Продажа молочной продукции", org_name_to_id.get("ИП Сидорова А.К."), 1350000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-028", "Реализация хлебобулочных изделий", org_name_to_id.get("ООО 'АгроПродукт'"), 980000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
+                    ("Д-2025-029", "Продажа напитков и соков", org_name_to_id.get("ТК 'Ашан'"), 1250000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-030", "Реализация детского питания", org_name_to_id.get("ООО 'Поставщик+'"), 1850000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
+                    ("Д-2025-031", "Продажа диетических продуктов", org_name_to_id.get("ООО 'ЭкоПродукт'"), 760000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-032", "Реализация бакалейных товаров", org_name_to_id.get("ИП Петров С.М."), 540000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-033", "Продажа замороженных полуфабрикатов", org_name_to_id.get("ЗАО 'Пищепром'"), 1980000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
+                    ("Д-2025-034", "Реализация консервированной продукции", org_name_to_id.get("ТК 'Ашан'"), 1120000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-035", "Продажа специй и приправ", org_name_to_id.get("ИП Иванова И.В."), 320000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
+                    ("Д-2025-036", "Реализация кофе и чая", org_name_to_id.get("ООО 'АгроПродукт'"), 870000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-037", "Продажа алкогольной продукции", org_name_to_id.get("ТК 'Ашан'"), 2450000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "urgent", None),
+                    ("Д-2025-038", "Реализация табачных изделий", org_name_to_id.get("ООО 'Поставщик+'"), 1890000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-039", "Продажа кормов для животных", org_name_to_id.get("ООО 'ЭкоПродукт'"), 680000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "standard", None),
+                    ("Д-2025-040", "Реализация бытовой химии", org_name_to_id.get("ИП Козлов В.П."), 450000.0,
+                     user_ids.get("sales"), "Продажи", "Черновик", "custom", None),
+
+                    # Общие договоры (10 шт.)
+                    ("Д-2025-041", "Обслуживание оборудования", org_name_to_id.get("ООО 'СервисПро'"), 500000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "custom", None),
+                    ("Д-2025-042", "Аренда складских помещений", org_name_to_id.get("ЗАО 'СтройИнвест'"), 1200000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
+                    ("Д-2025-043", "Услуги охраны объекта", org_name_to_id.get("ООО 'Безопасность+'"), 680000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
+                    ("Д-2025-044", "IT аутсорсинг", org_name_to_id.get("ООО 'ИТСервис'"), 950000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "urgent", None),
+                    ("Д-2025-045", "Юридическое сопровождение", org_name_to_id.get("АО 'ФинансКонсалт'"), 420000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
+                    ("Д-2025-046", "Транспортные услуги", org_name_to_id.get("АО 'ТрансАвто'"), 780000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "custom", None),
+                    ("Д-2025-047", "Маркетинговые услуги", org_name_to_id.get("ООО 'ТехноПрофи'"), 560000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
+                    ("Д-2025-048", "Консалтинговые услуги", org_name_to_id.get("АО 'ФинансКонсалт'"), 320000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "urgent", None),
+                    ("Д-2025-049", "Ремонт офисных помещений", org_name_to_id.get("АО 'СтройМатериалы'"), 890000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "standard", None),
+                    ("Д-2025-050", "Уборка производственных помещений", org_name_to_id.get("ИП Сидорова А.К."), 280000.0,
+                     user_ids.get("commercial"), "Общий", "Черновик", "custom", None)
+                ]
+
+                # Фильтруем договоры, для которых нашли организации
+                valid_contracts = [contract for contract in test_contracts if contract[2] is not None]
+
+                if valid_contracts:
+                    cur.executemany(
+                        "INSERT INTO contracts (contract_number, title, counterparty, amount, owner_id, department, status, priority, deadline_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        valid_contracts
+                    )
+                    log_message(f"Создано {len(valid_contracts)} тестовых договоров")
+                else:
+                    log_message("Не удалось создать тестовые договоры - организации не найдены")
+
+        log_message("База данных успешно инициализирована с тестовыми данными")
+
+    except DB_ERRORS as e:
+        log_message(f"Ошибка при инициализации БД: {e}")
+        raise
+
+    # Доводим схему существующей базы до актуальной версии
+    migrate_database()
+
+
+# ======================= МИГРАЦИИ СХЕМЫ =======================
+# Нагрузка исполнителей (число ожидающих задач) и позиции очередей round-robin по ролям
+TASK_LOAD_TABLES = '''
+    CREATE TABLE IF NOT EXISTS user_task_load (
+        user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        pending INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS assignment_cursors (
+        role_name TEXT PRIMARY KEY,
+        issued INTEGER NOT NULL DEFAULT 0
+    );
+    -- Счетчики по уже существующим задачам
+    INSERT INTO user_task_load (user_id, pending)
+        SELECT assigned_user_id, COUNT(*) FROM approval_tasks
+        WHERE status = 'pending' AND assigned_user_id IS NOT NULL
+        GROUP BY assigned_user_id;
+'''
+
+# Счетчик меняется при создании и удалении ожидающей задачи, смене ее статуса или исполнителя
+SQLITE_TASK_LOAD_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS tasks_load_insert AFTER INSERT ON approval_tasks
+    WHEN new.status = 'pending' AND new.assigned_user_id IS NOT NULL BEGIN
+        INSERT INTO user_task_load (user_id, pending) VALUES (new.assigned_user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET pending = pending + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_load_delete AFTER DELETE ON approval_tasks
+    WHEN old.status = 'pending' AND old.assigned_user_id IS NOT NULL BEGIN
+        UPDATE user_task_load SET pending = pending - 1 WHERE user_id = old.assigned_user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_load_update AFTER UPDATE OF status, assigned_user_id ON approval_tasks
+    WHEN old.status = 'pending' OR new.status = 'pending' BEGIN
+        UPDATE user_task_load SET pending = pending - 1
+        WHERE old.status = 'pending' AND user_id = old.assigned_user_id;
+        INSERT INTO user_task_load (user_id, pending)
+        SELECT new.assigned_user_id, 1 WHERE new.status = 'pending' AND new.assigned_user_id IS NOT NULL
+        ON CONFLICT (user_id) DO UPDATE SET pending = pending + 1;
+    END;
+'''
+
+# Тело функции содержит «;», поэтому выполняется одним запросом, а не через executescript
+PG_TASK_LOAD_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION track_user_task_load() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'pending' AND OLD.assigned_user_id IS NOT NULL THEN
+            UPDATE user_task_load SET pending = pending - 1 WHERE user_id = OLD.assigned_user_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'pending' AND NEW.assigned_user_id IS NOT NULL THEN
+            INSERT INTO user_task_load (user_id, pending) VALUES (NEW.assigned_user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET pending = user_task_load.pending + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+
+def _migrate_task_load_postgres(cur):
+    db.executescript(cur, TASK_LOAD_TABLES)
+    cur.execute(PG_TASK_LOAD_FUNCTION)
+    cur.execute("DROP TRIGGER IF EXISTS tasks_load ON approval_tasks")
+    cur.execute('''
+        CREATE TRIGGER tasks_load AFTER INSERT OR DELETE OR UPDATE OF status, assigned_user_id ON approval_tasks
+        FOR EACH ROW EXECUTE FUNCTION track_user_task_load()
+    ''')
+
+
+# contracts.approval_version растет при любом изменении экземпляров и задач согласования договора,
+# по ней кэш истории согласования (get_approval_timeline) понимает, что данные устарели
+APPROVAL_VERSION_COLUMN = "ALTER TABLE contracts ADD COLUMN approval_version INTEGER NOT NULL DEFAULT 0"
+
+SQLITE_APPROVAL_VERSION_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS instances_version_insert AFTER INSERT ON approval_instances BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1 WHERE id = new.contract_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS instances_version_update AFTER UPDATE ON approval_instances BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1 WHERE id = new.contract_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS instances_version_delete AFTER DELETE ON approval_instances BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1 WHERE id = old.contract_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_version_insert AFTER INSERT ON approval_tasks BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1
+        WHERE id = (SELECT contract_id FROM approval_instances WHERE id = new.instance_id);
+    END;
+    -- deadline_notified в истории не показывается и меняется массово, поэтому не учитывается
+    CREATE TRIGGER IF NOT EXISTS tasks_version_update
+    AFTER UPDATE OF step_order, role_name, assigned_user_id, status, assigned_at, completed_at, comment, deadline_at
+    ON approval_tasks BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1
+        WHERE id = (SELECT contract_id FROM approval_instances WHERE id = new.instance_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_version_delete AFTER DELETE ON approval_tasks BEGIN
+        UPDATE contracts SET approval_version = approval_version + 1
+        WHERE id = (SELECT contract_id FROM approval_instances WHERE id = old.instance_id);
+    END;
+'''
+
+PG_APPROVAL_VERSION_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION bump_approval_version() RETURNS trigger AS $$
+    DECLARE
+        changed RECORD;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := OLD;
+        ELSE
+            changed := NEW;
+        END IF;
+        IF TG_TABLE_NAME = 'approval_instances' THEN
+            UPDATE contracts SET approval_version = approval_version + 1 WHERE id = changed.contract_id;
+        ELSE
+            UPDATE contracts SET approval_version = approval_version + 1
+            WHERE id = (SELECT contract_id FROM approval_instances WHERE id = changed.instance_id);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+
+def _migrate_approval_version_postgres(cur):
+    cur.execute(APPROVAL_VERSION_COLUMN)
+    cur.execute(PG_APPROVAL_VERSION_FUNCTION)
+    cur.execute("DROP TRIGGER IF EXISTS instances_version ON approval_instances")
+    cur.execute('''
+        CREATE TRIGGER instances_version AFTER INSERT OR UPDATE OR DELETE ON approval_instances
+        FOR EACH ROW EXECUTE FUNCTION bump_approval_version()
+    ''')
+    cur.execute("DROP TRIGGER IF EXISTS tasks_version ON approval_tasks")
+    cur.execute('''
+        CREATE TRIGGER tasks_version AFTER INSERT OR DELETE
+        OR UPDATE OF step_order, role_name, assigned_user_id, status, assigned_at, completed_at, comment, deadline_at
+        ON approval_tasks FOR EACH ROW EXECUTE FUNCTION bump_approval_version()
+    ''')
+
+
+# Любое изменение approval_flows увеличивает версию маршрутов, и реестр (ApprovalFlowRegistry) их перечитывает
+SQLITE_FLOWS_VERSION_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS flows_version_insert AFTER INSERT ON approval_flows BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flows_version_update AFTER UPDATE ON approval_flows BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flows_version_delete AFTER DELETE ON approval_flows BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+'''.format(DATA_VERSION_FLOWS)
+
+PG_FLOWS_VERSION_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION bump_flows_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+'''.format(DATA_VERSION_FLOWS)
+
+
+def _migrate_flows_version(cur):
+    if db.backend == "sqlite":
+        db.executescript(cur, SQLITE_FLOWS_VERSION_TRIGGERS)
+    else:
+        cur.execute(PG_FLOWS_VERSION_FUNCTION)
+        cur.execute("DROP TRIGGER IF EXISTS flows_version ON approval_flows")
+        # На уровне оператора: массовое изменение маршрутов увеличивает версию один раз
+        cur.execute('''
+            CREATE TRIGGER flows_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON approval_flows
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_flows_version()
+        ''')
+    # Маршруты, созданные до триггеров, тоже получают версию
+    bump_data_version(cur, DATA_VERSION_FLOWS)
+
+
+# Этапы маршрутов отдельной таблицей: по ней база сама отвечает, в каких маршрутах участвует роль
+# и какой этап следующий, а задачи этапа создаются одним INSERT ... SELECT
+FLOW_STEPS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS approval_flow_steps (
+        flow_id INTEGER NOT NULL REFERENCES approval_flows(id) ON DELETE CASCADE,
+        step_order INTEGER NOT NULL,
+        role_name TEXT NOT NULL,
+        deadline_days INTEGER NOT NULL DEFAULT 3,
+        PRIMARY KEY (flow_id, step_order, role_name)
+    );
+    CREATE INDEX IF NOT EXISTS idx_flow_steps_role ON approval_flow_steps(role_name, flow_id);
+'''
+
+# Перенос этапов из JSON в approval_flows.steps; повтор роли внутри этапа схлопывается
+SQLITE_FLOW_STEPS_FROM_JSON = '''
+    INSERT INTO approval_flow_steps (flow_id, step_order, role_name, deadline_days)
+        SELECT f.id, json_extract(e.value, '$.step'), json_extract(e.value, '$.role'),
+               COALESCE(json_extract(e.value, '$.deadline_days'), 3)
+        FROM approval_flows f, json_each(f.steps) e
+        WHERE f.steps IS NOT NULL AND f.steps != ''
+        ON CONFLICT DO NOTHING;
+'''
+
+PG_FLOW_STEPS_FROM_JSON = '''
+    INSERT INTO approval_flow_steps (flow_id, step_order, role_name, deadline_days)
+        SELECT f.id, (e ->> 'step')::int, e ->> 'role', COALESCE((e ->> 'deadline_days')::int, 3)
+        FROM approval_flows f CROSS JOIN LATERAL jsonb_array_elements(f.steps::jsonb) e
+        WHERE f.steps IS NOT NULL AND f.steps != ''
+        ON CONFLICT DO NOTHING;
+'''
+
+SQLITE_FLOW_STEPS_VERSION_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS flow_steps_version_insert AFTER INSERT ON approval_flow_steps BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flow_steps_version_update AFTER UPDATE ON approval_flow_steps BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS flow_steps_version_delete AFTER DELETE ON approval_flow_steps BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('{0}', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+'''.format(DATA_VERSION_FLOWS)
+
+
+def _migrate_flow_steps(cur):
+    db.executescript(cur, FLOW_STEPS_TABLE)
+    if db.backend == "sqlite":
+        db.executescript(cur, SQLITE_FLOW_STEPS_FROM_JSON + SQLITE_FLOW_STEPS_VERSION_TRIGGERS)
+    else:
+        db.executescript(cur, PG_FLOW_STEPS_FROM_JSON)
+        cur.execute("DROP TRIGGER IF EXISTS flow_steps_version ON approval_flow_steps")
+        cur.execute('''
+            CREATE TRIGGER flow_steps_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON approval_flow_steps
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_flows_version()
+        ''')
+    bump_data_version(cur, DATA_VERSION_FLOWS)
+
+
+# Версия схемы хранится в PRAGMA user_version (SQLite) или таблице schema_version (PostgreSQL).
+# Миграция — (версия, описание, шаг), где шаг — SQL-скрипт, словарь {движок: скрипт}
+# или функция, принимающая курсор. Новые миграции только дописываются в конец.
+MIGRATIONS = [
+    (1, "Индексы для горячих запросов", '''
+        -- Задачи пользователя (load_tasks) и общий список ожидающих задач
+        CREATE INDEX IF NOT EXISTS idx_tasks_assignee_status_deadline
+            ON approval_tasks(assigned_user_id, status, deadline_at);
+        -- Поиск просроченных задач (notify_overdue_tasks)
+        CREATE INDEX IF NOT EXISTS idx_tasks_status_notified_deadline
+            ON approval_tasks(status, deadline_notified, deadline_at);
+        -- Задачи экземпляра согласования и проверка завершения этапа
+        CREATE INDEX IF NOT EXISTS idx_tasks_instance_step
+            ON approval_tasks(instance_id, step_order, status);
+        CREATE INDEX IF NOT EXISTS idx_instances_contract
+            ON approval_instances(contract_id, status);
+        -- Фильтр договоров для пользователей без прав директора (OR по трем условиям)
+        CREATE INDEX IF NOT EXISTS idx_contracts_owner ON contracts(owner_id);
+        CREATE INDEX IF NOT EXISTS idx_contracts_department ON contracts(department);
+        CREATE INDEX IF NOT EXISTS idx_contracts_status ON contracts(status);
+        CREATE INDEX IF NOT EXISTS idx_contracts_created ON contracts(created_at);
+        CREATE INDEX IF NOT EXISTS idx_contracts_counterparty ON contracts(counterparty);
+        CREATE INDEX IF NOT EXISTS idx_user_roles_role ON user_roles(role_id, user_id);
+        CREATE INDEX IF NOT EXISTS idx_flows_department ON approval_flows(department);
+    '''),
+    (2, "Полнотекстовый поиск", {
+        # Внешние FTS5-таблицы хранят только индекс, текст берется из основных таблиц;
+        # триггеры поддерживают индекс в актуальном состоянии. unicode61 не приравнивает «ё» к «е»,
+        # поэтому в индекс попадает текст с заменой «ё» (длина в байтах та же, фрагменты snippet() не сдвигаются)
+        "sqlite": '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS contracts_fts USING fts5(
+                contract_number, title, department,
+                content='contracts', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS organizations_fts USING fts5(
+                name, inn, kpp, ogrn, legal_address, phone, email,
+                content='organizations', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS task_comments_fts USING fts5(
+                comment,
+                content='approval_tasks', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS audit_log_fts USING fts5(
+                action, details,
+                content='audit_log', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+
+            CREATE TRIGGER IF NOT EXISTS contracts_fts_insert AFTER INSERT ON contracts BEGIN
+                INSERT INTO contracts_fts(rowid, contract_number, title, department)
+                VALUES (new.id, new.contract_number, replace(replace(new.title, 'ё', 'е'), 'Ё', 'Е'), replace(replace(new.department, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS contracts_fts_delete AFTER DELETE ON contracts BEGIN
+                INSERT INTO contracts_fts(contracts_fts, rowid, contract_number, title, department)
+                VALUES ('delete', old.id, old.contract_number, replace(replace(old.title, 'ё', 'е'), 'Ё', 'Е'), replace(replace(old.department, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS contracts_fts_update AFTER UPDATE OF contract_number, title, department ON contracts BEGIN
+                INSERT INTO contracts_fts(contracts_fts, rowid, contract_number, title, department)
+                VALUES ('delete', old.id, old.contract_number, replace(replace(old.title, 'ё', 'е'), 'Ё', 'Е'), replace(replace(old.department, 'ё', 'е'), 'Ё', 'Е'));
+                INSERT INTO contracts_fts(rowid, contract_number, title, department)
+                VALUES (new.id, new.contract_number, replace(replace(new.title, 'ё', 'е'), 'Ё', 'Е'), replace(replace(new.department, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS organizations_fts_insert AFTER INSERT ON organizations BEGIN
+                INSERT INTO organizations_fts(rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                VALUES (new.id, replace(replace(new.name, 'ё', 'е'), 'Ё', 'Е'), new.inn, new.kpp, new.ogrn, replace(replace(new.legal_address, 'ё', 'е'), 'Ё', 'Е'), new.phone, new.email);
+            END;
+            CREATE TRIGGER IF NOT EXISTS organizations_fts_delete AFTER DELETE ON organizations BEGIN
+                INSERT INTO organizations_fts(organizations_fts, rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                VALUES ('delete', old.id, replace(replace(old.name, 'ё', 'е'), 'Ё', 'Е'), old.inn, old.kpp, old.ogrn, replace(replace(old.legal_address, 'ё', 'е'), 'Ё', 'Е'), old.phone, old.email);
+            END;
+            CREATE TRIGGER IF NOT EXISTS organizations_fts_update AFTER UPDATE OF name, inn, kpp, ogrn, legal_address, phone, email ON organizations BEGIN
+                INSERT INTO organizations_fts(organizations_fts, rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                VALUES ('delete', old.id, replace(replace(old.name, 'ё', 'е'), 'Ё', 'Е'), old.inn, old.kpp, old.ogrn, replace(replace(old.legal_address, 'ё', 'е'), 'Ё', 'Е'), old.phone, old.email);
+                INSERT INTO organizations_fts(rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                VALUES (new.id, replace(replace(new.name, 'ё', 'е'), 'Ё', 'Е'), new.inn, new.kpp, new.ogrn, replace(replace(new.legal_address, 'ё', 'е'), 'Ё', 'Е'), new.phone, new.email);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS task_comments_fts_insert AFTER INSERT ON approval_tasks BEGIN
+                INSERT INTO task_comments_fts(rowid, comment)
+                VALUES (new.id, replace(replace(new.comment, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS task_comments_fts_delete AFTER DELETE ON approval_tasks BEGIN
+                INSERT INTO task_comments_fts(task_comments_fts, rowid, comment)
+                VALUES ('delete', old.id, replace(replace(old.comment, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS task_comments_fts_update AFTER UPDATE OF comment ON approval_tasks BEGIN
+                INSERT INTO task_comments_fts(task_comments_fts, rowid, comment)
+                VALUES ('delete', old.id, replace(replace(old.comment, 'ё', 'е'), 'Ё', 'Е'));
+                INSERT INTO task_comments_fts(rowid, comment)
+                VALUES (new.id, replace(replace(new.comment, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS audit_log_fts_insert AFTER INSERT ON audit_log BEGIN
+                INSERT INTO audit_log_fts(rowid, action, details)
+                VALUES (new.id, replace(replace(new.action, 'ё', 'е'), 'Ё', 'Е'), replace(replace(new.details, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_log_fts_delete AFTER DELETE ON audit_log BEGIN
+                INSERT INTO audit_log_fts(audit_log_fts, rowid, action, details)
+                VALUES ('delete', old.id, replace(replace(old.action, 'ё', 'е'), 'Ё', 'Е'), replace(replace(old.details, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_log_fts_update AFTER UPDATE OF action, details ON audit_log BEGIN
+                INSERT INTO audit_log_fts(audit_log_fts, rowid, action, details)
+                VALUES ('delete', old.id, replace(replace(old.action, 'ё', 'е'), 'Ё', 'Е'), replace(replace(old.details, 'ё', 'е'), 'Ё', 'Е'));
+                INSERT INTO audit_log_fts(rowid, action, details)
+                VALUES (new.id, replace(replace(new.action, 'ё', 'е'), 'Ё', 'Е'), replace(replace(new.details, 'ё', 'е'), 'Ё', 'Е'));
+            END;
+
+            -- Индексируем уже существующие данные
+            INSERT INTO contracts_fts(rowid, contract_number, title, department)
+                SELECT id, contract_number, replace(replace(title, 'ё', 'е'), 'Ё', 'Е'), replace(replace(department, 'ё', 'е'), 'Ё', 'Е') FROM contracts;
+            INSERT INTO organizations_fts(rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                SELECT id, replace(replace(name, 'ё', 'е'), 'Ё', 'Е'), inn, kpp, ogrn, replace(replace(legal_address, 'ё', 'е'), 'Ё', 'Е'), phone, email FROM organizations;
+            INSERT INTO task_comments_fts(rowid, comment)
+                SELECT id, replace(replace(comment, 'ё', 'е'), 'Ё', 'Е') FROM approval_tasks;
+            INSERT INTO audit_log_fts(rowid, action, details)
+                SELECT id, replace(replace(action, 'ё', 'е'), 'Ё', 'Е'), replace(replace(details, 'ё', 'е'), 'Ё', 'Е') FROM audit_log;
+        ''',
+        # В PostgreSQL — GIN-индексы по tsvector с русской конфигурацией (со стеммингом);
+        # выражения совпадают с PG_SEARCH_DOCUMENTS, иначе планировщик не возьмет индекс
+        "postgres": '''
+            CREATE INDEX IF NOT EXISTS idx_contracts_search ON contracts USING GIN (to_tsvector('russian', translate(
+                coalesce(contract_number, '') || ' ' || coalesce(title, '') || ' ' || coalesce(department, ''),
+                'ёЁ', 'еЕ')));
+            CREATE INDEX IF NOT EXISTS idx_organizations_search ON organizations USING GIN (to_tsvector('russian', translate(
+                coalesce(name, '') || ' ' || coalesce(inn, '') || ' ' || coalesce(kpp, '') || ' ' ||
+                coalesce(ogrn, '') || ' ' || coalesce(legal_address, '') || ' ' || coalesce(phone, '') || ' ' ||
+                coalesce(email, ''), 'ёЁ', 'еЕ')));
+            CREATE INDEX IF NOT EXISTS idx_tasks_comment_search ON approval_tasks USING GIN (to_tsvector('russian', translate(
+                coalesce(comment, ''), 'ёЁ', 'еЕ')));
+            CREATE INDEX IF NOT EXISTS idx_audit_log_search ON audit_log USING GIN (to_tsvector('russian', translate(
+                coalesce(action, '') || ' ' || coalesce(details, ''), 'ёЁ', 'еЕ')));
+        ''',
+    }),
+    (3, "Нагрузка исполнителей и очереди назначения", {
+        "sqlite": TASK_LOAD_TABLES + SQLITE_TASK_LOAD_TRIGGERS,
+        "postgres": _migrate_task_load_postgres,
+    }),
+    (4, "Версия истории согласования договора", {
+        "sqlite": APPROVAL_VERSION_COLUMN + ";" + SQLITE_APPROVAL_VERSION_TRIGGERS,
+        "postgres": _migrate_approval_version_postgres,
+    }),
+    (5, "Версия маршрутов согласования", _migrate_flows_version),
+    (6, "Этапы маршрутов согласования в отдельной таблице", _migrate_flow_steps),
+]
+
+
+def migrate_database():
+    """Применить недостающие миграции схемы без пересоздания базы"""
+    # Одна транзакция на все шаги: параллельно запущенные клиенты дождутся ее окончания
+    with db.transaction() as cur:
+        db.lock_schema(cur)
+        version = db.schema_version(cur)
+        for target, description, step in MIGRATIONS:
+            if target <= version:
+                continue
+            if isinstance(step, dict):
+                step = step[db.backend]
+            if callable(step):
+                step(cur)
+            else:
+                db.executescript(cur, step)
+            db.set_schema_version(cur, target)
+            version = target
+            log_message(f"Применена миграция схемы {target}: {description}")
+    return version
+
+
+# ======================= ГЕНЕРАЦИЯ ТЕСТОВЫХ ДАННЫХ =======================
+# Словари для правдоподобных названий
+DATASET_ACTIONS = {
+    "Закупки": ("Поставка", "Закупка"),
+    "Продажи": ("Реализация", "Продажа", "Поставка"),
+    "Общий": ("Аренда", "Обслуживание", "Ремонт", "Страхование"),
+}
+DATASET_SUBJECTS = (
+    "сырья для производства", "оборудования для цеха", "упаковочных материалов", "спецодежды",
+    "мясной продукции", "молочной продукции", "замороженных полуфабрикатов", "кондитерских изделий",
+    "хлебобулочных изделий", "IT оборудования", "программного обеспечения", "строительных материалов",
+    "офисной мебели", "канцелярских товаров", "химических реактивов", "автотранспорта", "складских помещений",
+    "холодильного оборудования", "систем безопасности", "медицинского оборудования", "детского питания",
+)
+DATASET_ORG_ROOTS = ("Поставщик", "Металл", "Строй", "Техно", "Агро", "Эко", "Транс", "Мед", "Пищепром",
+                     "Логистик", "Финанс", "Инвест", "Сервис", "Торг", "Хлеб", "Молоко", "Фуд", "Снаб")
+DATASET_ORG_SUFFIXES = ("Трейд", "Групп", "Пром", "Маркет", "Профи", "Холдинг", "Систем", "Опт", "Плюс")
+DATASET_SURNAMES = ("Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов",
+                    "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров")
+DATASET_NAMES = (("Иван", "Иванович"), ("Пётр", "Петрович"), ("Сергей", "Сергеевич"), ("Алексей", "Алексеевич"),
+                 ("Дмитрий", "Дмитриевич"), ("Андрей", "Андреевич"), ("Михаил", "Михайлович"),
+                 ("Николай", "Николаевич"))
+DATASET_STREETS = ("ул. Тверская", "Ленинский проспект", "ул. Профсоюзная", "Варшавское шоссе", "ул. Бутырская",
+                   "Каширское шоссе", "ул. Летниковская", "Волгоградский проспект", "ул. Правды")
+DATASET_REGIONS = ("77", "50", "78", "33", "47", "52", "66", "16")
+# Отделы исполнителей ролей согласования — как у пользователей начальных данных
+DATASET_ROLE_DEPARTMENTS = {
+    "Генеральный директор": "Руководство", "Финансовый директор": "Финансы", "Юрист": "Юридический",
+    "Начальник отдела закупок": "Закупки", "Начальник отдела продаж": "Продажи",
+    "Коммерческий директор": "Коммерция", "Служба безопасности": "Безопасность", "Отдел логистики": "Логистика",
+}
+# Доли отделов, статусов и приоритетов договоров
+DATASET_DEPARTMENTS = (("Закупки", 45), ("Продажи", 35), ("Общий", 20))
+DATASET_STATUSES = (("Черновик", 25), ("На согласовании", 20), ("Согласован", 45), ("Отклонён", 10))
+DATASET_PRIORITIES = (("standard", 70), ("urgent", 20), ("custom", 10))
+
+
+def _weighted_picker(rng: random.Random, weighted):
+    """Функция выбора значения из ((значение, вес), ...) — быстрее rng.choices на миллионах вызовов"""
+    values = [value for value, _ in weighted]
+    bounds = list(itertools.accumulate(weight for _, weight in weighted))
+    total = bounds[-1]
+    return lambda: values[bisect.bisect(bounds, rng.random() * total)]
+
+
+def _checksum_digit(digits, coefficients) -> int:
+    return sum(digit * coefficient for digit, coefficient in zip(digits, coefficients)) % 11 % 10
+
+
+def _generate_requisites(rng: random.Random, org_type: str):
+    """Случайные ИНН, КПП и ОГРН (ОГРНИП), проходящие validate_inn, validate_kpp и validate_ogrn"""
+    region = rng.choice(DATASET_REGIONS)
+    year = f"{rng.randint(2, 24):02d}"
+    if org_type == "legal":
+        digits = [int(c) for c in region] + [rng.randrange(10) for _ in range(7)]
+        digits.append(_checksum_digit(digits, (2, 4, 10, 3, 5, 9, 4, 6, 8)))
+        inn = "".join(map(str, digits))
+        ogrn = f"1{year}{region}{rng.randrange(10 ** 7):07d}"
+        return inn, f"{inn[:4]}01001", ogrn + str(int(ogrn) % 11 % 10)
+    digits = [int(c) for c in region] + [rng.randrange(10) for _ in range(8)]
+    digits.append(_checksum_digit(digits, (7, 2, 4, 10, 3, 5, 9, 4, 6, 8)))
+    digits.append(_checksum_digit(digits, (3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8)))
+    ogrn = f"3{year}{region}{rng.randrange(10 ** 9):09d}"
+    return "".join(map(str, digits)), "", ogrn + str(int(ogrn) % 13 % 10)
+
+
+DATASET_TABLES = ("organizations", "users", "contracts", "approval_instances", "approval_tasks", "audit_log")
+DATASET_COLUMNS = {
+    "organizations": ("id", "name", "organization_type", "inn", "kpp", "ogrn", "legal_address", "phone", "email"),
+    "users": ("id", "username", "full_name", "password", "department", "position", "is_active"),
+    "contracts": ("id", "contract_number", "title", "counterparty", "amount", "status", "owner_id", "department",
+                  "priority", "deadline_at", "created_at", "updated_at", "approval_version"),
+    "approval_instances": ("id", "contract_id", "flow_id", "status", "started_at", "finished_at"),
+    "approval_tasks": ("id", "instance_id", "step_order", "role_name", "assigned_user_id", "status", "assigned_at",
+                       "completed_at", "comment", "deadline_at", "deadline_notified"),
+    "audit_log": ("id", "user_id", "action", "details", "created_at"),
+}
+
+
+def generate_dataset(contracts: int, seed: int = 1, anchor: Optional[datetime] = None, progress=None) -> dict:
+    """Добавить в базу синтетические данные на contracts договоров (для нагрузочных проверок).
+
+    При одинаковых contracts, seed и anchor (момент «сейчас», от которого отсчитываются даты)
+    получаются одни и те же данные. У организаций корректные ИНН, КПП и ОГРН; договоры распределены
+    по отделам, статусам и приоритетам; у отправленных есть экземпляр и задачи согласования по маршруту
+    отдела: пройденные этапы, отклонения с отменой остальных задач этапа, идущие этапы со сроками
+    и в прошлом, и в будущем. Все пишется одной транзакцией пакетами по DATASET_BATCH строк
+    с отключенными триггерами; полнотекстовый индекс и нагрузка исполнителей пересчитываются в конце.
+    progress(сделано, всего) вызывается после каждого пакета. Возвращает число строк по таблицам.
+    """
+    rng = random.Random(seed)
+    anchor = (anchor or datetime.now()).replace(microsecond=0)
+    started_at = time.perf_counter()
+    counts = dict.fromkeys(DATASET_TABLES + ("user_roles",), 0)
+    pick_department = _weighted_picker(rng, DATASET_DEPARTMENTS)
+    pick_status = _weighted_picker(rng, DATASET_STATUSES)
+    pick_priority = _weighted_picker(rng, DATASET_PRIORITIES)
+
+    with db.transaction() as cur:
+        with db.bulk_load(cur, DATASET_TABLES) as write:
+            next_id = {table: cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+                       for table in DATASET_TABLES}
+            first_id = dict(next_id)
+            rows = {table: [] for table in DATASET_TABLES}
+
+            def add(table, *values):
+                rows[table].append((next_id[table], *values))
+                next_id[table] += 1
+                return next_id[table] - 1
+
+            def flush():
+                # В порядке ссылок: договоры раньше экземпляров, экземпляры раньше задач
+                for table in DATASET_TABLES:
+                    if rows[table]:
+                        write(table, DATASET_COLUMNS[table], rows[table])
+                        counts[table] += len(rows[table])
+                        rows[table].clear()
+
+            org_ids = []
+            for _ in range(max(50, contracts // 20)):
+                org_type = "individual" if rng.random() < 0.15 else "legal"
+                inn, kpp, ogrn = _generate_requisites(rng, org_type)
+                if org_type == "legal":
+                    name = (f"{rng.choice(('ООО', 'ООО', 'АО', 'ЗАО'))} "
+                            f"'{rng.choice(DATASET_ORG_ROOTS)}{rng.choice(DATASET_ORG_SUFFIXES)}'")
+                else:
+                    first_name, patronymic = rng.choice(DATASET_NAMES)
+                    name = f"ИП {rng.choice(DATASET_SURNAMES)} {first_name[0]}.{patronymic[0]}."
+                org_ids.append(add(
+                    "organizations", name, org_type, inn, kpp, ogrn,
+                    f"{rng.randint(101000, 129999)}, г.Москва, {rng.choice(DATASET_STREETS)}, д.{rng.randint(1, 120)}",
+                    f"+7 (495) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}",
+                    f"office{next_id['organizations']}@example.ru"))
+
+            # Исполнители ролей согласования и авторы договоров; у всех пароль 123
+            password = hash_password("123")
+
+            def add_user(department, position):
+                first_name, patronymic = rng.choice(DATASET_NAMES)
+                return add("users", f"gen_{next_id['users']}",
+                           f"{rng.choice(DATASET_SURNAMES)} {first_name} {patronymic}", password, department, position, 1)
+
+            role_ids = dict(cur.execute("SELECT name, id FROM roles").fetchall())
+            members, user_roles = {}, []
+            for role_name, department in DATASET_ROLE_DEPARTMENTS.items():
+                for _ in range(max(2, contracts // 25000) if role_name in role_ids else 0):
+                    user_id = add_user(department, role_name)
+                    members.setdefault(role_name, []).append(user_id)
+                    user_roles.append((user_id, role_ids[role_name]))
+            owners = {department: [add_user(department, "Менеджер") for _ in range(max(3, contracts // 2000))]
+                      for department, _ in DATASET_DEPARTMENTS}
+            flush()
+            cur.executemany("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", user_roles)
+            counts["user_roles"] = len(user_roles)
+            bump_data_version(cur, DATA_VERSION_ROLES)
+            # Задачи достаются и исполнителям, которые уже были в базе
+            for role_name, user_id in cur.execute('''
+                SELECT r.name, u.id FROM user_roles ur
+                JOIN roles r ON ur.role_id = r.id
+                JOIN users u ON ur.user_id = u.id
+                WHERE u.is_active = 1 AND u.id < ?
+                ORDER BY u.id
+            ''', (first_id["users"],)).fetchall():
+                members.setdefault(role_name, []).append(user_id)
+            flows = {department: flow_registry.for_department(cur, department)
+                     for department, _ in DATASET_DEPARTMENTS}
+            # Роли этапа в одном порядке на любой СУБД, чтобы данные зависели только от зерна
+            stages = {flow.id: {order: sorted(flow.stages[order]) for order in flow.orders}
+                      for flow in flows.values() if flow is not None}
+
+            number_offset = cur.execute("SELECT COUNT(*) FROM contracts WHERE contract_number LIKE ?",
+                                        ("ГЕН-%",)).fetchone()[0]
+            for index in range(contracts):
+                department, status, priority = pick_department(), pick_status(), pick_priority()
+                number = f"ГЕН-{number_offset + index + 1:07d}"
+                owner = rng.choice(owners[department])
+                flow = flows[department]
+                if flow is None or not flow.orders:
+                    status = "Черновик"
+                if status == "На согласовании":
+                    # Идущие согласования начаты недавно: сроки текущих задач и истекли, и впереди
+                    created = anchor - timedelta(seconds=rng.randrange(86400, 10 * 86400))
+                else:
+                    created = anchor - timedelta(seconds=rng.randrange(3600, 730 * 86400))
+                deadline = created + timedelta(days=rng.randint(7, 60)) if priority == "custom" else None
+                contract_id, updated = next_id["contracts"], created
+
+                if status != "Черновик":
+                    instance_id = next_id["approval_instances"]
+                    moment = started = created + timedelta(seconds=rng.randrange(600, 2 * 86400))
+                    add("audit_log", owner, "send_for_approval", f"Договор {number} отправлен на согласование",
+                        started.isoformat(" "))
+                    current = len(flow.orders) - 1 if status == "Согласован" else rng.randrange(len(flow.orders))
+                    for position, order in enumerate(flow.orders[:current + 1]):
+                        stage, stage_started = stages[flow.id][order], moment
+                        waiting = rejected = ()
+                        if position == current and status == "На согласовании":
+                            # Часть задач текущего этапа уже закрыта, хотя бы одна ждет
+                            waiting = rng.sample(range(len(stage)), rng.randint(1, len(stage)))
+                        elif position == current and status == "Отклонён":
+                            rejected = (rng.randrange(len(stage)),)
+                            rejected_at = stage_started + timedelta(seconds=rng.randrange(1800, 3 * 86400))
+                        for task_index, (role_name, deadline_days) in enumerate(stage):
+                            assignee = rng.choice(members[role_name]) if role_name in members else None
+                            if position:
+                                task_deadline = stage_started + timedelta(days=deadline_days)
+                            else:  # как _initial_deadline
+                                task_deadline = deadline or stage_started + timedelta(days=1 if priority == "urgent" else 3)
+                            notified = 0
+                            if task_index in waiting:
+                                task_status, completed, comment = "pending", None, None
+                                notified = int(task_deadline < anchor and rng.random() < 0.5)
+                            elif task_index in rejected:
+                                task_status, completed, comment = "rejected", rejected_at, "Отклонено"
+                            elif rejected:
+                                task_status, completed = "cancelled", rejected_at
+                                comment = f" | Отменено из-за отклонения отделом {stage[rejected[0]][0]}"
+                            else:
+                                task_status, comment = "approved", "Согласовано"
+                                completed = stage_started + timedelta(
+                                    seconds=rng.randrange(1800, int(deadline_days * 1.3 * 86400) + 3600))
+                            task_id = add("approval_tasks", instance_id, order, role_name, assignee, task_status,
+                                          stage_started.isoformat(" "), completed and completed.isoformat(" "),
+                                          comment, task_deadline.isoformat(" "), notified)
+                            if task_status in ("approved", "rejected"):
+                                add("audit_log", assignee, "approve_task" if task_status == "approved" else "reject_task",
+                                    f"Задача {task_id} для договора {number}", completed.isoformat(" "))
+                            if completed is not None:
+                                moment = max(moment, completed)
+                    finished = status != "На согласовании"
+                    add("approval_instances", contract_id, flow.id, "finished" if finished else "running",
+                        started.isoformat(" "), moment.isoformat(" ") if finished else None)
+                    updated = moment
+
+                add("contracts", number, f"{rng.choice(DATASET_ACTIONS[department])} {rng.choice(DATASET_SUBJECTS)}",
+                    rng.choice(org_ids), round(rng.lognormvariate(13.5, 1.1), -3), status, owner, department,
+                    priority, deadline and deadline.isoformat(" "), created.isoformat(" "), updated.isoformat(" "),
+                    int(status != "Черновик"))
+
+                if len(rows["approval_tasks"]) >= DATASET_BATCH or len(rows["contracts"]) >= DATASET_BATCH:
+                    flush()
+                    if progress:
+                        progress(index + 1, contracts)
+            flush()
+            if progress:
+                progress(contracts, contracts)
+
+            # Производные данные, которые в обычной работе поддерживают триггеры
+            if db.backend == "sqlite":
+                def fts_text(column):
+                    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+                cur.execute(f'''
+                    INSERT INTO contracts_fts(rowid, contract_number, title, department)
+                    SELECT id, contract_number, {fts_text("title")}, {fts_text("department")}
+                    FROM contracts WHERE id >= ?
+                ''', (first_id["contracts"],))
+                cur.execute(f'''
+                    INSERT INTO organizations_fts(rowid, name, inn, kpp, ogrn, legal_address, phone, email)
+                    SELECT id, {fts_text("name")}, inn, kpp, ogrn, {fts_text("legal_address")}, phone, email
+                    FROM organizations WHERE id >= ?
+                ''', (first_id["organizations"],))
+                cur.execute(f'''
+                    INSERT INTO task_comments_fts(rowid, comment)
+                    SELECT id, {fts_text("comment")} FROM approval_tasks WHERE id >= ?
+                ''', (first_id["approval_tasks"],))
+                cur.execute(f'''
+                    INSERT INTO audit_log_fts(rowid, action, details)
+                    SELECT id, {fts_text("action")}, {fts_text("details")} FROM audit_log WHERE id >= ?
+                ''', (first_id["audit_log"],))
+            cur.execute("DELETE FROM user_task_load")
+            cur.execute('''
+                INSERT INTO user_task_load (user_id, pending)
+                SELECT assigned_user_id, COUNT(*) FROM approval_tasks
+                WHERE status = 'pending' AND assigned_user_id IS NOT NULL
+                GROUP BY assigned_user_id
+            ''')
+
+    # Статистика для планировщика запросов после загрузки большого объема
+    with db.transaction() as cur:
+        cur.execute("ANALYZE")
+
+    log_message(f"Сгенерированы тестовые данные: договоров {counts['contracts']}, "
+                f"задач согласования {counts['approval_tasks']} за {time.perf_counter() - started_at:.1f} с")
+    return counts
+
+
+# ======================= АВТОРИЗАЦИЯ =======================
+def get_active_users_with_roles():
+    """Получить список активных пользователей с ролями"""
+    try:
+        return db.fetchall(f'''
+            SELECT u.id, u.full_name, u.username, u.is_active, u.department,
+                   {db.group_concat("r.name")} as roles
+            FROM users u
+            LEFT JOIN user_roles ur ON u.id = ur.user_id
+            LEFT JOIN roles r ON ur.role_id = r.id
+            WHERE u.is_active = 1
+            GROUP BY u.id
+            ORDER BY u.full_name
+        ''')
+    except DB_ERRORS as e:
+        log_message(f"Ошибка получения пользователей: {e}")
+        return []
+
+
+def get_user_roles(user_id):
+    """Получить роли пользователя"""
+    try:
+        rows = db.fetchall("SELECT r.name FROM roles r JOIN user_roles ur ON r.id = ur.role_id WHERE ur.user_id = ?",
+                           (user_id,))
+        return [row[0] for row in rows]
+    except DB_ERRORS as e:
+        log_message(f"Ошибка получения ролей: {e}")
         return []
 
 
@@ -1181,20 +3271,2072 @@ def get_user_roles(user_id):
 def get_all_organizations():
     """Получить все организации для выпадающего списка"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute('''
+        return db.fetchall('''
             SELECT id, name, inn FROM organizations 
             ORDER BY name
         ''')
-        organizations = cur.fetchall()
-        conn.close()
-        return organizations
-    except sqlite3.Error as e:
+    except DB_ERRORS as e:
         log_message(f"Ошибка получения организаций: {e}")
         return []
 
 
+# ======================= СЕРВИСНЫЙ СЛОЙ =======================
+# Операции над договорами без привязки к окнам: их вызывают и FastlandApp, и HTTP API (api.py)
+class WorkflowError(Exception):
+    """Операция отклонена бизнес-правилом; текст показывается пользователю"""
+
+
+class NotFoundError(WorkflowError):
+    """Объект не найден"""
+
+
+class AccessDeniedError(WorkflowError):
+    """Недостаточно прав для операции"""
+
+
+ADMIN_ROLE = "Администратор"
+DIRECTOR_ROLES = ("Генеральный директор", "Коммерческий директор")
+
+# Колонки реестра договоров в порядке, который ожидают таблица и фильтр
+CONTRACT_COLUMNS = '''c.id, c.contract_number, c.title, o.name as counterparty_name, c.amount, c.status,
+                      c.department, c.file_path, c.priority, c.deadline_at'''
+
+TASK_COLUMNS = '''t.id, c.contract_number, c.title, t.step_order, t.role_name,
+                  t.status, t.deadline_at, c.file_path'''
+
+ORGANIZATION_COLUMNS = "id, name, organization_type, inn, kpp, ogrn, legal_address, phone, email"
+
+
+def is_admin_role(roles) -> bool:
+    return ADMIN_ROLE in roles
+
+
+def is_director_role(roles) -> bool:
+    return any(role in DIRECTOR_ROLES for role in roles)
+
+
+def authenticate_user(username: str, password: str):
+    """Проверить логин и пароль: (user_id, full_name, roles, department) или None"""
+    user = db.fetchone(
+        "SELECT id, full_name, password, department FROM users WHERE username = ? AND is_active = 1",
+        (username,)
+    )
+    if not user or hash_password(password) != user[2]:
+        return None
+    user_id, full_name, _, department = user
+    return user_id, full_name, get_user_roles(user_id), department
+
+
+def _like_pattern(text: str) -> str:
+    """Шаблон LIKE для поиска подстроки (символы % и _ из запроса экранируются)"""
+    escaped = text.casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _contracts_visibility(user_id, department, see_all: bool):
+    """Условие видимости договоров: директора видят все, остальные — свои, своего отдела и на согласовании"""
+    if see_all:
+        return [], []
+    return ["(c.owner_id = ? OR c.department = ? OR c.status = 'На согласовании')"], [user_id, department]
+
+
+def _contracts_query(user_id, department, see_all: bool, status: str = None, contract_department: str = None,
+                     search: str = None, after=None, limit: int = None, with_created_at: bool = False):
+    """(SQL, параметры) выборки договоров для fetch_contracts"""
+    where, params = _contracts_visibility(user_id, department, see_all)
+    if status:
+        where.append("c.status = ?")
+        params.append(status)
+    if contract_department:
+        where.append("c.department = ?")
+        params.append(contract_department)
+    if search:
+        columns = ("c.contract_number", "c.title", "o.name", "c.department")
+        where.append("(" + " OR ".join(f"{db.casefold(column)} LIKE ? ESCAPE '\\'" for column in columns) + ")")
+        params += [_like_pattern(search)] * len(columns)
+    if after:
+        where.append("(c.created_at < ? OR (c.created_at = ? AND c.id < ?))")
+        params += [after[0], after[0], after[1]]
+
+    sql = f'''
+        SELECT {CONTRACT_COLUMNS}{", c.created_at" if with_created_at else ""}
+        FROM contracts c
+        LEFT JOIN organizations o ON c.counterparty = o.id
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY c.created_at DESC, c.id DESC
+    '''
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return sql, params
+
+
+def fetch_contracts(user_id, department, see_all: bool, status: str = None, contract_department: str = None,
+                    search: str = None, after=None, limit: int = None, with_created_at: bool = False) -> list:
+    """Договоры, видимые пользователю, от новых к старым.
+
+    after — (created_at, id) последней полученной строки: выборка продолжается после нее (keyset-пагинация).
+    """
+    sql, params = _contracts_query(user_id, department, see_all, status, contract_department, search,
+                                   after, limit, with_created_at)
+    # Реестр может быть большим: читаем порциями (в PostgreSQL — серверным курсором)
+    return list(db.stream(sql, params))
+
+
+def contract_visible_to(contract_id, user_id, department, see_all: bool) -> bool:
+    where, params = _contracts_visibility(user_id, department, see_all)
+    where.append("c.id = ?")
+    return db.fetchone(f"SELECT 1 FROM contracts c WHERE {' AND '.join(where)}", params + [contract_id]) is not None
+
+
+def _tasks_query(user_id, all_users: bool, after=None, limit: int = None):
+    """(SQL, параметры) выборки задач для fetch_tasks"""
+    where = ["t.status = 'pending'", "c.status != 'Согласован'"]
+    params = []
+    if not all_users:
+        where.insert(0, "t.assigned_user_id = ?")
+        params.append(user_id)
+    # Задачи без дедлайна идут в конце (NULLS LAST на обоих движках); сравнение с NULL
+    # всегда ложно, поэтому для них в условии курсора отдельная ветка
+    if after and after[0] is None:
+        where.append("(t.deadline_at IS NULL AND t.id > ?)")
+        params.append(after[1])
+    elif after:
+        where.append("(t.deadline_at > ? OR (t.deadline_at = ? AND t.id > ?) OR t.deadline_at IS NULL)")
+        params += [after[0], after[0], after[1]]
+
+    sql = f'''
+        SELECT {TASK_COLUMNS}
+        FROM approval_tasks t
+        JOIN approval_instances i ON t.instance_id = i.id
+        JOIN contracts c ON i.contract_id = c.id
+        WHERE {" AND ".join(where)}
+        ORDER BY t.deadline_at NULLS LAST, t.id
+    '''
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return sql, params
+
+
+def fetch_tasks(user_id, all_users: bool, after=None, limit: int = None) -> list:
+    """Ожидающие задачи согласования (администратор видит задачи всех), по возрастанию дедлайна.
+
+    after — (deadline_at, id) последней полученной строки.
+    """
+    return db.fetchall(*_tasks_query(user_id, all_users, after, limit))
+
+
+def fetch_statistics() -> tuple:
+    """Сводка системы: (договоров, на согласовании, ожидающих задач, активных пользователей)"""
+    return (db.fetchvalue("SELECT COUNT(*) FROM contracts"),
+            db.fetchvalue("SELECT COUNT(*) FROM contracts WHERE status = 'На согласовании'"),
+            db.fetchvalue("SELECT COUNT(*) FROM approval_tasks WHERE status = 'pending'"),
+            db.fetchvalue("SELECT COUNT(*) FROM users WHERE is_active = 1"))
+
+
+class ApprovalFlow:
+    """Маршрут согласования в памяти: этапы по порядку, у этапа — роли со сроками в днях"""
+
+    def __init__(self, flow_id, name, department, steps):
+        """steps — [(этап, роль, срок в днях)] из approval_flow_steps"""
+        self.id = flow_id
+        self.name = name
+        self.department = department
+        stages = {}
+        for step_order, role_name, deadline_days in steps:
+            stages.setdefault(step_order, []).append((role_name, deadline_days))
+        self.orders = sorted(stages)
+        self.stages = {order: tuple(stages[order]) for order in self.orders}  # этап -> ((роль, дней), ...)
+        self._next = dict(zip(self.orders, self.orders[1:]))
+
+    @property
+    def first_step(self) -> Optional[int]:
+        return self.orders[0] if self.orders else None
+
+    def next_step(self, step_order) -> Optional[int]:
+        """Следующий этап после step_order или None, если этот этап последний"""
+        return self._next.get(step_order)
+
+
+class ApprovalFlowRegistry:
+    """Маршруты согласования, прочитанные один раз: по id и по отделу.
+
+    Перечитываются, только когда меняется версия DATA_VERSION_FLOWS (ее увеличивают триггеры
+    на approval_flows и approval_flow_steps); в одной транзакции версия сверяется один раз.
+    """
+
+    DEFAULT_DEPARTMENT = "Общий"
+
+    def __init__(self):
+        self._flows = None  # (id -> ApprovalFlow, отдел -> ApprovalFlow)
+        self._version = None
+        self._checked_cur = None
+
+    def invalidate(self):
+        self._flows = self._version = self._checked_cur = None
+
+    def _load(self, cur):
+        if cur is self._checked_cur and self._flows is not None:
+            return self._flows
+        row = cur.execute("SELECT version FROM data_versions WHERE name = ?", (DATA_VERSION_FLOWS,)).fetchone()
+        version = row[0] if row else 0
+        if self._flows is None or version != self._version:
+            flows, steps = {}, {}
+            for flow_id, name, department, step_order, role_name, deadline_days in cur.execute('''
+                SELECT f.id, f.name, f.department, s.step_order, s.role_name, s.deadline_days
+                FROM approval_flows f
+                LEFT JOIN approval_flow_steps s ON s.flow_id = f.id
+                ORDER BY f.id, s.step_order, s.role_name
+            ''').fetchall():
+                flows.setdefault(flow_id, (name, department))
+                if step_order is not None:
+                    steps.setdefault(flow_id, []).append((step_order, role_name, deadline_days))
+            by_id, by_department = {}, {}
+            for flow_id, (name, department) in flows.items():
+                flow = ApprovalFlow(flow_id, name, department, steps.get(flow_id, ()))
+                by_id[flow_id] = flow
+                by_department.setdefault(department, flow)
+            self._flows, self._version = (by_id, by_department), version
+        self._checked_cur = cur
+        return self._flows
+
+    def get(self, cur, flow_id) -> Optional[ApprovalFlow]:
+        return self._load(cur)[0].get(flow_id)
+
+    def for_department(self, cur, department) -> Optional[ApprovalFlow]:
+        """Маршрут отдела, а если его нет — общий"""
+        by_department = self._load(cur)[1]
+        return by_department.get(department) or by_department.get(self.DEFAULT_DEPARTMENT)
+
+
+flow_registry = ApprovalFlowRegistry()
+
+
+STAGE_TASKS_BATCH = 200  # задач в одном INSERT ... SELECT (по 5 параметров на задачу)
+
+# {values} — строки (?, ?, ?, ?, ?) задач, {deadline} — db.add_days от параметра "сейчас"
+STAGE_TASKS_SQL = '''
+    WITH x(instance_id, flow_id, step_order, role_name, assignee) AS (VALUES {values})
+    INSERT INTO approval_tasks (instance_id, step_order, role_name, assigned_user_id, status, deadline_at)
+    SELECT x.instance_id, s.step_order, s.role_name, CAST(x.assignee AS INTEGER), 'pending', {deadline}
+    FROM x
+    JOIN approval_flow_steps s
+      ON s.flow_id = x.flow_id AND s.step_order = x.step_order AND s.role_name = x.role_name
+'''
+
+
+def _insert_step_tasks(cur, stages, assigner) -> int:
+    """Создать задачи этапов маршрутов одним INSERT ... SELECT из approval_flow_steps.
+
+    stages — [(id экземпляра, ApprovalFlow, этап)]. Исполнители выбираются заранее (assigner),
+    на все задачи роли сразу, и передаются вместе с ключами задач списком VALUES;
+    дедлайн — сейчас плюс срок этапа. Возвращает число созданных задач.
+    """
+    tasks = [(instance_id, flow.id, step_order, role_name)
+             for instance_id, flow, step_order in stages
+             for role_name, _ in flow.stages.get(step_order, ())]
+    assignees = {role_name: iter(assigner.get_next_users(role_name, count, cur))
+                 for role_name, count in Counter(task[3] for task in tasks).items()}
+    rows = [(*task, next(assignees[task[3]])) for task in tasks]
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    created = 0
+    for batch in _batches(rows, STAGE_TASKS_BATCH):
+        sql = STAGE_TASKS_SQL.format(values=", ".join(["(?, ?, ?, ?, ?)"] * len(batch)),
+                                     deadline=db.add_days("?", "s.deadline_days"))
+        cur.execute(sql, [value for row in batch for value in row] + [now])
+        created += cur.rowcount
+    return created
+
+
+def _batches(items, size: int = BULK_BATCH):
+    """Список частями по size — для IN (...) с ограниченным числом параметров"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _initial_deadline(priority, contract_deadline) -> str:
+    """Дедлайн задач первого этапа: дедлайн договора, а без него — по приоритету"""
+    if contract_deadline:
+        return contract_deadline
+    if priority == "urgent":
+        deadline_days = 1
+    elif priority == "custom":
+        deadline_days = 3  # По умолчанию для custom
+    else:  # standard
+        deadline_days = 3
+    return (datetime.now() + timedelta(days=deadline_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Повторная отправка: незавершенные экземпляры договоров удаляются вместе с задачами
+CLEAR_APPROVAL_TASKS_SQL = '''
+    DELETE FROM approval_tasks WHERE instance_id IN (
+        SELECT id FROM approval_instances WHERE contract_id IN ({placeholders}) AND status != 'finished'
+    )
+'''
+CLEAR_APPROVAL_INSTANCES_SQL = '''
+    DELETE FROM approval_instances WHERE contract_id IN ({placeholders}) AND status != 'finished'
+'''
+RUNNING_INSTANCES_SQL = '''
+    SELECT contract_id, id FROM approval_instances
+    WHERE contract_id IN ({placeholders}) AND status = 'running'
+'''
+
+
+def start_approval(contract_id, user_id, assigner) -> str:
+    """Отправить договор-черновик на согласование; возвращает номер договора"""
+    sent, skipped = start_approvals([contract_id], user_id, assigner)
+    if skipped:
+        raise skipped[contract_id]
+    return sent[0][1]
+
+
+def start_approvals(contract_ids, user_id, assigner):
+    """Отправить на согласование несколько черновиков одной транзакцией.
+
+    Экземпляры, задачи первого этапа и записи журнала создаются пакетами (executemany),
+    исполнители каждой роли распределяются сразу на весь пакет. Возвращает
+    ([(id, номер)] отправленных, {id: WorkflowError} пропущенных с причиной).
+    """
+    contract_ids = list(dict.fromkeys(contract_ids))
+    skipped = {}
+
+    with db.transaction() as cur:
+        contracts = {}
+        for batch in _batches(contract_ids):
+            for contract_id, *contract in cur.execute(f'''
+                SELECT id, contract_number, department, priority, deadline_at FROM contracts
+                WHERE id IN ({", ".join("?" * len(batch))})
+            ''', batch).fetchall():
+                contracts[contract_id] = contract
+
+        # Находим подходящий маршрут
+        flows = {}
+        for contract_id in contract_ids:
+            if contract_id not in contracts:
+                skipped[contract_id] = NotFoundError("Договор не найден")
+                continue
+            flow = flow_registry.for_department(cur, contracts[contract_id][1])
+            if not flow or flow.first_step is None:
+                skipped[contract_id] = WorkflowError("Не найден подходящий маршрут согласования")
+                continue
+            flows[contract_id] = flow
+
+        # Статус меняется условно: из двух одновременных отправок пройдет только одна
+        updated = set()
+        for batch in _batches(list(flows)):
+            updated.update(row[0] for row in cur.execute(f'''
+                UPDATE contracts SET status = 'На согласовании', updated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({", ".join("?" * len(batch))}) AND status = 'Черновик'
+                RETURNING id
+            ''', batch).fetchall())
+        sent = [contract_id for contract_id in flows if contract_id in updated]
+        for contract_id in flows.keys() - updated:
+            skipped[contract_id] = WorkflowError("Только договоры в статусе 'Черновик' можно отправить на согласование")
+        if not sent:
+            return [], skipped
+
+        # УДАЛЯЕМ ПРЕДЫДУЩИЕ ДАННЫЕ СОГЛАСОВАНИЯ (если есть)
+        removed = 0
+        for batch in _batches(sent):
+            placeholders = ", ".join("?" * len(batch))
+            cur.execute(CLEAR_APPROVAL_TASKS_SQL.format(placeholders=placeholders), batch)
+            cur.execute(CLEAR_APPROVAL_INSTANCES_SQL.format(placeholders=placeholders), batch)
+            removed += cur.rowcount
+
+        # Создаем НОВЫЕ экземпляры согласования; незавершенных у этих договоров больше нет,
+        # поэтому их id находятся по договору и статусу
+        cur.executemany("INSERT INTO approval_instances (contract_id, flow_id, status) VALUES (?, ?, 'running')",
+                        [(contract_id, flows[contract_id].id) for contract_id in sent])
+        instances = {}
+        for batch in _batches(sent):
+            instances.update(cur.execute(RUNNING_INSTANCES_SQL.format(placeholders=", ".join("?" * len(batch))),
+                                         batch).fetchall())
+
+        # Создаем задачи согласования только для первого этапа; стратегия назначения
+        # получает все задачи роли сразу и распределяет их по пакету
+        tasks = [(contract_id, role_name) for contract_id in sent
+                 for role_name, _ in flows[contract_id].stages[flows[contract_id].first_step]]
+        assignees = {role_name: iter(assigner.get_next_users(role_name, count, cur))
+                     for role_name, count in Counter(role_name for _, role_name in tasks).items()}
+        cur.executemany('''
+            INSERT INTO approval_tasks
+            (instance_id, step_order, role_name, assigned_user_id, status, deadline_at)
+            VALUES (?, ?, ?, ?, 'pending', ?)
+        ''', [(instances[contract_id], flows[contract_id].first_step, role_name, next(assignees[role_name]),
+               _initial_deadline(*contracts[contract_id][2:4])) for contract_id, role_name in tasks])
+
+        # Записываем действия пользователя
+        cur.executemany(
+            "INSERT INTO audit_log (user_id, action, details) VALUES (?, ?, ?)",
+            [(user_id, 'send_for_approval', f'Договор {contracts[contract_id][0]} отправлен на согласование')
+             for contract_id in sent]
+        )
+
+    if removed:
+        log_message(f"Удалено предыдущих экземпляров согласования: {removed}")
+    if len(sent) == 1:
+        log_message(f"Договор {contracts[sent[0]][0]} отправлен на согласование")
+    else:
+        log_message(f"Отправлено на согласование договоров: {len(sent)}")
+    return [(contract_id, contracts[contract_id][0]) for contract_id in sent], skipped
+
+
+def complete_task(task_id, user_id, approve: bool, comment: str, assigner, is_admin: bool = False) -> str:
+    """Утвердить или отклонить задачу согласования; возвращает номер договора"""
+    done, failed = complete_tasks([task_id], user_id, approve, comment, assigner, is_admin)
+    if failed:
+        raise failed[task_id]
+    return done[0][1]
+
+
+# Этапы экземпляров, где еще остались ожидающие задачи
+OPEN_STAGES_SQL = '''
+    SELECT instance_id, step_order FROM approval_tasks
+    WHERE instance_id IN ({placeholders}) AND status = 'pending'
+    GROUP BY instance_id, step_order
+'''
+
+
+def complete_tasks(task_ids, user_id, approve: bool, comment: str, assigner, is_admin: bool = False):
+    """Утвердить или отклонить несколько задач одной транзакцией с общим комментарием.
+
+    Статусы задач, проверка завершения этапов, задачи следующих этапов и статусы экземпляров
+    и договоров меняются пакетами, а не по задаче. Возвращает ([(id задачи, номер договора)]
+    обработанных, {id задачи: WorkflowError} необработанных с причиной).
+    """
+    # Автоматическая подстановка комментария если поле пустое
+    if not comment:
+        comment = "Согласовано" if approve else "Отклонено"
+    task_ids = list(dict.fromkeys(task_ids))
+    failed = {}
+
+    with db.transaction() as cur:
+        # Получаем информацию о задачах
+        tasks = {}
+        for batch in _batches(task_ids):
+            for task_id, *task in cur.execute(f'''
+                SELECT t.id, t.instance_id, t.step_order, t.role_name, t.assigned_user_id, i.contract_id, i.flow_id,
+                       c.contract_number
+                FROM approval_tasks t
+                JOIN approval_instances i ON t.instance_id = i.id
+                JOIN contracts c ON i.contract_id = c.id
+                WHERE t.id IN ({", ".join("?" * len(batch))})
+            ''', batch).fetchall():
+                tasks[task_id] = task
+        allowed = []
+        for task_id in task_ids:
+            if task_id not in tasks:
+                failed[task_id] = NotFoundError("Задача не найдена")
+            elif not is_admin and tasks[task_id][3] != user_id:
+                failed[task_id] = AccessDeniedError("Задача назначена другому пользователю")
+            else:
+                allowed.append(task_id)
+
+        new_status = "approved" if approve else "rejected"
+        completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        # Условие на статус не дает обработать задачу дважды с разных рабочих мест
+        updated = set()
+        for batch in _batches(allowed):
+            updated.update(row[0] for row in cur.execute(f'''
+                UPDATE approval_tasks 
+                SET status = ?, completed_at = ?, comment = ?
+                WHERE id IN ({", ".join("?" * len(batch))}) AND status = 'pending'
+                RETURNING id
+            ''', (new_status, completed_at, comment, *batch)).fetchall())
+        done = [task_id for task_id in allowed if task_id in updated]
+        for task_id in allowed:
+            if task_id not in updated:
+                failed[task_id] = WorkflowError("Задача уже обработана")
+        if not done:
+            return [], failed
+
+        finished_instances, finished_contracts = [], []
+        if approve:
+            # Проверяем, все ли задачи затронутых этапов завершены: этапы, где еще есть
+            # ожидающие задачи, находятся одним запросом
+            stages = {(tasks[task_id][0], tasks[task_id][1]): tasks[task_id] for task_id in done}
+            instance_ids = sorted({instance_id for instance_id, _ in stages})
+            open_stages = set()
+            for batch in _batches(instance_ids):
+                open_stages.update(tuple(row) for row in cur.execute(
+                    OPEN_STAGES_SQL.format(placeholders=", ".join("?" * len(batch))), batch).fetchall())
+
+            next_stages = []
+            for (instance_id, current_step), task in stages.items():
+                if (instance_id, current_step) in open_stages:
+                    continue
+                flow = flow_registry.get(cur, task[5])
+                if not flow:
+                    continue
+                next_step = flow.next_step(current_step)
+                if next_step is not None:
+                    next_stages.append((instance_id, flow, next_step))
+                else:
+                    # Нет следующих этапов - завершаем согласование
+                    finished_instances.append(instance_id)
+                    finished_contracts.append(task[4])
+
+            # Создаем задачи для следующих этапов со сроками этапа
+            if next_stages:
+                _insert_step_tasks(cur, next_stages, assigner)
+            contract_status = 'Согласован'
+        else:
+            # Задача отклонена - ВАЖНОЕ ИСПРАВЛЕНИЕ: отменяем ВСЕ задачи для этого договора
+            rejected_by = {}  # экземпляр -> роль отклонившего
+            for task_id in done:
+                instance_id, _, role, _, contract_id, _, _ = tasks[task_id]
+                if instance_id not in rejected_by:
+                    rejected_by[instance_id] = role
+                    finished_instances.append(instance_id)
+                    finished_contracts.append(contract_id)
+            by_role = {}
+            for instance_id, role in rejected_by.items():
+                by_role.setdefault(role, []).append(instance_id)
+            for role, instance_ids in by_role.items():
+                for batch in _batches(instance_ids):
+                    cur.execute(f'''
+                        UPDATE approval_tasks 
+                        SET status = 'cancelled', completed_at = CURRENT_TIMESTAMP, 
+                            comment = COALESCE(comment, '') || ?
+                        WHERE instance_id IN ({", ".join("?" * len(batch))}) AND status = 'pending'
+                    ''', (f" | Отменено из-за отклонения отделом {role}", *batch))
+            contract_status = 'Отклонён'
+
+        for batch in _batches(finished_instances):
+            cur.execute(f'''
+                UPDATE approval_instances SET status = 'finished', finished_at = CURRENT_TIMESTAMP
+                WHERE id IN ({", ".join("?" * len(batch))})
+            ''', batch)
+        for batch in _batches(finished_contracts):
+            cur.execute(f'''
+                UPDATE contracts SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({", ".join("?" * len(batch))})
+            ''', (contract_status, *batch))
+
+        # Записываем действия пользователя
+        action = "approve_task" if approve else "reject_task"
+        cur.executemany(
+            "INSERT INTO audit_log (user_id, action, details) VALUES (?, ?, ?)",
+            [(user_id, action, f'Задача {task_id} для договора {tasks[task_id][6]}') for task_id in done]
+        )
+
+    if len(done) == 1:
+        log_message(f"Задача {done[0]} {'утверждена' if approve else 'отклонена'} с комментарием: {comment}")
+    else:
+        log_message(f"{'Утверждено' if approve else 'Отклонено'} задач: {len(done)} с комментарием: {comment}")
+    return [(task_id, tasks[task_id][6]) for task_id in done], failed
+
+
+APPROVAL_TIMELINE_VERSION_SQL = '''
+    SELECT c.approval_version, (SELECT version FROM data_versions WHERE name = ?)
+    FROM contracts c WHERE c.id = ?
+'''
+
+# Экземпляры без задач тоже нужны, поэтому задачи присоединяются через LEFT JOIN
+APPROVAL_TIMELINE_SQL = '''
+    SELECT i.id, f.name, i.status, i.started_at, i.finished_at,
+           t.step_order, t.role_name, u.full_name, t.status, t.completed_at, t.comment, t.assigned_at,
+           t.deadline_at
+    FROM approval_instances i
+    JOIN approval_flows f ON i.flow_id = f.id
+    LEFT JOIN approval_tasks t ON t.instance_id = i.id
+    LEFT JOIN users u ON t.assigned_user_id = u.id
+    WHERE i.contract_id = ?
+    ORDER BY i.started_at DESC, i.id DESC, t.step_order, t.assigned_at, t.id
+'''
+
+_timeline_cache = OrderedDict()  # id договора -> (версия, история)
+_timeline_lock = threading.Lock()
+
+
+def clear_timeline_cache():
+    """Сбросить кэш историй (после пересоздания базы версии начинаются заново и могут совпасть)"""
+    with _timeline_lock:
+        _timeline_cache.clear()
+
+
+def get_approval_timeline(contract_id) -> list:
+    """История согласования договора: [(экземпляр, [задачи])], последний экземпляр первым.
+
+    Экземпляр — (id, маршрут, статус, начато, завершено), задача — (этап, роль, исполнитель, статус,
+    завершено, комментарий, назначено, дедлайн). Все читается одним запросом и кэшируется по договору;
+    кэш сверяется с contracts.approval_version и версией справочника пользователей.
+    """
+    row = db.fetchone(APPROVAL_TIMELINE_VERSION_SQL, (DATA_VERSION_ROLES, contract_id))
+    if row is None:
+        with _timeline_lock:
+            _timeline_cache.pop(contract_id, None)
+        return []
+    version = tuple(row)
+    with _timeline_lock:
+        cached = _timeline_cache.get(contract_id)
+        if cached and cached[0] == version:
+            _timeline_cache.move_to_end(contract_id)
+            return cached[1]
+
+    # Версия прочитана раньше данных: если договор успеет измениться между запросами,
+    # в кэш попадут более свежие данные со старой версией и следующий вызов их перечитает
+    timeline = []
+    for row in db.fetchall(APPROVAL_TIMELINE_SQL, (contract_id,)):
+        instance, task = tuple(row[:5]), tuple(row[5:])
+        if not timeline or timeline[-1][0][0] != instance[0]:
+            timeline.append((instance, []))
+        if task[0] is not None:
+            timeline[-1][1].append(task)
+
+    with _timeline_lock:
+        _timeline_cache[contract_id] = (version, timeline)
+        _timeline_cache.move_to_end(contract_id)
+        while len(_timeline_cache) > APPROVAL_TIMELINE_CACHE_SIZE:
+            _timeline_cache.popitem(last=False)
+    return timeline
+
+
+def compute_deadline(priority: str, custom_value: str = None) -> str:
+    """Дедлайн по приоритету: стандартный +3 дня, срочный +1 день (к 18:00), custom — указанная дата"""
+    if priority == "custom":
+        if not custom_value:
+            raise WorkflowError("Для ручного ввода необходимо выбрать дату и время")
+        deadline_dt = datetime.strptime(custom_value, '%Y-%m-%d %H:%M:%S')
+    elif priority in ("standard", "urgent"):
+        days = 3 if priority == "standard" else 1
+        deadline_dt = datetime.now() + timedelta(days=days)
+        deadline_dt = deadline_dt.replace(hour=18, minute=0, second=0)
+    else:
+        raise WorkflowError(f"Неизвестный приоритет: {priority}")
+
+    # Проверяем что дедлайн в будущем
+    if deadline_dt <= datetime.now():
+        raise WorkflowError("Дедлайн должен быть в будущем")
+    return deadline_dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def set_contract_deadline(contract_id, priority: str, deadline_str: str) -> str:
+    """Сохранить приоритет и дедлайн договора и перенести его на активные задачи; возвращает номер договора"""
+    with db.transaction() as cur:
+        updated = cur.execute('''
+            UPDATE contracts 
+            SET priority = ?, deadline_at = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            RETURNING contract_number
+        ''', (priority, deadline_str, contract_id)).fetchall()
+        if not updated:
+            raise NotFoundError("Договор не найден")
+        number = updated[0][0]
+
+        # Обновляем дедлайны всех активных задач для этого договора
+        cur.execute('''
+            UPDATE approval_tasks 
+            SET deadline_at = ?, deadline_notified = 0
+            WHERE instance_id IN (
+                SELECT id FROM approval_instances 
+                WHERE contract_id = ? AND status = 'running'
+            ) AND status = 'pending'
+        ''', (deadline_str, contract_id))
+
+    log_message(f"Изменен дедлайн договора {number} на {deadline_str}")
+    return number
+
+
+def list_organizations(after=None, limit: int = None) -> list:
+    """Организации по алфавиту; after — (name, id) последней полученной строки"""
+    sql = f"SELECT {ORGANIZATION_COLUMNS} FROM organizations"
+    params = []
+    if after:
+        sql += " WHERE name > ? OR (name = ? AND id > ?)"
+        params += [after[0], after[0], after[1]]
+    sql += " ORDER BY name, id"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return db.fetchall(sql, params)
+
+
+def get_organization(org_id):
+    organization = db.fetchone(f"SELECT {ORGANIZATION_COLUMNS}, created_at FROM organizations WHERE id = ?", (org_id,))
+    if not organization:
+        raise NotFoundError("Организация не найдена")
+    return organization
+
+
+def validate_organization(name, org_type, inn, kpp=None, ogrn=None, phone=None, email=None) -> Optional[str]:
+    """Проверка реквизитов организации: текст ошибки или None"""
+    if not name or not inn:
+        return "Заполните обязательные поля (Название и ИНН)"
+
+    # Проверка ИНН в зависимости от типа организации
+    if not validate_inn(inn, org_type):
+        if org_type == "legal":
+            return "Неверный формат ИНН для юридического лица. Должно быть 10 или 12 цифр."
+        return "Неверный формат ИНН для ИП. Должно быть 12 цифр."
+
+    # Проверка КПП (только для Юр. Лиц)
+    if org_type == "legal" and kpp and not validate_kpp(kpp):
+        return "КПП должен содержать 9 цифр"
+
+    # Проверка ОГРН/ОГРНИП
+    if ogrn and not validate_ogrn(ogrn, org_type):
+        if org_type == "legal":
+            return "Неверный формат ОГРН. Должно быть 13 цифр."
+        return "Неверный формат ОГРНИП. Должно быть 15 цифр."
+
+    # Проверка телефона
+    if phone and not validate_phone(phone):
+        return "Телефон должен быть в формате: +7 (xxx) xxx-xxxx"
+
+    # Проверка email
+    if email and not validate_email(email):
+        return "Неверный формат email адреса"
+    return None
+
+
+def store_organization(org_id, name, org_type, inn, kpp=None, ogrn=None, address=None, phone=None,
+                      email=None) -> int:
+    """Создать (org_id=None) или обновить организацию; возвращает ее id"""
+    error = validate_organization(name, org_type, inn, kpp, ogrn, phone, email)
+    if error:
+        raise WorkflowError(error)
+
+    values = (name, org_type, inn, kpp or None, ogrn or None, address or None, phone or None, email or None)
+    with db.transaction() as cur:
+        if org_id:
+            # Обновление существующей организации
+            cur.execute('''
+                UPDATE organizations 
+                SET name=?, organization_type=?, inn=?, kpp=?, ogrn=?, legal_address=?, phone=?, email=?
+                WHERE id=?
+            ''', values + (org_id,))
+            if cur.rowcount == 0:
+                raise NotFoundError("Организация не найдена")
+            action_msg = "Организация обновлена"
+        else:
+            # Создание новой организации
+            org_id = db.insert(cur, '''
+                INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', values)
+            action_msg = "Организация создана"
+
+    log_message(f"{action_msg}: {name} (ИНН: {inn}, Тип: {'Юрлицо' if org_type == 'legal' else 'ИП'})")
+    return org_id
+
+
+ORGANIZATION_CONTRACTS_SQL = "SELECT COUNT(*) FROM contracts WHERE counterparty = ?"
+
+
+def organization_contract_count(org_id) -> int:
+    return db.fetchvalue(ORGANIZATION_CONTRACTS_SQL, (org_id,), 0)
+
+
+def remove_organization(org_id):
+    """Удалить организацию, если на нее не ссылается ни один договор"""
+    with db.transaction() as cur:
+        organization = cur.execute("SELECT name, inn FROM organizations WHERE id = ?", (org_id,)).fetchone()
+        if not organization:
+            raise NotFoundError("Организация не найдена")
+        name, inn = organization
+        contract_count = organization_contract_count(org_id)
+        if contract_count > 0:
+            raise WorkflowError(f"Организация '{name}' используется в {contract_count} договоре(ах).\n"
+                                "Удаление невозможно.")
+        cur.execute("DELETE FROM organizations WHERE id = ?", (org_id,))
+
+    log_message(f"Удалена организация: {name} (ИНН: {inn})")
+
+
+def get_contract(contract_id):
+    contract = db.fetchone("SELECT * FROM contracts WHERE id = ?", (contract_id,))
+    if not contract:
+        raise NotFoundError("Договор не найден")
+    return contract
+
+
+def reset_contract_to_draft(contract_id):
+    """Сбросить договор в 'Черновик' перед редактированием; возвращает обновленную строку"""
+    with db.transaction() as cur:
+        cur.execute('''
+            UPDATE contracts SET status = 'Черновик', updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (contract_id,))
+        contract = cur.execute("SELECT * FROM contracts WHERE id = ?", (contract_id,)).fetchone()
+        if not contract:
+            raise NotFoundError("Договор не найден")
+
+    log_message(f"Договор {contract[1]} сброшен в статус 'Черновик' для редактирования")
+    return contract
+
+
+def store_contract(contract_id, number, title_text, counterparty_id, amount, owner_id, department, file_path,
+                   priority, deadline_str) -> str:
+    """Создать (contract_id=None) или обновить договор; возвращает текст результата"""
+    with db.transaction() as cur:
+        if contract_id:
+            cur.execute('''
+                UPDATE contracts
+                SET contract_number = ?, title = ?, counterparty = ?, amount = ?,
+                    department = ?, file_path = ?, priority = ?, deadline_at = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (number, title_text, counterparty_id, amount, department, file_path or None,
+                  priority, deadline_str, contract_id))
+            if cur.rowcount == 0:
+                raise NotFoundError("Договор не найден")
+            action_msg = "Договор обновлен"
+        else:
+            cur.execute('''
+                INSERT INTO contracts
+                (contract_number, title, counterparty, amount, owner_id, department, file_path, status, priority, deadline_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'Черновик', ?, ?)
+            ''', (number, title_text, counterparty_id, amount, owner_id, department, file_path or None,
+                  priority, deadline_str))
+            action_msg = "Договор создан"
+
+    log_message(f"{action_msg}: {number}")
+    return action_msg
+
+
+def remove_contract(contract_id, number):
+    """Удалить договор вместе с историей согласования"""
+    with db.transaction() as cur:
+        # Сначала история согласования: в PostgreSQL внешние ключи не дадут удалить договор с ней
+        cur.execute('''
+            DELETE FROM approval_tasks
+            WHERE instance_id IN (SELECT id FROM approval_instances WHERE contract_id = ?)
+        ''', (contract_id,))
+        cur.execute("DELETE FROM approval_instances WHERE contract_id = ?", (contract_id,))
+        cur.execute("DELETE FROM contracts WHERE id = ?", (contract_id,))
+
+    log_message(f"Удален договор: {number}")
+
+
+def contract_file_path(contract_id) -> Optional[str]:
+    return db.fetchvalue("SELECT file_path FROM contracts WHERE id = ?", (contract_id,))
+
+
+def task_contract_file_path(task_id) -> Optional[str]:
+    """Файл договора, к которому относится задача согласования"""
+    return db.fetchvalue('''
+        SELECT c.file_path
+        FROM contracts c
+        JOIN approval_instances i ON c.id = i.contract_id
+        JOIN approval_tasks t ON i.id = t.instance_id
+        WHERE t.id = ?
+    ''', (task_id,))
+
+
+def recreate_database(assigner=None):
+    """Пересоздать базу с тестовыми данными и сбросить кэши, построенные по старым данным"""
+    db.drop_all(APP_TABLES)
+    init_database()
+    if assigner is not None:
+        assigner.invalidate()
+    flow_registry.invalidate()
+    clear_timeline_cache()
+    log_message("База данных сброшена администратором")
+
+
+def list_users() -> list:
+    """Все пользователи с ролями для окна администрирования"""
+    return db.fetchall(f'''
+        SELECT u.id, u.username, u.full_name, u.department, u.position,
+               CASE WHEN u.is_active = 1 THEN 'Активен' ELSE 'Неактивен' END as status,
+               {db.group_concat("r.name")} as roles
+        FROM users u
+        LEFT JOIN user_roles ur ON u.id = ur.user_id
+        LEFT JOIN roles r ON ur.role_id = r.id
+        GROUP BY u.id
+        ORDER BY u.full_name
+    ''')
+
+
+def list_roles() -> list:
+    return db.fetchall("SELECT id, name FROM roles ORDER BY name")
+
+
+def get_user_for_edit(user_id) -> tuple:
+    """Пользователь, названия его ролей и все роли — данные формы редактирования"""
+    user = db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+    if not user:
+        raise NotFoundError("Пользователь не найден")
+    user_roles = [row[0] for row in db.fetchall('''
+        SELECT r.name
+        FROM roles r
+        JOIN user_roles ur ON r.id = ur.role_id
+        WHERE ur.user_id = ?
+    ''', (user_id,))]
+    return user, user_roles, list_roles()
+
+
+def store_user(user_id, username, full_name, password, department, position, is_active, role_ids) -> str:
+    """Создать (user_id=None) или обновить пользователя с ролями; password=None оставляет прежний"""
+    with db.transaction() as cur:
+        if user_id:
+            update_data = [username, full_name, department or None, position or None, is_active, user_id]
+            if password:
+                update_sql = '''UPDATE users SET username=?, full_name=?, password=?,
+                              department=?, position=?, is_active=? WHERE id=?'''
+                update_data.insert(2, hash_password(password))
+            else:
+                update_sql = '''UPDATE users SET username=?, full_name=?, department=?,
+                              position=?, is_active=? WHERE id=?'''
+            cur.execute(update_sql, update_data)
+            if cur.rowcount == 0:
+                raise NotFoundError("Пользователь не найден")
+            action_msg = "Пользователь обновлен"
+        else:
+            user_id = db.insert(
+                cur,
+                '''INSERT INTO users (username, full_name, password, department, position, is_active)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                (username, full_name, hash_password(password), department or None, position or None, is_active))
+            action_msg = "Пользователь создан"
+
+        # Обновляем роли
+        cur.execute("DELETE FROM user_roles WHERE user_id = ?", (user_id,))
+        for role_id in role_ids:
+            cur.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (user_id, role_id))
+        bump_data_version(cur, DATA_VERSION_ROLES)
+
+    log_message(f"{action_msg}: {full_name} ({username})")
+    return action_msg
+
+
+def remove_user(user_id, username, full_name):
+    with db.transaction() as cur:
+        # Удаляем связи с ролями
+        cur.execute("DELETE FROM user_roles WHERE user_id = ?", (user_id,))
+        # Удаляем пользователя
+        cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        bump_data_version(cur, DATA_VERSION_ROLES)
+
+    log_message(f"Удален пользователь: {full_name} ({username})")
+
+
+OVERDUE_MARK_SQL = '''
+    UPDATE approval_tasks SET deadline_notified = 1
+    WHERE status = 'pending' AND deadline_notified = 0 AND deadline_at < ?
+      AND assigned_user_id IS NOT NULL
+    RETURNING id
+'''
+OVERDUE_DETAILS_SQL = '''
+    SELECT u.id, u.full_name, c.contract_number, t.role_name, t.deadline_at
+    FROM approval_tasks t
+    JOIN users u ON t.assigned_user_id = u.id
+    JOIN approval_instances i ON t.instance_id = i.id
+    JOIN contracts c ON i.contract_id = c.id
+    WHERE t.id IN ({placeholders})
+    ORDER BY u.id, t.deadline_at
+'''
+
+
+def notify_overdue_tasks() -> dict:
+    """Отметить просроченные задачи и уведомить исполнителей, по одному уведомлению на пользователя.
+
+    Задачи отмечаются одним UPDATE ... RETURNING; возвращает {id пользователя: [(договор, роль, дедлайн)]},
+    пустой словарь — новых просрочек нет.
+    """
+    # Дедлайны хранятся в местном времени, поэтому "сейчас" передаем параметром,
+    # а не функцией СУБД (datetime('now') в SQLite возвращает UTC)
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with db.transaction() as cur:
+        task_ids = [row[0] for row in cur.execute(OVERDUE_MARK_SQL, (now_str,)).fetchall()]
+
+        overdue_tasks = []
+        for batch in _batches(task_ids):
+            overdue_tasks += cur.execute(OVERDUE_DETAILS_SQL.format(placeholders=", ".join("?" * len(batch))),
+                                         batch).fetchall()
+
+    # Уведомления собираются уже после фиксации, чтобы не держать блокировку записи
+    by_user, names = {}, {}
+    for user_id, user_name, contract_number, role, deadline in overdue_tasks:
+        by_user.setdefault(user_id, []).append((contract_number, role, deadline))
+        names[user_id] = user_name
+    for user_id, tasks in by_user.items():
+        lines = "\n".join(f"{number} — {role}, дедлайн {deadline[:16]}" for number, role, deadline in tasks)
+        log_message(f"Уведомление о просрочке отправлено пользователю {names[user_id]}: "
+                    f"ПРОСРОЧЕНО задач: {len(tasks)}\n{lines}")
+    return by_user
+
+
+# Горячие запросы приложения: каждый должен обслуживаться индексом, а не полным сканированием таблиц.
+# Берутся те же строки SQL, что выполняет код, с примерными параметрами.
+HOT_QUERIES = {
+    "load_contracts (директор)": _contracts_query(None, None, True),
+    "load_contracts (сотрудник)": _contracts_query(1, "Закупки", False),
+    "load_contracts (следующая страница)": _contracts_query(None, None, True, after=("2025-01-01 00:00:00", 1),
+                                                            limit=1000),
+    "load_tasks (пользователь)": _tasks_query(1, False),
+    "load_tasks (администратор)": _tasks_query(None, True),
+    "notify_overdue_tasks": (OVERDUE_MARK_SQL, ("2025-01-01 00:00:00",)),
+    "notify_overdue_tasks (подробности)": (OVERDUE_DETAILS_SQL.format(placeholders="?, ?"), (1, 2)),
+    "get_approval_timeline (версия)": (APPROVAL_TIMELINE_VERSION_SQL, (DATA_VERSION_ROLES, 1)),
+    "get_approval_timeline": (APPROVAL_TIMELINE_SQL, (1,)),
+    "send_for_approval (задачи прежних экземпляров)": (CLEAR_APPROVAL_TASKS_SQL.format(placeholders="?, ?"), (1, 2)),
+    "send_for_approval (прежние экземпляры)": (CLEAR_APPROVAL_INSTANCES_SQL.format(placeholders="?, ?"), (1, 2)),
+    "send_for_approval (новые экземпляры)": (RUNNING_INSTANCES_SQL.format(placeholders="?, ?"), (1, 2)),
+    "_process_task (незавершенные этапы)": (OPEN_STAGES_SQL.format(placeholders="?, ?"), (1, 2)),
+    "назначение (нагрузка исполнителей)": (TASK_LOAD_SQL.format(placeholders="?, ?"), (1, 2)),
+    "_insert_step_tasks (задачи этапа)": (STAGE_TASKS_SQL.format(values="(?, ?, ?, ?, ?)",
+                                                                 deadline=db.add_days("?", "s.deadline_days")),
+                                          (1, 1, 2, "Юрист", 1, "2025-01-01 00:00:00")),
+    "delete_organization (договоры контрагента)": (ORGANIZATION_CONTRACTS_SQL, (1,)),
+}
+
+
+def check_query_plans() -> dict:
+    """EXPLAIN QUERY PLAN для горячих запросов: {запрос: [строки плана с полным сканированием]}"""
+    problems = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        bad = [line for line in db.query_plan(sql, params) if db.is_full_scan(line)]
+        if bad:
+            problems[name] = bad
+    return problems
+
+
+# ======================= РЕЗЕРВНОЕ КОПИРОВАНИЕ =======================
+class BackupError(Exception):
+    """Резервная копия не создана или не прошла проверку"""
+
+
+BACKUP_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# pg_dump сжимает архив сам; zstd поддерживается начиная с PostgreSQL 16
+PG_DUMP_COMPRESSION = {"none": "0", "gzip": "6", "zstd": "zstd"}
+
+
+def _open_backup_stream(path: str, mode: str, compression: str):
+    """Файл бэкапа с потоковым сжатием; mode — rb или wb"""
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise BackupError("Для сжатия zstd установите пакет zstandard")
+        raw = open(path, mode)
+        if mode == "wb":
+            return zstandard.ZstdCompressor(level=3).stream_writer(raw)
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return open(path, mode)
+
+
+def _file_digest(stream, progress=None, total: int = 0) -> str:
+    digest = hashlib.sha256()
+    done = 0
+    for chunk in iter(lambda: stream.read(BACKUP_CHUNK), b""):
+        digest.update(chunk)
+        done += len(chunk)
+        if progress:
+            progress("Проверка", done, total)
+    return digest.hexdigest()
+
+
+def _check_sqlite_file(path: str):
+    """PRAGMA integrity_check файла базы; при ошибках — BackupError"""
+    conn = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    if problems != ["ok"]:
+        raise BackupError("Копия не прошла проверку целостности: " + "; ".join(problems[:5]))
+
+
+def _copy_sqlite(copy_path: str, progress):
+    """Копия через backup API: страницы переносятся шагами, запись в базу между шагами не блокируется.
+
+    В режиме WAL копирование идет внутри читающей транзакции, то есть из одного снимка базы;
+    без нее каждая запись другого клиента заставляла бы SQLite начинать копирование заново.
+    """
+    if not os.path.exists(DB_FILE):
+        raise BackupError(f"Файл базы данных не найден: {DB_FILE}")
+    source = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    copy = sqlite3.connect(copy_path)
+    try:
+        snapshot = source.execute("PRAGMA journal_mode").fetchone()[0].upper() == "WAL"
+        if snapshot:
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(
+            copy, pages=BACKUP_PAGES_PER_STEP,
+            progress=(lambda status, remaining, total: progress("Копирование", total - remaining, total))
+            if progress else None)
+        if snapshot:
+            source.execute("COMMIT")
+        # Бэкап должен открываться как одиночный файл, без журнала WAL рядом
+        copy.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        copy.close()
+        source.close()
+    _check_sqlite_file(copy_path)
+
+
+def _backup_sqlite(target: str, compression: str, progress):
+    copy_path = target + ".part" + (".db" if compression != "none" else "")
+    try:
+        _copy_sqlite(copy_path, progress)
+
+        if compression != "none":
+            total = os.path.getsize(copy_path)
+            digest = hashlib.sha256()
+            done = 0
+            with open(copy_path, "rb") as source, _open_backup_stream(target + ".part", "wb", compression) as out:
+                for chunk in iter(lambda: source.read(BACKUP_CHUNK), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress("Сжатие", done, total)
+            # Сжатый файл перечитывается целиком: он должен распаковываться в ту же проверенную копию
+            with _open_backup_stream(target + ".part", "rb", compression) as packed:
+                if _file_digest(packed, progress, total) != digest.hexdigest():
+                    raise BackupError("Сжатый бэкап не совпадает с копией базы")
+            os.remove(copy_path)
+        os.replace(target + ".part", target)
+    finally:
+        for leftover in {copy_path, target + ".part"}:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def _backup_postgres(target: str, compression: str, progress):
+    """Архив pg_dump в формате custom; прогресс — по выгруженным таблицам приложения"""
+    command = [PG_DUMP, "--format=custom", "--verbose", f"--compress={PG_DUMP_COMPRESSION[compression]}",
+               f"--file={target}.part"]
+    if PG_DSN:
+        command.append(f"--dbname={PG_DSN}")
+    # Сообщения pg_dump разбираются по тексту, поэтому без локализации
+    env = dict(os.environ, LC_ALL="C", LC_MESSAGES="C")
+    dumped, errors, process = 0, [], None
+    try:
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       text=True, errors="replace", env=env)
+        except OSError as e:
+            raise BackupError(f"Не удалось запустить {PG_DUMP}: {e}")
+        for line in process.stderr:
+            if "dumping contents of table" in line:
+                dumped += 1
+                if progress:
+                    progress("Выгрузка таблиц", min(dumped, len(APP_TABLES)), len(APP_TABLES))
+            elif "error" in line.lower():
+                errors.append(line.strip())
+        if process.wait() != 0:
+            raise BackupError(f"pg_dump завершился с кодом {process.returncode}: {'; '.join(errors[-3:])}")
+
+        # Проверка: архив читается pg_restore и содержит данные всех таблиц приложения
+        if progress:
+            progress("Проверка", 0, 1)
+        try:
+            listing = subprocess.run([PG_RESTORE, "--list", target + ".part"], capture_output=True,
+                                     text=True, errors="replace", env=env)
+        except OSError as e:
+            raise BackupError(f"Не удалось запустить {PG_RESTORE}: {e}")
+        if listing.returncode != 0:
+            raise BackupError(f"Архив не читается pg_restore: {listing.stderr.strip()}")
+        present = set(re.findall(r"TABLE DATA \S+ (\S+)", listing.stdout))
+        missing = [table for table in APP_TABLES if table not in present]
+        if missing:
+            raise BackupError(f"В архиве нет данных таблиц: {', '.join(missing)}")
+        os.replace(target + ".part", target)
+    finally:
+        # Прерванная выгрузка (например, отмена в progress) не должна оставлять pg_dump работать
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        if os.path.exists(target + ".part"):
+            os.remove(target + ".part")
+
+
+def backup_database(progress=None, compression: str = BACKUP_COMPRESSION) -> str:
+    """Создать проверенную резервную копию базы в BACKUP_DIR, не останавливая работу клиентов.
+
+    progress(этап, сделано, всего) вызывается из потока, выполняющего копирование.
+    Возвращает путь к файлу бэкапа.
+    """
+    if compression not in BACKUP_EXTENSIONS:
+        raise BackupError(f"Неизвестный способ сжатия: {compression}")
+    if compression == "zstd" and db.backend == "sqlite" and zstandard is None:
+        raise BackupError("Для сжатия zstd установите пакет zstandard")
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    started = time.perf_counter()
+    if db.backend == "sqlite":
+        target = os.path.join(BACKUP_DIR, f"backup_{timestamp}.db{BACKUP_EXTENSIONS[compression]}")
+        _backup_sqlite(target, compression, progress)
+    else:
+        target = os.path.join(BACKUP_DIR, f"backup_{timestamp}.dump")
+        _backup_postgres(target, compression, progress)
+
+    log_message(f"Создан бэкап: {target} ({os.path.getsize(target) / 1024 / 1024:.1f} МБ, "
+                f"{time.perf_counter() - started:.1f} с)")
+    return target
+
+
+class SnapshotStore:
+    """Хранилище инкрементальных снимков базы SQLite.
+
+    Проверенная копия базы режется на блоки фиксированного размера; блок хранится один раз
+    под SHA-256 своего содержимого (сжатым zlib), снимок — манифест со списком блоков.
+    Между снимками в базе меняется немного страниц, поэтому новый снимок дописывает
+    в хранилище только изменившиеся блоки.
+    """
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, root: str = BACKUP_STORE_DIR, chunk_size: int = BACKUP_STORE_CHUNK):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.chunks_dir = os.path.join(root, "chunks")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+
+    @contextmanager
+    def lock(self):
+        """Хранилище меняет один владелец за раз; если оно занято — BackupError.
+
+        Блокировка берется средствами ОС на открытом файле: ее снимает закрытие файла, в том числе
+        при падении процесса, поэтому сколько бы ни шел снимок, чужую блокировку никто не сломает.
+        Сам файл не удаляется — иначе следующий владелец мог бы заблокировать уже другой файл.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        handle = open(os.path.join(self.root, "lock"), "a+")
+        try:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                raise BackupError("Хранилище снимков занято другим процессом")
+            # pid владельца — только для диагностики
+            handle.seek(0)
+            handle.truncate()
+            handle.write(str(os.getpid()))
+            handle.flush()
+            yield
+        finally:
+            handle.close()
+
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def _manifest_path(self, snapshot_id: str) -> str:
+        return os.path.join(self.snapshots_dir, f"{snapshot_id}.json")
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> int:
+        """Записать файл целиком: под временным именем, затем переименовать"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as out:
+            out.write(data)
+        os.replace(path + ".tmp", path)
+        return len(data)
+
+    def snapshots(self) -> list:
+        """Манифесты снимков, новые первыми"""
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        manifests = []
+        for name in os.listdir(self.snapshots_dir):
+            if name.endswith(".json"):
+                with open(os.path.join(self.snapshots_dir, name), encoding="utf-8") as f:
+                    manifests.append(json.load(f))
+        return sorted(manifests, key=lambda manifest: manifest["id"], reverse=True)
+
+    def load(self, snapshot_id: str) -> dict:
+        try:
+            with open(self._manifest_path(snapshot_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise BackupError(f"Снимок {snapshot_id} не найден")
+
+    def create(self, progress=None, min_age: float = None) -> Optional[dict]:
+        """Снять снимок базы; вернуть его манифест.
+
+        min_age — не снимать (вернуть None), если последний снимок моложе min_age секунд:
+        так несколько клиентов по расписанию не дублируют друг друга.
+        """
+        if db.backend != "sqlite":
+            raise BackupError("Инкрементальные снимки доступны только для SQLite; "
+                              "для PostgreSQL используйте бэкап через pg_dump")
+        with self.lock():
+            created = datetime.now()
+            existing = self.snapshots()
+            if min_age is not None:
+                # Снимки «из будущего» (часы переводили назад) не учитываются, иначе расписание встанет
+                ages = ((created - datetime.strptime(manifest["created_at"], self.TIME_FORMAT)).total_seconds()
+                        for manifest in existing)
+                if any(0 <= age < min_age for age in ages):
+                    return None
+            snapshot_id = created.strftime("%Y%m%d_%H%M%S")
+            if any(manifest["id"] == snapshot_id for manifest in existing):
+                snapshot_id += f"_{len(existing)}"
+
+            started = time.perf_counter()
+            copy_path = os.path.join(self.root, f"{snapshot_id}.part.db")
+            try:
+                _copy_sqlite(copy_path, progress)
+                total = os.path.getsize(copy_path)
+                digest = hashlib.sha256()
+                chunks, new_chunks, stored_bytes = [], 0, 0
+                with open(copy_path, "rb") as source:
+                    for data in iter(lambda: source.read(self.chunk_size), b""):
+                        digest.update(data)
+                        chunk_digest = hashlib.sha256(data).hexdigest()
+                        chunks.append(chunk_digest)
+                        path = self._chunk_path(chunk_digest)
+                        if not os.path.exists(path):
+                            stored_bytes += self._write_file(path, zlib.compress(data, 6))
+                            new_chunks += 1
+                        if progress:
+                            progress("Запись блоков", min(len(chunks) * self.chunk_size, total), total)
+            finally:
+                if os.path.exists(copy_path):
+                    os.remove(copy_path)
+
+            manifest = {
+                "id": snapshot_id,
+                "created_at": created.strftime(self.TIME_FORMAT),
+                "size": total,
+                "sha256": digest.hexdigest(),
+                "chunk_size": self.chunk_size,
+                "chunks": chunks,
+                "new_chunks": new_chunks,
+                "stored_bytes": stored_bytes,
+            }
+            self._write_file(self._manifest_path(snapshot_id), json.dumps(manifest, indent=1).encode("utf-8"))
+
+        log_message(f"Создан снимок базы {snapshot_id}: новых блоков {new_chunks} из {len(chunks)}, "
+                    f"записано {stored_bytes / 1024 / 1024:.1f} МБ за {time.perf_counter() - started:.1f} с")
+        return manifest
+
+    def restore(self, snapshot_id: str, target: str, progress=None) -> str:
+        """Собрать файл базы из блоков снимка, проверить хэш и целостность; вернуть путь"""
+        if os.path.exists(DB_FILE) and os.path.exists(target) and os.path.samefile(target, DB_FILE):
+            raise BackupError("Нельзя восстанавливать поверх рабочей базы — выберите другой файл")
+        with self.lock():
+            manifest = self.load(snapshot_id)
+            part = target + ".part"
+            try:
+                digest = hashlib.sha256()
+                with open(part, "wb") as out:
+                    for number, chunk_digest in enumerate(manifest["chunks"], 1):
+                        try:
+                            with open(self._chunk_path(chunk_digest), "rb") as f:
+                                data = zlib.decompress(f.read())
+                        except FileNotFoundError:
+                            raise BackupError(f"В хранилище нет блока {chunk_digest} снимка {snapshot_id}")
+                        except zlib.error:
+                            raise BackupError(f"Блок {chunk_digest} снимка {snapshot_id} поврежден")
+                        if hashlib.sha256(data).hexdigest() != chunk_digest:
+                            raise BackupError(f"Блок {chunk_digest} снимка {snapshot_id} поврежден")
+                        digest.update(data)
+                        out.write(data)
+                        if progress:
+                            progress("Восстановление", number, len(manifest["chunks"]))
+                if digest.hexdigest() != manifest["sha256"]:
+                    raise BackupError(f"Собранный файл не совпадает со снимком {snapshot_id}")
+                _check_sqlite_file(part)
+                os.replace(part, target)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+
+        log_message(f"Снимок базы {snapshot_id} восстановлен в {target}")
+        return target
+
+    def prune(self, keep_hourly: int = BACKUP_KEEP_HOURLY, keep_daily: int = BACKUP_KEEP_DAILY,
+              keep_weekly: int = BACKUP_KEEP_WEEKLY) -> list:
+        """Удалить снимки вне правил хранения и блоки, на которые больше никто не ссылается.
+
+        Хранятся последний снимок и самый новый снимок в каждом из keep_hourly последних часов,
+        keep_daily дней и keep_weekly недель, в которых снимки были. Возвращает id удаленных.
+        """
+        with self.lock():
+            snapshots = self.snapshots()
+            keep = {snapshots[0]["id"]} if snapshots else set()
+            for count, period in ((keep_hourly, "%Y-%m-%d %H"), (keep_daily, "%Y-%m-%d"), (keep_weekly, "%G-%V")):
+                periods = set()
+                for manifest in snapshots:
+                    key = datetime.strptime(manifest["created_at"], self.TIME_FORMAT).strftime(period)
+                    if key not in periods:
+                        if len(periods) >= count:
+                            break
+                        periods.add(key)
+                        keep.add(manifest["id"])
+
+            removed = [manifest["id"] for manifest in snapshots if manifest["id"] not in keep]
+            for snapshot_id in removed:
+                os.remove(self._manifest_path(snapshot_id))
+
+            used = {chunk for manifest in snapshots if manifest["id"] in keep for chunk in manifest["chunks"]}
+            freed = 0
+            if os.path.isdir(self.chunks_dir):
+                for prefix in os.listdir(self.chunks_dir):
+                    directory = os.path.join(self.chunks_dir, prefix)
+                    for name in os.listdir(directory):
+                        if name not in used:
+                            freed += os.path.getsize(os.path.join(directory, name))
+                            os.remove(os.path.join(directory, name))
+
+        if removed or freed:
+            log_message(f"Хранение снимков: удалено снимков {len(removed)}, освобождено {freed / 1024 / 1024:.1f} МБ")
+        return removed
+
+
+class SnapshotScheduler:
+    """Автоматические снимки в фоновом потоке.
+
+    Раз в CHECK_SECONDS поток проверяет, не старше ли последний снимок хранилища interval_minutes,
+    и если да — снимает новый и применяет правила хранения. Срок считается по хранилищу, а не по
+    процессу, поэтому клиенты с общей базой не снимают лишних копий.
+    """
+
+    CHECK_SECONDS = 60
+
+    def __init__(self, store: SnapshotStore, interval_minutes: int = BACKUP_SNAPSHOT_INTERVAL):
+        self.store = store
+        self.interval_minutes = interval_minutes
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval_minutes <= 0 or db.backend != "sqlite" or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Остановить поток; идущий снимок дописывается (но не дольше timeout)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_due(self) -> Optional[dict]:
+        """Снять снимок, если подошел срок; вернуть его манифест или None"""
+        manifest = self.store.create(min_age=self.interval_minutes * 60)
+        if manifest is not None:
+            self.store.prune()
+        return manifest
+
+    def _run(self):
+        while not self._stop.wait(self.CHECK_SECONDS):
+            try:
+                self.run_due()
+            except (BackupError, OSError, *DB_ERRORS) as e:
+                log_message(f"Автоматический снимок базы не создан: {e}")
+
+
+snapshot_store = SnapshotStore()
+
+
+# ======================= ФОНОВЫЕ ЗАПРОСЫ =======================
+class DbJob:
+    """Запрос, отправленный в фоновый поток; cancel() — результат не будет доставлен.
+
+    Чтение, еще не начатое, снимается с очереди; подтвержденное пользователем изменение
+    (write) выполняется в любом случае, отменяется только доставка результата.
+    """
+
+    def __init__(self, owner, on_done, on_error, key, write=False):
+        self.owner = owner
+        self.window = owner.winfo_toplevel()
+        self.on_done = on_done
+        self.on_error = on_error
+        self.key = key
+        self.write = write
+        self.future = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None and not self.write:
+            self.future.cancel()
+
+
+class DbExecutor:
+    """Работа с БД вне потока Tk: чтения — в пуле потоков, изменения — последовательно в одном потоке.
+
+    Результаты возвращаются через очередь, которую главный поток разбирает по after(); колбэки
+    вызываются в главном потоке. Закрытие окна отменяет его запросы. Пока у окна есть
+    незавершенные запросы, у него курсор ожидания.
+    """
+
+    POLL_MS = 25
+
+    def __init__(self, workers: int = DB_WORKERS):
+        self.workers = workers
+        self._read_pool = None
+        self._write_pool = None
+        self._results = queue.Queue()
+        self._poller = None
+        self._poll_id = None
+        self._pending = set()
+        self._latest = {}  # ключ -> последний запрос с этим ключом
+        self._busy = {}  # окно -> число незавершенных запросов
+        self._watched = set()  # окна, у которых отслеживается закрытие
+
+    def submit(self, owner, func, *args, on_done=None, on_error=None, key=None, write=False) -> DbJob:
+        """Выполнить func(*args) в фоне. Новый запрос с тем же key отменяет предыдущий."""
+        if self._read_pool is None:
+            self._read_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db-read")
+            self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+        job = DbJob(owner, on_done, on_error, key, write)
+        if key is not None:
+            previous = self._latest.get(key)
+            if previous is not None:
+                previous.cancel()
+            self._latest[key] = job
+        self._pending.add(job)
+        self._set_busy(job.window, 1)
+
+        pool = self._write_pool if write else self._read_pool
+        job.future = pool.submit(func, *args)
+        job.future.add_done_callback(lambda future: self._results.put(job))
+
+        self._poller = owner
+        if self._poll_id is None:
+            self._poll_id = owner.after(self.POLL_MS, self._poll)
+        return job
+
+    def cancel_window(self, window):
+        """Отменить запросы окна: результаты закрытого диалога уже никому не нужны"""
+        for job in list(self._pending):
+            if job.window is window:
+                job.cancel()
+
+    def shutdown(self):
+        # Непрочитанные чтения больше не нужны, а изменения из очереди доводятся до конца
+        if self._read_pool is not None:
+            self._read_pool.shutdown(wait=True, cancel_futures=True)
+        if self._write_pool is not None:
+            self._write_pool.shutdown(wait=True)
+        self._read_pool = self._write_pool = None
+
+    def _set_busy(self, window, delta):
+        if window not in self._busy:
+            self._busy[window] = 0
+            window.configure(cursor="watch")
+            if window not in self._watched:
+                self._watched.add(window)
+                window.bind("<Destroy>", lambda e: self._on_destroy(e, window), add="+")
+        self._busy[window] += delta
+        if self._busy[window] <= 0:
+            del self._busy[window]
+            window.configure(cursor="")
+
+    def _on_destroy(self, event, window):
+        if event.widget is window:
+            self._watched.discard(window)
+            self._busy.pop(window, None)
+            self.cancel_window(window)
+
+    def _poll(self):
+        self._poll_id = None
+        while not self._results.empty():
+            self._deliver(self._results.get())
+        if self._pending:
+            try:
+                self._poll_id = self._poller.after(self.POLL_MS, self._poll)
+            except tk.TclError:
+                # Окно, через которое шел опрос, закрыто — продолжаем через любое живое
+                alive = next((job.owner for job in self._pending if self._alive(job.owner)), None)
+                if alive is not None:
+                    self._poller = alive
+                    self._poll_id = alive.after(self.POLL_MS, self._poll)
+
+    @staticmethod
+    def _alive(widget):
+        try:
+            return bool(widget.winfo_exists())
+        except tk.TclError:
+            return False
+
+    def _deliver(self, job):
+        self._pending.discard(job)
+        if job.key is not None and self._latest.get(job.key) is job:
+            del self._latest[job.key]
+        if job.window in self._busy:
+            self._set_busy(job.window, -1)
+        if job.cancelled or not self._alive(job.owner):
+            # Ошибку изменения, которое уже некому показать, хотя бы записываем в журнал
+            if job.write and not job.future.cancelled() and job.future.exception() is not None:
+                log_message(f"Ошибка фонового изменения в БД: {job.future.exception()}")
+            return
+
+        error = job.future.exception()
+        if error is None:
+            if job.on_done is not None:
+                job.on_done(job.future.result())
+        elif job.on_error is not None:
+            job.on_error(error)
+        else:
+            log_message(f"Ошибка фонового запроса к БД: {error}")
+
+
+db_executor = DbExecutor()
+
+
+# ======================= ПОИСК =======================
+def normalize_search_text(text) -> str:
+    """Нормализация для поиска: без учета регистра, «ё» и «е» не различаются"""
+    return str(text or "").casefold().replace("ё", "е")
+
+
+class ContractSearchIndex:
+    """Индекс фильтра договоров в памяти: нормализованный текст строки и триграммы -> id договоров.
+
+    Совпадение — вхождение подстроки в «номер наименование контрагент отдел», как и раньше;
+    триграммы лишь сужают круг кандидатов, поэтому каждый кандидат проверяется по тексту.
+    """
+
+    NGRAM = 3
+    FIELDS = (1, 2, 3, 6)  # номер, наименование, контрагент, отдел
+
+    def __init__(self):
+        self._rows = {}  # id -> строка договора
+        self._texts = {}  # id -> нормализованный текст
+        self._postings = {}  # триграмма -> set(id)
+        self._rank = {}  # id -> позиция в списке договоров
+        self._top_rank = 0
+        self._last_query = None
+        self._last_keys = None
+        # Поиск может идти в фоновом потоке планировщика, пока главный поток обновляет индекс
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @classmethod
+    def _grams(cls, text):
+        return {text[i:i + cls.NGRAM] for i in range(len(text) - cls.NGRAM + 1)}
+
+    def _reset_last(self):
+        self._last_query = self._last_keys = None
+
+    def update(self, row):
+        """Добавить или переиндексировать один договор; новый считается самым свежим"""
+        key = row[0]
+        with self._lock:
+            if self._rows.get(key) == row:
+                return
+            self.remove(key)
+            text = normalize_search_text(" ".join(str(row[i] or "") for i in self.FIELDS))
+            self._rows[key] = row
+            self._texts[key] = text
+            for gram in self._grams(text):
+                self._postings.setdefault(gram, set()).add(key)
+            if key not in self._rank:
+                self._top_rank -= 1
+                self._rank[key] = self._top_rank
+            self._reset_last()
+
+    def remove(self, key):
+        with self._lock:
+            text = self._texts.pop(key, None)
+            if text is None:
+                return
+            del self._rows[key]
+            for gram in self._grams(text):
+                keys = self._postings[gram]
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+            self._reset_last()
+
+    def load(self, rows):
+        """Синхронизировать индекс со списком договоров: переиндексируются только изменившиеся строки"""
+        with self._lock:
+            keys = set()
+            for row in rows:
+                keys.add(row[0])
+                self.update(row)
+            for key in self._rows.keys() - keys:
+                self.remove(key)
+            self._rank = {row[0]: position for position, row in enumerate(rows)}
+            self._top_rank = 0
+            self._reset_last()
+
+    def search(self, query: str) -> list:
+        """Строки договоров, содержащих query, в порядке исходного списка"""
+        query = normalize_search_text(query).strip()
+        with self._lock:
+            if not query:
+                return sorted(self._rows.values(), key=lambda row: self._rank[row[0]])
+
+            if self._last_query is not None and self._last_query in query:
+                # Запрос уточнился: результат может только сузиться
+                candidates = self._last_keys
+            elif len(query) >= self.NGRAM:
+                postings = sorted((self._postings.get(gram, ()) for gram in self._grams(query)), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:]) if postings[0] else ()
+            else:
+                candidates = self._texts.keys()
+
+            texts = self._texts
+            keys = [key for key in candidates if query in texts[key]]
+            if candidates is not self._last_keys:
+                keys.sort(key=self._rank.__getitem__)
+            self._last_query, self._last_keys = query, keys
+            return [self._rows[key] for key in keys]
+
+
+class SearchScheduler:
+    """Запуск фильтра по мере ввода: нажатия клавиш копятся delay_ms, устаревшие запросы отменяются.
+
+    search(text) выполняется в главном потоке, а при size() >= thread_threshold — в фоновом;
+    apply(text, result) всегда вызывается в главном потоке и только для последнего запроса.
+    """
+
+    POLL_MS = 15
+
+    def __init__(self, widget, search, apply, size=None, delay_ms=SEARCH_DEBOUNCE_MS,
+                 thread_threshold=SEARCH_THREAD_THRESHOLD):
+        self.widget = widget
+        self.search = search
+        self.apply = apply
+        self.size = size
+        self.delay_ms = delay_ms
+        self.thread_threshold = thread_threshold
+        self._generation = 0  # номер последнего запроса; результаты других номеров отбрасываются
+        self._applied = None  # текст, результат которого сейчас на экране
+        self._after_id = None
+        self._poll_id = None
+        self._pending = None  # номер запроса, отданного фоновому потоку
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._worker = None
+        widget.bind("<Destroy>", lambda e: self.close() if e.widget is widget else None, add="+")
+
+    def schedule(self, text: str):
+        """Отложить фильтр до паузы в наборе"""
+        self._generation += 1
+        self._cancel_timer()
+        self._after_id = self.widget.after(self.delay_ms, self._start, self._generation, text)
+
+    def flush(self, text: str):
+        """Применить запрос сразу (Enter): повторно не считается, если он уже на экране"""
+        if self._after_id is None and text == self._applied:
+            return
+        self.run_now(text)
+
+    def run_now(self, text: str):
+        """Синхронно отфильтровать и применить, отменив все отложенные и фоновые запросы"""
+        self._generation += 1
+        self._cancel_timer()
+        self._finish(text, self.search(text))
+
+    def close(self):
+        self._generation += 1
+        self._cancel_timer()
+        if self._poll_id is not None:
+            self.widget.after_cancel(self._poll_id)
+            self._poll_id = None
+        if self._worker is not None:
+            self._jobs.put(None)
+            self._worker = None
+
+    def _cancel_timer(self):
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _finish(self, text, result):
+        self._applied = text
+        self.apply(text, result)
+
+    def _start(self, generation, text):
+        self._after_id = None
+        if generation != self._generation:
+            return
+        if self.size is None or self.size() < self.thread_threshold:
+            self._finish(text, self.search(text))
+            return
+
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, name="contracts-search", daemon=True)
+            self._worker.start()
+        self._pending = generation
+        self._jobs.put((generation, text))
+        if self._poll_id is None:
+            self._poll_id = self.widget.after(self.POLL_MS, self._poll)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            # В очереди важен только последний запрос
+            while job is not None and not self._jobs.empty():
+                job = self._jobs.get()
+            if job is None:
+                return
+            generation, text = job
+            if generation != self._generation:
+                continue
+            try:
+                result = self.search(text)
+            except Exception as e:
+                log_message(f"Ошибка фонового поиска: {e}")
+                result = None
+            self._results.put((generation, text, result))
+
+    def _poll(self):
+        self._poll_id = None
+        while not self._results.empty():
+            generation, text, result = self._results.get()
+            if generation == self._generation:
+                self._pending = None
+                if result is not None:
+                    self._finish(text, result)
+        # Ждем, пока фоновый поток посчитает последний запрос
+        if self._pending == self._generation:
+            self._poll_id = self.widget.after(self.POLL_MS, self._poll)
+
+
+SEARCH_PAGE_SIZE = 50
+# Границы найденных слов во фрагменте: управляющие символы STX/ETX в тексте документов не встречаются
+SEARCH_MARKS = ("\x02", "\x03")
+SEARCH_KIND_NAMES = {"contract": "Договор", "comment": "Комментарий", "organization": "Организация",
+                     "audit": "Журнал"}
+
+# Документы полнотекстового поиска в PostgreSQL: выражения совпадают с GIN-индексами миграции 2
+PG_SEARCH_DOCUMENTS = {
+    "contract": "translate(coalesce(c.contract_number, '') || ' ' || coalesce(c.title, '') || ' ' || "
+                "coalesce(c.department, ''), 'ёЁ', 'еЕ')",
+    "comment": "translate(coalesce(t.comment, ''), 'ёЁ', 'еЕ')",
+    "organization": "translate(coalesce(o.name, '') || ' ' || coalesce(o.inn, '') || ' ' || coalesce(o.kpp, '') || ' ' || "
+                    "coalesce(o.ogrn, '') || ' ' || coalesce(o.legal_address, '') || ' ' || "
+                    "coalesce(o.phone, '') || ' ' || coalesce(o.email, ''), 'ёЁ', 'еЕ')",
+    "audit": "translate(coalesce(a.action, '') || ' ' || coalesce(a.details, ''), 'ёЁ', 'еЕ')",
+}
+
+# Окончания, которые отбрасываются у слов запроса в SQLite (в FTS5 нет русского стеммера):
+# по оставшейся основе ищутся все словоформы
+RUSSIAN_ENDINGS = sorted((
+    "иями", "ями", "ами", "ией", "иях", "ях", "ах", "ов", "ев", "ей", "ий", "ый", "ой", "ая", "яя", "ое", "ее",
+    "ые", "ие", "ых", "их", "ым", "им", "ом", "ем", "ую", "юю", "ия", "ья", "ью", "ам", "ям", "ого", "его",
+    "ому", "ему", "ыми", "ими", "а", "я", "ы", "и", "у", "ю", "о", "е", "ь",
+), key=len, reverse=True)
+
+# Источники поиска: вид -> (псевдоним, FTS5-таблица, таблицы, заголовок результата, id договора)
+SEARCH_SOURCES = {
+    "contract": ("c", "contracts_fts", "contracts c", "c.contract_number || ' — ' || c.title", "c.id"),
+    "comment": ("t", "task_comments_fts",
+                "approval_tasks t JOIN approval_instances i ON i.id = t.instance_id "
+                "JOIN contracts c ON c.id = i.contract_id",
+                "c.contract_number || ' — ' || coalesce(t.role_name, '')", "c.id"),
+    "organization": ("o", "organizations_fts", "organizations o", "o.name", None),
+    "audit": ("a", "audit_log_fts", "audit_log a", "coalesce(a.action, '')", None),
+}
+
+
+def _search_terms(query: str) -> list:
+    return re.findall(r"\w+", normalize_search_text(query))
+
+
+def _russian_stem(term: str) -> str:
+    """Грубая основа русского слова: без окончания, но не короче трех букв"""
+    if len(term) < 5 or not re.fullmatch(r"[а-я]+", term):
+        return term
+    for ending in RUSSIAN_ENDINGS:
+        if term.endswith(ending) and len(term) - len(ending) >= 3:
+            return term[:-len(ending)]
+    return term
+
+
+def _search_source_sql(kind: str) -> str:
+    """Запрос к одному источнику поиска (один параметр — поисковое выражение)"""
+    alias, fts, tables, title, contract_id = SEARCH_SOURCES[kind]
+    # Символы меток передаются выражениями СУБД, чтобы текст запроса оставался печатным
+    start, end = (ord(mark) for mark in SEARCH_MARKS)
+    head = f"SELECT '{kind}' AS kind, {alias}.id AS id, {contract_id or 'NULL'} AS contract_id, {title} AS title"
+    if db.backend == "postgres":
+        document = PG_SEARCH_DOCUMENTS[kind]
+        return f'''{head},
+               ts_headline('russian', {document}, q,
+                           'StartSel=' || chr({start}) || ', StopSel=' || chr({end})
+                           || ', MaxWords=20, MinWords=6, MaxFragments=1') AS snippet,
+               -ts_rank(to_tsvector('russian', {document}), q) AS score
+        FROM {tables}, to_tsquery('russian', ?) q
+        WHERE to_tsvector('russian', {document}) @@ q'''
+    return f'''{head},
+               snippet({fts}, -1, char({start}), char({end}), '…', 12) AS snippet, bm25({fts}) AS score
+        FROM {fts}, {tables}
+        WHERE {fts} MATCH ? AND {alias}.id = {fts}.rowid'''
+
+
+def snippet_parts(snippet: Optional[str]) -> list:
+    """Фрагмент результата поиска по частям: [(текст, найденное ли слово)]"""
+    start, end = SEARCH_MARKS
+    parts = re.split(f"({re.escape(start)}|{re.escape(end)})", snippet or "")
+    result, matched = [], False
+    for part in parts:
+        if part in SEARCH_MARKS:
+            matched = part == start
+        elif part:
+            result.append((part, matched))
+    return result
+
+
+def search_documents(query: str, user_id, department, see_all: bool, kinds=None,
+                     limit: int = SEARCH_PAGE_SIZE, offset: int = 0) -> list:
+    """Полнотекстовый поиск по договорам, комментариям согласования, организациям и журналу действий.
+
+    Возвращает строки (kind, id, contract_id, title, snippet, score) по убыванию релевантности;
+    найденные слова во фрагменте обрамлены SEARCH_MARKS. Каждое слово запроса ищется как префикс.
+    Организации и журнал доступны только тем, кто видит все договоры.
+    """
+    terms = _search_terms(query)
+    if not terms:
+        return []
+    if db.backend == "postgres":
+        # Номера вида «Д-2025-001» и адреса почты парсер PostgreSQL разбирает как составные слова,
+        # поэтому в запрос они передаются целиком, а не по частям
+        words = [word.strip(".-@") for word in re.findall(r"[\w.@-]+", normalize_search_text(query))]
+        match = " & ".join(f"{word}:*" for word in words if word)
+    else:
+        match = " ".join(f'"{_russian_stem(term)}"*' for term in terms)
+
+    parts, params = [], []
+    visibility, visibility_params = _contracts_visibility(user_id, department, see_all)
+    for kind, (_, _, _, _, contract_id) in SEARCH_SOURCES.items():
+        if kinds and kind not in kinds:
+            continue
+        if contract_id is None and not see_all:
+            continue
+        sql = _search_source_sql(kind)
+        params.append(match)
+        if contract_id and visibility:
+            sql += " AND " + " AND ".join(visibility)
+            params += visibility_params
+        parts.append(sql)
+    if not parts:
+        return []
+
+    sql = " UNION ALL ".join(parts) + " ORDER BY score, kind, id LIMIT ? OFFSET ?"
+    return db.fetchall(sql, params + [int(limit), int(offset)])
+
+
+# ======================= ДИАЛОГ ПОЛНОТЕКСТОВОГО ПОИСКА =======================
+class SearchDialog(TextShortcutsMixin):
+    """Поиск по договорам, комментариям, организациям и журналу с постраничной выдачей"""
+
+    def __init__(self, parent, user_id, department, see_all, on_open_contract):
+        super().__init__()
+        self.user_id = user_id
+        self.department = department
+        self.see_all = see_all
+        self.on_open_contract = on_open_contract
+        self.query = ""
+        self.results = {}  # iid -> строка результата
+
+        self.win = tk.Toplevel(parent)
+        self.win.title("Полнотекстовый поиск")
+        self.win.geometry("900x600")
+        self.win.transient(parent)
+
+        self.create_widgets()
+        center_window(self.win)
+        self.query_entry.focus_set()
+
+    def create_widgets(self):
+        main_frame = ttk.Frame(self.win, padding=15)
+        main_frame.pack(fill="both", expand=True)
+
+        query_frame = ttk.Frame(main_frame)
+        query_frame.pack(fill="x", pady=(0, 10))
+
+        self.query_var = tk.StringVar()
+        self.query_entry = ttk.Entry(query_frame, textvariable=self.query_var)
+        self.query_entry.pack(side="left", fill="x", expand=True)
+        self.query_entry.bind("<Return>", lambda e: self.run_search())
+        self.setup_text_shortcuts(self.query_entry)
+        ttk.Button(query_frame, text="🔎 Найти", command=self.run_search).pack(side="left", padx=(5, 0))
+
+        tree_frame = ttk.Frame(main_frame)
+        tree_frame.pack(fill="both", expand=True)
+
+        columns = ("kind", "title", "snippet")
+        self.results_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=15)
+        for col, header, width in zip(columns, ["Тип", "Объект", "Фрагмент"], [110, 250, 480]):
+            self.results_tree.heading(col, text=header)
+            self.results_tree.column(col, width=width)
+
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.results_tree.yview)
+        self.results_tree.configure(yscrollcommand=scrollbar.set)
+        self.results_tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        self.results_tree.bind("<<TreeviewSelect>>", lambda e: self.show_preview())
+        self.results_tree.bind("<Double-1>", lambda e: self.open_selected())
+
+        # Фрагмент с подсветкой найденных слов
+        self.preview = tk.Text(main_frame, height=4, wrap="word", state="disabled")
+        self.preview.tag_configure("match", background="#fff2a8")
+        self.preview.pack(fill="x", pady=(10, 0))
+
+        bottom = ttk.Frame(main_frame)
+        bottom.pack(fill="x", pady=(10, 0))
+        self.status_label = ttk.Label(bottom, text="")
+        self.status_label.pack(side="left")
+        ttk.Button(bottom, text="Закрыть", command=self.win.destroy).pack(side="right")
+        self.more_button = ttk.Button(bottom, text="Показать ещё", command=self.load_more, state="disabled")
+        self.more_button.pack(side="right", padx=5)
+
+    def run_search(self):
+        self.query = self.query_var.get().strip()
+        self.results.clear()
+        self.results_tree.delete(*self.results_tree.get_children())
+        self.load_more()
+
+    def load_more(self):
+        if not self.query:
+            self.status_label.config(text="")
+            self.more_button.config(state="disabled")
+            return
+        self.more_button.config(state="disabled")
+        # Новый поиск (тот же ключ) отменяет доставку страницы предыдущего
+        db_executor.submit(self.results_tree, functools.partial(search_documents, offset=len(self.results)),
+                           self.query, self.user_id, self.department, self.see_all, key=("search", id(self)),
+                           on_done=self.show_page, on_error=self.on_search_error)
+
+    def on_search_error(self, e):
+        log_message(f"Ошибка полнотекстового поиска: {e}")
+        messagebox.showerror("Ошибка", f"Не удалось выполнить поиск: {e}", parent=self.win)
+
+    def show_page(self, rows):
+        for row in rows:
+            kind, _, _, title, snippet, _ = row
+            parts = snippet_parts(snippet)
+            iid = self.results_tree.insert("", "end", values=(
+                SEARCH_KIND_NAMES[kind], title or "", " ".join("".join(text for text, _ in parts).split())))
+            self.results[iid] = row
+
+        self.status_label.config(text=f"Найдено: {len(self.results)}")
+        self.more_button.config(state="normal" if len(rows) == SEARCH_PAGE_SIZE else "disabled")
+
+    def show_preview(self):
+        selection = self.results_tree.selection()
+        self.preview.config(state="normal")
+        self.preview.delete("1.0", tk.END)
+        if selection:
+            for text, matched in snippet_parts(self.results[selection[0]][4]):
+                self.preview.insert(tk.END, text, ("match",) if matched else ())
+        self.preview.config(state="disabled")
+
+    def open_selected(self):
+        selection = self.results_tree.selection()
+        if not selection:
+            return
+        contract_id = self.results[selection[0]][2]
+        if contract_id is not None:
+            self.on_open_contract(contract_id)
+
+
 # ======================= ДИАЛОГ УПРАВЛЕНИЯ ОРГАНИЗАЦИЯМИ =======================
 class OrganizationManagementDialog(TextShortcutsMixin):
     def __init__(self, parent):
@@ -1231,7 +5373,7 @@ class OrganizationManagementDialog(TextShortcutsMixin):
 
         # ИСПРАВЛЕНО: Правильный порядок колонок
         columns = ("id", "name", "type", "inn", "kpp", "ogrn", "legal_address", "phone", "email")
-        self.organizations_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=20)
+        self.organizations_tree = VirtualTreeview(tree_frame, columns=columns, show="headings", height=20)
 
         # ИСПРАВЛЕНО: Правильные заголовки с email
         headers = ["ID", "Название", "Тип", "ИНН", "КПП", "ОГРН", "Юридический адрес", "Телефон", "Email"]
@@ -1316,39 +5458,30 @@ class OrganizationManagementDialog(TextShortcutsMixin):
         tree.bind("<Button-5>", anyhide, add="+")
 
     def load_organizations(self):
-        for item in self.organizations_tree.get_children():
-            self.organizations_tree.delete(item)
-
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT id, name, organization_type, inn, kpp, ogrn, legal_address, phone, email
-                FROM organizations 
-                ORDER BY name
-            ''')
-            organizations = cur.fetchall()
-            conn.close()
-
-            for org in organizations:
-                org_id, name, org_type, inn, kpp, ogrn, address, phone, email = org
-                org_type_display = "Юрлицо" if org_type == "legal" else "ИП"
-
-                # ИСПРАВЛЕНО: Правильный порядок вставки данных
-                self.organizations_tree.insert("", "end", values=(
-                    org_id,
-                    name,
-                    org_type_display,
-                    inn or "",
-                    kpp or "",
-                    ogrn or "",
-                    address or "",
-                    phone or "",
-                    email or ""  # Теперь email будет в правильном столбце
-                ))
-
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить организации: {e}")
+        db_executor.submit(self.organizations_tree, list_organizations, key="organizations",
+                           on_done=self.show_organizations, on_error=lambda e: messagebox.showerror(
+                               "Ошибка", f"Не удалось загрузить организации: {e}", parent=self.win))
+
+    def show_organizations(self, organizations):
+        rows = []
+        for org in organizations:
+            org_id, name, org_type, inn, kpp, ogrn, address, phone, email = org
+            org_type_display = "Юрлицо" if org_type == "legal" else "ИП"
+
+            # ИСПРАВЛЕНО: Правильный порядок вставки данных
+            rows.append(((
+                org_id,
+                name,
+                org_type_display,
+                inn or "",
+                kpp or "",
+                ogrn or "",
+                address or "",
+                phone or "",
+                email or ""  # Теперь email будет в правильном столбце
+            ), ()))
+
+        self.organizations_tree.set_rows(rows)
 
     def add_organization(self):
         self._show_organization_dialog()
@@ -1362,17 +5495,14 @@ class OrganizationManagementDialog(TextShortcutsMixin):
         item = self.organizations_tree.item(selection[0])
         org_id = item['values'][0]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM organizations WHERE id = ?", (org_id,))
-            organization = cur.fetchone()
-            conn.close()
-
-            self._show_organization_dialog(organization)
+        def on_error(e):
+            if isinstance(e, WorkflowError):
+                messagebox.showwarning("Внимание", str(e), parent=self.win)
+            else:
+                messagebox.showerror("Ошибка", f"Не удалось загрузить данные организации: {e}", parent=self.win)
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить данные организации: {e}")
+        db_executor.submit(self.win, get_organization, org_id, key="organization",
+                           on_done=self._show_organization_dialog, on_error=on_error)
 
     def delete_organization(self):
         selection = self.organizations_tree.selection()
@@ -1383,38 +5513,32 @@ class OrganizationManagementDialog(TextShortcutsMixin):
         item = self.organizations_tree.item(selection[0])
         org_id, name, inn = item['values'][0:3]
 
-        # Проверяем, используется ли организация в договорах
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM contracts WHERE counterparty = ?", (org_id,))
-            contract_count = cur.fetchone()[0]
-            conn.close()
+        def on_removed(_result):
+            messagebox.showinfo("Успех", "Организация удалена", parent=self.win)
+            self.load_organizations()
 
+        def on_remove_error(e):
+            if isinstance(e, WorkflowError):
+                messagebox.showwarning("Внимание", str(e), parent=self.win)
+            else:
+                messagebox.showerror("Ошибка", f"Не удалось удалить организацию: {e}", parent=self.win)
+
+        # Проверяем, используется ли организация в договорах
+        def on_count(contract_count):
             if contract_count > 0:
                 messagebox.showwarning("Внимание",
-                                       f"Организация '{name}' используется в {contract_count} договоре(ах).\n" "Удаление невозможно.")
+                                       f"Организация '{name}' используется в {contract_count} договоре(ах).\n" "Удаление невозможно.",
+                                       parent=self.win)
                 return
+            if messagebox.askyesno("Подтверждение",
+                                   f"Удалить организацию '{name}' (ИНН: {inn})?\n\n" "Внимание: Это действие нельзя отменить.",
+                                   parent=self.win):
+                db_executor.submit(self.win, remove_organization, org_id, write=True,
+                                   on_done=on_removed, on_error=on_remove_error)
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Ошибка проверки использования организации: {e}")
-            return
-
-        if messagebox.askyesno("Подтверждение",
-                               f"Удалить организацию '{name}' (ИНН: {inn})?\n\n" "Внимание: Это действие нельзя отменить."):
-            try:
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-                cur.execute("DELETE FROM organizations WHERE id = ?", (org_id,))
-                conn.commit()
-                conn.close()
-
-                messagebox.showinfo("Успех", "Организация удалена")
-                self.load_organizations()
-                log_message(f"Удалена организация: {name} (ИНН: {inn})")
-
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось удалить организацию: {e}")
+        db_executor.submit(self.win, organization_contract_count, org_id, key="organization", on_done=on_count,
+                           on_error=lambda e: messagebox.showerror(
+                               "Ошибка", f"Ошибка проверки использования организации: {e}", parent=self.win))
 
     def _show_organization_dialog(self, organization=None):
         dialog = tk.Toplevel(self.win)
@@ -1539,78 +5663,30 @@ class OrganizationManagementDialog(TextShortcutsMixin):
             email_input = email_entry.get().strip()
             current_org_type = org_type_var.get()  # переименовано из org_type
 
-            if not name_input or not inn_input:
-                messagebox.showwarning("Внимание", "Заполните обязательные поля (Название и ИНН)")
-                return
-
-            # Проверка ИНН в зависимости от типа организации
-            if not validate_inn(inn_input, current_org_type):
-                if current_org_type == "legal":
-                    messagebox.showwarning("Внимание",
-                                           "Неверный формат ИНН для юридического лица. Должно быть 10 или 12 цифр.")
-                else:
-                    messagebox.showwarning("Внимание", "Неверный формат ИНН для ИП. Должно быть 12 цифр.")
-                return
-
-            # Проверка КПП (только для Юр. Лиц)
-            if current_org_type == "legal" and kpp_input and not validate_kpp(kpp_input):
-                messagebox.showwarning("Внимание", "КПП должен содержать 9 цифр")
-                return
-
-            # Проверка ОГРН/ОГРНИП
-            if ogrn_input and not validate_ogrn(ogrn_input, current_org_type):
-                if current_org_type == "legal":
-                    messagebox.showwarning("Внимание", "Неверный формат ОГРН. Должно быть 13 цифр.")
-                else:
-                    messagebox.showwarning("Внимание", "Неверный формат ОГРНИП. Должно быть 15 цифр.")
-                return
-
-            # Проверка телефона
-            if phone_input and not validate_phone(phone_input):
-                messagebox.showwarning("Внимание", "Телефон должен быть в формате: +7 (xxx) xxx-xxxx")
+            error = validate_organization(name_input, current_org_type, inn_input, kpp_input, ogrn_input,
+                                          phone_input, email_input)
+            if error:
+                messagebox.showwarning("Внимание", error)
                 return
 
-            # Проверка email
-            if email_input and not validate_email(email_input):
-                messagebox.showwarning("Внимание", "Неверный формат email адреса")
-                return
+            def on_done(_org_id):
+                action_msg = "Организация обновлена" if organization else "Организация создана"
 
-            try:
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-
-                if organization:
-                    # Обновление существующей организации
-                    cur.execute('''
-                        UPDATE organizations 
-                        SET name=?, organization_type=?, inn=?, kpp=?, ogrn=?, legal_address=?, phone=?, email=?
-                        WHERE id=?
-                    ''', (name_input, current_org_type, inn_input, kpp_input or None, ogrn_input or None,
-                          address_input or None, phone_input or None, email_input or None,
-                          organization[0]))
-                    action_msg = "Организация обновлена"
-                else:
-                    # Создание новой организации
-                    cur.execute('''
-                        INSERT INTO organizations (name, organization_type, inn, kpp, ogrn, legal_address, phone, email)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (name_input, current_org_type, inn_input, kpp_input or None, ogrn_input or None,
-                          address_input or None, phone_input or None, email_input or None))
-                    action_msg = "Организация создана"
-
-                conn.commit()
-                conn.close()
-
-                messagebox.showinfo("Успех", action_msg)
+                messagebox.showinfo("Успех", action_msg, parent=self.win)
                 self.load_organizations()
                 dialog.destroy()
-                log_message(
-                    f"{action_msg}: {name_input} (ИНН: {inn_input}, Тип: {'Юрлицо' if current_org_type == 'legal' else 'ИП'})")
 
-            except sqlite3.IntegrityError:
-                messagebox.showerror("Ошибка", "Организация с таким ИНН уже существует")
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось сохранить организацию: {e}")
+            def on_error(e):
+                if isinstance(e, WorkflowError):
+                    messagebox.showwarning("Внимание", str(e), parent=dialog)
+                elif isinstance(e, DB_INTEGRITY_ERRORS):
+                    messagebox.showerror("Ошибка", "Организация с таким ИНН уже существует", parent=dialog)
+                else:
+                    messagebox.showerror("Ошибка", f"Не удалось сохранить организацию: {e}", parent=dialog)
+
+            db_executor.submit(dialog, store_organization, organization[0] if organization else None, name_input,
+                               current_org_type, inn_input, kpp_input, ogrn_input, address_input, phone_input,
+                               email_input, write=True, on_done=on_done, on_error=on_error)
 
         # Кнопки
         button_frame = ttk.Frame(main_frame)
@@ -1668,14 +5744,11 @@ class LoginDialog(TextShortcutsMixin):
                                        width=35)
         self.user_combo.pack(pady=(0, 15))
 
-        # Заполняем список пользователей
-        users = get_active_users_with_roles()
-        if users:
-            self.user_combo['values'] = [f"{u[1]} ({u[2]}) - {u[4] or 'Общий'}" for u in users]
-            self.user_combo.current(0)
-        else:
-            self.user_combo['values'] = ["Нет активных пользователей"]
-            self.user_combo.current(0)
+        # Список пользователей загружается в фоне
+        self.user_combo['values'] = ["Загрузка..."]
+        self.user_combo.current(0)
+        db_executor.submit(self.win, get_active_users_with_roles, on_done=self.show_users,
+                           on_error=self.show_db_error)
 
         # Поле пароля
         ttk.Label(main_frame, text="Пароль:", style='Login.TLabel').pack(anchor="w", pady=(0, 5))
@@ -1692,8 +5765,9 @@ class LoginDialog(TextShortcutsMixin):
         btn_frame = ttk.Frame(main_frame, style='Login.TFrame')
         btn_frame.pack(pady=10)
 
-        ttk.Button(btn_frame, text="Войти", command=self.login,
-                   style='Login.TButton', width=12).pack(side="left", padx=5)
+        self.login_button = ttk.Button(btn_frame, text="Войти", command=self.login,
+                                       style='Login.TButton', width=12)
+        self.login_button.pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Отмена", command=self.on_close,
                    style='Login.TButton', width=12).pack(side="left", padx=5)
 
@@ -1702,41 +5776,48 @@ class LoginDialog(TextShortcutsMixin):
         # Центрируем окно после создания всех элементов
         center_window(self.win)
 
+    def show_users(self, users):
+        if users:
+            self.user_combo['values'] = [f"{u[1]} ({u[2]}) - {u[4] or 'Общий'}" for u in users]
+        else:
+            self.user_combo['values'] = ["Нет активных пользователей"]
+        self.user_combo.current(0)
+
+    def show_db_error(self, error):
+        self.msg_label.config(text="Ошибка подключения к базе данных")
+        self.login_button.config(state="normal")
+        log_message(f"Ошибка при входе: {error}")
+
     def login(self):
+        if str(self.login_button.cget("state")) == "disabled":
+            return
         selected = self.user_var.get()
         password = self.entry_pass.get()
 
-        if not selected or not password:
+        if not selected or not password or "(" not in selected:
             self.msg_label.config(text="Выберите пользователя и введите пароль")
             return
 
         # Извлекаем логин из выбранного значения
         login = selected.split("(")[1].split(")")[0]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT id, full_name, password, department FROM users WHERE username = ? AND is_active = 1",
-                (login,)
-            )
-            user = cur.fetchone()
-            conn.close()
-
-            if user and hash_password(password) == user[2]:
-                user_id, full_name, _, department = user
-                roles = get_user_roles(user_id)
+        def on_result(user):
+            if user:
+                user_id, full_name, roles, department = user
 
                 self.result = (user_id, full_name, roles, department)
                 log_message(f"Успешный вход пользователя: {full_name} ({login})")
                 self.win.destroy()
             else:
+                self.login_button.config(state="normal")
                 self.msg_label.config(text="Неверный пароль")
                 log_message(f"Неудачная попытка входа: {login}")
 
-        except sqlite3.Error as e:
-            self.msg_label.config(text="Ошибка подключения к базе данных")
-            log_message(f"Ошибка при входе: {e}")
+        # Кнопка блокируется до ответа, чтобы повторное нажатие не отправило второй запрос
+        self.login_button.config(state="disabled")
+        self.msg_label.config(text="")
+        db_executor.submit(self.win, authenticate_user, login, password, on_done=on_result,
+                           on_error=self.show_db_error, key="login")
 
     def on_close(self):
         self.result = None
@@ -1744,8 +5825,23 @@ class LoginDialog(TextShortcutsMixin):
 
 
 # ======================= ОСНОВНОЕ ПРИЛОЖЕНИЕ =======================
-def _get_contract_tag_with_deadline(status, deadline):
-    """Определить тег для цветового кодирования договора с учетом дедлайна"""
+def parse_deadline(value):
+    """Дедлайн из БД («ГГГГ-ММ-ДД ЧЧ:ММ[:СС]») в метку времени или None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+DEADLINE_WARNING_SECONDS = 259200  # 3 дня до дедлайна договора — желтый
+DEADLINE_URGENT_SECONDS = 86400  # 24 часа — оранжевый
+TASK_URGENT_SECONDS = 2 * 86400  # задача срочная, если до дедлайна меньше двух суток
+
+
+def _get_contract_tag_with_deadline(status, deadline_ts, now):
+    """Определить тег для цветового кодирования договора с учетом дедлайна (метки времени)"""
     if not status:
         return ''
 
@@ -1760,22 +5856,18 @@ def _get_contract_tag_with_deadline(status, deadline):
     if status_normalized in ['отклонён', 'отклонен', 'rejected']:
         return 'rejected'
 
-    # Если договор на согласовании и есть дедлайн
-    if status_normalized == 'на согласовании' and deadline:
-        try:
-            deadline_dt = datetime.strptime(deadline, '%Y-%m-%d %H:%M:%S')
-            current_dt = datetime.now()
-
-            if current_dt > deadline_dt:
-                return 'overdue'  # Просрочен - красный
-            elif (deadline_dt - current_dt).total_seconds() <= 86400:  # 24 часа
-                return 'urgent'  # Срочный - оранжевый
-            elif (deadline_dt - current_dt).total_seconds() <= 259200:  # 3 дня
-                return 'warning'  # Предупреждение - желтый
-            else:
-                return 'pending'  # Стандартный цвет для согласования
-        except ValueError:
+    # Если договор на согласовании и есть дедлайн
+    if status_normalized == 'на согласовании':
+        if deadline_ts is None:
             return 'pending'
+        remaining = deadline_ts - now
+        if remaining < 0:
+            return 'overdue'  # Просрочен - красный
+        elif remaining <= DEADLINE_URGENT_SECONDS:
+            return 'urgent'  # Срочный - оранжевый
+        elif remaining <= DEADLINE_WARNING_SECONDS:
+            return 'warning'  # Предупреждение - желтый
+        return 'pending'  # Стандартный цвет для согласования
 
     # Для договоров не на согласовании используем стандартные теги
     if status_normalized == 'согласован':
@@ -1784,6 +5876,91 @@ def _get_contract_tag_with_deadline(status, deadline):
     return 'pending'
 
 
+def _get_task_tag(status, deadline_ts, now):
+    """Определить тег для цветового кодирования задачи согласования"""
+    # ПРИОРИТЕТ: сначала проверяем статус отклонения
+    if status in ('rejected', 'Отклонён', 'Отклонен', 'cancelled'):
+        return 'cancelled'
+    if status == 'pending' and deadline_ts is not None:
+        if now > deadline_ts:
+            return 'overdue'
+        if deadline_ts - now < TASK_URGENT_SECONDS:
+            return 'urgent'
+    return ''
+
+
+def _contract_tag_transitions(status, deadline_ts):
+    """Моменты, когда меняется цвет договора (с запасом в секунду после границы)"""
+    if deadline_ts is None or str(status or '').strip().lower() != 'на согласовании':
+        return ()
+    return (deadline_ts - DEADLINE_WARNING_SECONDS, deadline_ts - DEADLINE_URGENT_SECONDS, deadline_ts + 1)
+
+
+def _task_tag_transitions(status, deadline_ts):
+    if deadline_ts is None or status != 'pending':
+        return ()
+    return (deadline_ts - TASK_URGENT_SECONDS + 1, deadline_ts + 1)
+
+
+class DeadlineScheduler:
+    """Таймер дедлайнов: куча ближайших моментов смены цвета строк и один after() на самый ранний.
+
+    on_due(kind, ids) вызывается, когда для строк вида kind («contract», «task») наступил такой момент.
+    """
+
+    MAX_DELAY_MS = 3600 * 1000  # дальние сроки перепроверяются раз в час (сон, перевод часов)
+
+    def __init__(self, widget, on_due):
+        self.widget = widget
+        self.on_due = on_due
+        self._heap = []  # (момент, вид, id)
+        self._after_id = None
+        self._due_at = None
+
+    def reset(self, kind, transitions):
+        """Заменить моменты строк одного вида: transitions — пары (id, метка времени)"""
+        now = time.time()
+        self._heap = [entry for entry in self._heap if entry[1] != kind]
+        self._heap.extend((at, kind, key) for key, at in transitions if at > now)
+        heapq.heapify(self._heap)
+        self._schedule()
+
+    def close(self):
+        self._heap = []
+        self._cancel()
+
+    def _cancel(self):
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = self._due_at = None
+
+    def _schedule(self):
+        if not self._heap:
+            self._cancel()
+            return
+        due_at = self._heap[0][0]
+        if self._after_id is not None and self._due_at == due_at:
+            return
+        self._cancel()
+        delay_ms = min(max(int((due_at - time.time()) * 1000) + 1, 0), self.MAX_DELAY_MS)
+        self._due_at = due_at
+        self._after_id = self.widget.after(delay_ms, self._fire)
+
+    def _fire(self):
+        self._after_id = self._due_at = None
+        now = time.time()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, kind, key = heapq.heappop(self._heap)
+            due.setdefault(kind, set()).add(key)
+        for kind, keys in due.items():
+            try:
+                self.on_due(kind, keys)
+            except Exception as e:
+                log_message(f"Ошибка обработки дедлайнов: {e}")
+        self._schedule()
+
+
 class CalendarDialog:
     """Диалог выбора даты и времени"""
 
@@ -2027,8 +6204,8 @@ class FastlandApp(TextShortcutsMixin):
         self.full_name = full_name
         self.roles = roles
         self.department = department
-        self.is_admin = "Администратор" in roles
-        self.is_director = any(role in ["Генеральный директор", "Коммерческий директор"] for role in roles)
+        self.is_admin = is_admin_role(roles)
+        self.is_director = is_director_role(roles)
         self._exiting = False  # Добавляем флаг выхода
 
         # Инициализация атрибутов UI
@@ -2040,6 +6217,7 @@ class FastlandApp(TextShortcutsMixin):
         self.search_entry = None
         self._search_placeholder = None
         self._search_has_placeholder = None
+        self._search_scheduler = None
         self._contracts_tree_frame = None
         self.contracts_tree = None
         self.tasks_tree = None
@@ -2049,6 +6227,9 @@ class FastlandApp(TextShortcutsMixin):
         # --- для резиновой верстки таблицы договоров: веса колонок (сумма ≈ 1.0)
         self.contracts_col_weights = [0.06, 0.12, 0.34, 0.16, 0.10, 0.10, 0.06, 0.06]
         self._all_contracts = []  # кэш всех договоров (tuple rows) для фильтрации
+        self._contract_deadlines = {}  # id договора -> (статус, метка времени дедлайна)
+        self._task_deadlines = {}  # id задачи -> (статус, метка времени дедлайна)
+        self._contracts_index = ContractSearchIndex()
 
         self.root.title(f"Система управления договорами — {full_name} ({department})")
 
@@ -2064,98 +6245,43 @@ class FastlandApp(TextShortcutsMixin):
         # Устанавливаем обработчик закрытия окна
         self.root.protocol("WM_DELETE_WINDOW", self.confirm_exit)
 
+        # Цвета строк меняются ровно в моменты пересечения границ дедлайнов
+        self._deadline_scheduler = DeadlineScheduler(self.root, self._on_deadlines_due)
+
         self.setup_styles()
         self.create_ui()
         self.load_contracts()
         self.load_tasks()
 
-        # Запускаем периодическую проверку дедлайнов
-        self.check_deadlines_periodically()
+        # Уведомления о задачах, просроченных пока приложение было закрыто
+        self.check_task_deadlines()
 
         log_message(f"Запущено приложение для пользователя: {full_name}")
 
-    def check_deadlines_periodically(self):
-        """Периодическая проверка дедлайнов каждые 5 минут"""
-        # Проверяем, существует ли еще приложение
-        if hasattr(self, 'root') and self.root.winfo_exists():
-            self.check_task_deadlines()
-            self.update_contract_colors()  # ОБНОВЛЯЕМ ЦВЕТА ДОГОВОРОВ
-            self.root.after(300000, self.check_deadlines_periodically)  # 5 минут
+    def _on_deadlines_due(self, kind, ids):
+        """Перекрасить только строки, у которых наступила граница дедлайна"""
+        now = time.time()
+        if kind == "contract":
+            deadlines = self._contract_deadlines
+            self.contracts_tree.set_tags({
+                contract_id: (_get_contract_tag_with_deadline(*deadlines[contract_id], now),)
+                for contract_id in ids if contract_id in deadlines})
+        elif kind == "task":
+            deadlines = self._task_deadlines
+            tags = {task_id: (_get_task_tag(*deadlines[task_id], now),) for task_id in ids if task_id in deadlines}
+            self.tasks_tree.set_tags(tags)
+            if ('overdue',) in tags.values():
+                self.check_task_deadlines()
 
     def check_task_deadlines(self):
-        """Проверка просроченных задач и отправка уведомлений"""
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            # Находим просроченные задачи
-            cur.execute('''
-                SELECT t.id, t.assigned_user_id, u.full_name, c.contract_number, 
-                       t.role_name, t.deadline_at
-                FROM approval_tasks t
-                JOIN users u ON t.assigned_user_id = u.id
-                JOIN approval_instances i ON t.instance_id = i.id
-                JOIN contracts c ON i.contract_id = c.id
-                WHERE t.status = 'pending' AND t.deadline_at < datetime('now') 
-                AND t.deadline_notified = 0
-            ''')  # Использовать SQL функцию вместо переменной
-
-            overdue_tasks = cur.fetchall()
-
-            for task in overdue_tasks:
-                task_id, user_id, user_name, contract_number, role, deadline = task
-                message = f"ПРОСРОЧЕНА задача по договору {contract_number}\nРоль: {role}\nДедлайн: {deadline[:16]}"
-
-                # Помечаем задачу как уведомленную
-                cur.execute('''
-                    UPDATE approval_tasks SET deadline_notified = 1 WHERE id = ?
-                ''', (task_id,))
-
-                log_message(f"Уведомление о просрочке отправлено пользователю {user_name}: {message}")
-
-            conn.commit()
-            conn.close()
-
-            # Перезагружаем задачи для обновления цветов
-            self.load_tasks()
-
-        except sqlite3.Error as e:
-            log_message(f"Ошибка проверки дедлайнов: {e}")
+        """Проверка просроченных задач и отправка уведомлений (в потоке записи)"""
+        def on_done(notified):
+            # Таблица задач перечитывается, только если что-то действительно просрочилось
+            if notified:
+                self.load_tasks()
 
-    def update_task_colors(self):
-        """Обновление цветов задач в зависимости от статуса дедлайна"""
-        try:
-            for item in self.tasks_tree.get_children():
-                values = self.tasks_tree.item(item)['values']
-                if len(values) >= 6:
-                    task_id, contract_number, title, step, role, status = values[:6]
-
-                    # Сбрасываем теги
-                    self.tasks_tree.item(item, tags=())
-
-                    # ПРИОРИТЕТ: сначала проверяем статус отклонения
-                    if status == 'rejected' or status == 'Отклонён' or status == 'Отклонен':
-                        self.tasks_tree.item(item, tags=('cancelled',))
-                    elif status == 'cancelled':
-                        self.tasks_tree.item(item, tags=('cancelled',))
-                    elif status == 'pending':
-                        # Логика для pending задач с дедлайнами
-                        if len(values) >= 7:
-                            deadline_str = values[6]
-                            if deadline_str and deadline_str != "Не указан":
-                                try:
-                                    deadline_dt = datetime.strptime(deadline_str, '%Y-%m-%d %H:%M:%S')
-                                    current_dt = datetime.now()
-
-                                    if current_dt > deadline_dt:
-                                        self.tasks_tree.item(item, tags=('overdue',))
-                                    elif (deadline_dt - current_dt).days <= 1:
-                                        self.tasks_tree.item(item, tags=('urgent',))
-                                except ValueError:
-                                    pass
-
-        except Exception as e:
-            log_message(f"Ошибка обновления цветов задач: {e}")
+        db_executor.submit(self.root, notify_overdue_tasks, write=True, on_done=on_done,
+                           on_error=lambda e: log_message(f"Ошибка проверки дедлайнов: {e}"))
 
     @staticmethod
     def setup_styles():
@@ -2314,6 +6440,7 @@ class FastlandApp(TextShortcutsMixin):
             ("📂 Открыть файл", self.open_contract_file),
             ("✅ На согласование", self.send_for_approval),
             ("📊 Статус", self.show_approval_status),
+            ("🔎 Поиск", self.open_search),
             ("🔄 Обновить", self.load_contracts)
         ]
 
@@ -2344,7 +6471,7 @@ class FastlandApp(TextShortcutsMixin):
                 self.search_entry.insert(0, self._search_placeholder)
                 self._search_has_placeholder = True
                 # При установке placeholder показываем ВСЕ договоры
-                self.apply_contracts_filter("")
+                self._search_scheduler.flush("")
 
         def clear_placeholder(_event=None):
             if self._search_has_placeholder:
@@ -2364,23 +6491,29 @@ class FastlandApp(TextShortcutsMixin):
         self.search_entry.bind("<FocusIn>", clear_placeholder)
         self.search_entry.bind("<FocusOut>", on_focus_out)
 
+        # Фильтр запускается после паузы в наборе, а не на каждое изменение текста
+        self._search_scheduler = SearchScheduler(
+            self.search_entry,
+            lambda text: self._contracts_index.search(text) if text else self._all_contracts,
+            self.apply_contracts_filter,
+            size=lambda: len(self._contracts_index))
+
         # Реагируем на изменение текста поиска (trace)
         def on_search_var(*args):
             search_text = self.search_var.get()
             if self._search_has_placeholder:
                 # Если есть placeholder, игнорируем изменения
                 return
-            self.apply_contracts_filter(search_text.strip())
+            self._search_scheduler.schedule(search_text.strip())
 
         # trace variable
         self.search_var.trace_add("write", on_search_var)
 
-        # Обработчик нажатия Enter в поле поиска
+        # Enter применяет набранный запрос без ожидания паузы
         def on_search_enter(_event=None):
             if self._search_has_placeholder:
                 return
-            search_text = self.search_var.get().strip()
-            self.apply_contracts_filter(search_text)
+            self._search_scheduler.flush(self.search_var.get().strip())
 
         self.search_entry.bind("<Return>", on_search_enter)
 
@@ -2393,7 +6526,8 @@ class FastlandApp(TextShortcutsMixin):
 
         columns = ("id", "number", "title", "counterparty", "amount", "status", "department", "file_path", "priority",
                    "deadline")
-        self.contracts_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=20)
+        self.contracts_tree = VirtualTreeview(tree_frame, columns=columns, show="headings", height=20,
+                                              selectmode="extended")
 
         headers = ["ID", "Номер", "Наименование", "Контрагент", "Сумма", "Статус", "Отдел", "Файл", "Приоритет",
                    "Дедлайн"]
@@ -2434,58 +6568,59 @@ class FastlandApp(TextShortcutsMixin):
         # Привязка события изменения размера главного окна
         self.root.bind("<Configure>", lambda e: self._adjust_contracts_columns())
 
-    def apply_contracts_filter(self, filter_text: str):
-        """Применить фильтр к списку договоров (self._all_contracts)."""
+    def apply_contracts_filter(self, filter_text: str, contracts=None):
+        """Применить фильтр к списку договоров (self._all_contracts).
+
+        contracts — уже отфильтрованные строки (их передает планировщик поиска)."""
         # Проверяем, существует ли дерево договоров
         if not hasattr(self, 'contracts_tree') or not self.contracts_tree.winfo_exists():
             return
 
-        # Если placeholder виден и текст равен подсказке — считаем пустым
-        if not filter_text:
-            # показываем всё
-            for item in self.contracts_tree.get_children():
-                self.contracts_tree.delete(item)
-            for contract in self._all_contracts:
-                contract_id, number, title, counterparty, amount, status, dept, file_path, priority, deadline = contract
-                formatted_amount = format_amount(amount)
-                file_display = os.path.basename(file_path) if file_path else ""
-                deadline_display = deadline[:16] if deadline else ""
-
-                # Определяем тег для цвета с учетом дедлайна
-                tag = _get_contract_tag_with_deadline(status, deadline)
-
-                self.contracts_tree.insert("", "end", values=(
-                    contract_id, number, title, counterparty or "",
-                    formatted_amount, status, dept or "", file_display,
-                    self._get_priority_display(priority), deadline_display
-                ), tags=(tag,))
-            return
-
-        query = filter_text.lower()
-        # удаляем текущие записи
-        for item in self.contracts_tree.get_children():
-            self.contracts_tree.delete(item)
-
-        for contract in self._all_contracts:
+        # ищем соответствие по номеру, названию, контрагенту или отделу через индекс
+        if contracts is None:
+            contracts = self._contracts_index.search(filter_text) if filter_text else self._all_contracts
+        now = time.time()
+        deadlines = self._contract_deadlines
+        rows = []
+        for contract in contracts:
             contract_id, number, title, counterparty, amount, status, dept, file_path, priority, deadline = contract
-            # ищем соответствие по номеру, названию, контрагенту или отделу
-            haystack = f"{number or ''} {title or ''} {counterparty or ''} {dept or ''}".lower()
-            if query in haystack:
-                formatted_amount = format_amount(amount)
-                file_display = os.path.basename(file_path) if file_path else ""
-                deadline_display = deadline[:16] if deadline else ""
-
-                # Определяем тег для цвета с учетом дедлайна
-                tag = _get_contract_tag_with_deadline(status, deadline)
-
-                self.contracts_tree.insert("", "end", values=(
-                    contract_id, number, title, counterparty or "",
-                    formatted_amount, status, dept or "", file_display,
-                    self._get_priority_display(priority), deadline_display
-                ), tags=(tag,))
-
-        # После применения фильтра обновляем цвета
-        self.update_contract_colors()
+            formatted_amount = format_amount(amount)
+            file_display = os.path.basename(file_path) if file_path else ""
+            deadline_display = deadline[:16] if deadline else ""
+
+            # Определяем тег для цвета с учетом дедлайна
+            tag = _get_contract_tag_with_deadline(status, deadlines[contract_id][1], now)
+
+            rows.append(((
+                contract_id, number, title, counterparty or "",
+                formatted_amount, status, dept or "", file_display,
+                self._get_priority_display(priority), deadline_display
+            ), (tag,)))
+
+        # В виджет попадают только видимые строки, остальные живут в модели таблицы
+        self.contracts_tree.set_rows(rows)
+
+    def open_search(self):
+        SearchDialog(self.root, self.user_id, self.department, self.is_admin or self.is_director,
+                     self.select_contract)
+
+    def select_contract(self, contract_id):
+        """Показать договор в таблице, при необходимости сбросив фильтр"""
+        iid = str(contract_id)
+        if not self.contracts_tree.exists(iid) and not self._search_has_placeholder:
+            self.search_var.set("")
+            self._search_scheduler.run_now("")
+
+        def show():
+            if self.contracts_tree.exists(iid):
+                self.contracts_tree.selection_set(iid)
+                self.contracts_tree.see(iid)
+
+        if self.contracts_tree.exists(iid):
+            show()
+        else:
+            # Договор мог появиться после последней загрузки списка
+            self.load_contracts(then=show)
 
     @staticmethod
     def _get_priority_display(priority):
@@ -2508,68 +6643,6 @@ class FastlandApp(TextShortcutsMixin):
             return 'pending'
         return ''
 
-    def update_contract_colors(self):
-        """Обновление цветов договоров в зависимости от статуса дедлайна"""
-        # Проверяем, существует ли дерево договоров
-        if not hasattr(self, 'contracts_tree') or not self.contracts_tree.winfo_exists():
-            return
-
-        try:
-            current_time = datetime.now()
-
-            for item in self.contracts_tree.get_children():
-                values = self.contracts_tree.item(item)['values']
-                if len(values) >= 10:  # Проверяем, что есть все значения
-                    contract_id, number, title, counterparty, amount, status, dept, file_display, priority, deadline_str = values
-
-                    # Нормализуем статус
-                    status_normalized = str(status).strip().lower() if status else ''
-
-                    # ОТКЛОНЕННЫЕ договоры - красный цвет (высший приоритет)
-                    if status_normalized in ['отклонён', 'отклонен', 'rejected']:
-                        self.contracts_tree.item(item, tags=('rejected',))
-                        continue
-
-                    # Черновики - прозрачный цвет (без тега)
-                    if status_normalized == 'черновик':
-                        self.contracts_tree.item(item, tags=())
-                        continue
-
-                    # Если договор на согласовании и есть дедлайн
-                    if status_normalized == 'на согласовании' and deadline_str and deadline_str.strip():
-                        try:
-                            # Преобразуем строку дедлайна в datetime
-                            try:
-                                deadline_dt = datetime.strptime(deadline_str, '%Y-%m-%d %H:%M:%S')
-                            except ValueError:
-                                deadline_dt = datetime.strptime(deadline_str, '%Y-%m-%d %H:%M')
-
-                            if current_time > deadline_dt:
-                                # Просроченный договор - красный цвет
-                                self.contracts_tree.item(item, tags=('overdue',))
-                            elif (deadline_dt - current_time).total_seconds() <= 86400:  # 24 часа
-                                # Скоро дедлайн - оранжевый цвет
-                                self.contracts_tree.item(item, tags=('urgent',))
-                            elif (deadline_dt - current_time).total_seconds() <= 259200:  # 3 дня
-                                # Приближается дедлайн - желтый цвет
-                                self.contracts_tree.item(item, tags=('warning',))
-                            else:
-                                # Все в порядке - стандартный цвет для статуса "На согласовании"
-                                self.contracts_tree.item(item, tags=('pending',))
-                        except ValueError as e:
-                            # Если ошибка получения даты
-                            log_message(f"Ошибка получения даты для договора {number}: {e}")
-                            self.contracts_tree.item(item, tags=('pending',))
-                    else:
-                        # Для договоров не на согласовании используем стандартные теги
-                        if status_normalized == 'согласован':
-                            self.contracts_tree.item(item, tags=('approved',))
-                        else:
-                            self.contracts_tree.item(item, tags=('pending',))
-
-        except Exception as e:
-            log_message(f"Ошибка обновления цветов договоров: {e}")
-
     def _adjust_contracts_columns(self):
         """Перерасчёт ширин колонок таблицы договоров на основе размеров контейнера и весов."""
         try:
@@ -2612,7 +6685,8 @@ class FastlandApp(TextShortcutsMixin):
         tree_frame.pack(fill="both", expand=True)
 
         columns = ("id", "contract_number", "title", "step", "role", "status", "deadline")
-        self.tasks_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=20)
+        self.tasks_tree = VirtualTreeview(tree_frame, columns=columns, show="headings", height=20,
+                                          selectmode="extended")
 
         headers = ["ID", "Договор", "Наименование", "Этап", "Роль", "Статус", "Дедлайн"]
         widths = [50, 100, 250, 80, 120, 100, 120]
@@ -2645,33 +6719,20 @@ class FastlandApp(TextShortcutsMixin):
         item = self.tasks_tree.item(selection[0])
         task_id = item['values'][0]  # ID задачи
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            # Получаем contract_id через instance_id и затем файл договора
-            cur.execute('''
-                SELECT c.file_path 
-                FROM contracts c
-                JOIN approval_instances i ON c.id = i.contract_id
-                JOIN approval_tasks t ON i.id = t.instance_id
-                WHERE t.id = ?
-            ''', (task_id,))
-
-            result = cur.fetchone()
-            conn.close()
-
-            if result and result[0]:
-                file_path = result[0]
+        def on_done(file_path):
+            if file_path:
                 if open_file(file_path):
                     log_message(f"Открыт файл договора для задачи {task_id}: {file_path}")
             else:
                 messagebox.showinfo("Информация", "Для договора в выбранной задаче файл не прикреплен")
 
-        except sqlite3.Error as e:
+        def on_error(e):
             messagebox.showerror("Ошибка", f"Не удалось открыть файл договора: {e}")
             log_message(f"Ошибка открытия файла договора для задачи {task_id}: {e}")
 
+        db_executor.submit(self.tasks_tree, task_contract_file_path, task_id, key="contract_file",
+                           on_done=on_done, on_error=on_error)
+
     def on_task_double_click(self, event):
         """Обработчик двойного клика по задаче - открывает файл договора"""
         item = self.tasks_tree.identify('item', event.x, event.y)
@@ -2690,126 +6751,96 @@ class FastlandApp(TextShortcutsMixin):
             ("👥 Управление пользователями", self.manage_users),
             ("🔄 Сбросить базу данных", self.reset_database),
             ("💾 Создать бэкап", self.create_backup),
+            ("🗂 Снимки базы", self.manage_snapshots),
             ("📊 Статистика системы", self.show_statistics)
         ]
 
         for text, command in admin_buttons:
             ttk.Button(content, text=text, command=command, width=25).pack(pady=5)
 
-    def load_contracts(self):
-        """Загружает все договора и кэширует их, сохраняя текущий фильтр поиска"""
+    def load_contracts(self, then=None):
+        """Загружает все договора в фоне и кэширует их, сохраняя текущий фильтр поиска.
+
+        then() вызывается, когда новые данные уже в таблице."""
         # Проверяем, существует ли еще дерево договоров
         if not hasattr(self, 'contracts_tree') or not self.contracts_tree.winfo_exists():
             return
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
+        def fetch():
             # Директора видят все договоры
-            if self.is_admin or self.is_director:
-                cur.execute('''
-                    SELECT c.id, c.contract_number, c.title, 
-                           o.name as counterparty_name, 
-                           c.amount, c.status, c.department, 
-                           c.file_path, c.priority, c.deadline_at
-                    FROM contracts c
-                    LEFT JOIN organizations o ON c.counterparty = o.id
-                    ORDER BY c.created_at DESC
-                ''')
-            else:
-                cur.execute('''
-                    SELECT c.id, c.contract_number, c.title, 
-                           o.name as counterparty_name, 
-                           c.amount, c.status, c.department, 
-                           c.file_path, c.priority, c.deadline_at
-                    FROM contracts c
-                    LEFT JOIN organizations o ON c.counterparty = o.id
-                    WHERE c.owner_id = ? OR c.department = ? OR c.status = 'На согласовании'
-                    ORDER BY c.created_at DESC
-                ''', (self.user_id, self.department))
-
-            contracts = cur.fetchall()
-            conn.close()
-
-            # Сохраняем весь набор для последующей фильтрации
-            self._all_contracts = contracts
-
-            # Получаем текущий текст поиска
-            search_text = ""
-            if hasattr(self, 'search_var') and self.search_var and not self._search_has_placeholder:
-                search_text = self.search_var.get().strip()
-
-            # Применяем фильтр (если есть) к обновленным данным
-            self.apply_contracts_filter(search_text)
-
-            # После загрузки выставляем колонки и цвета корректно
-            self._adjust_contracts_columns()
-            self.update_contract_colors()
+            contracts = fetch_contracts(self.user_id, self.department, self.is_admin or self.is_director)
+            # Дедлайны разбираются один раз на загрузку, раскраска дальше работает с метками времени
+            deadlines = {contract[0]: (contract[5], parse_deadline(contract[9])) for contract in contracts}
+            return contracts, deadlines
 
-        except sqlite3.Error as e:
-            # Проверяем, существует ли еще главное окно
-            if hasattr(self, 'root') and self.root.winfo_exists():
-                messagebox.showerror("Ошибка", f"Не удалось загрузить договоры: {e}")
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось загрузить договоры: {e}")
             log_message(f"Ошибка загрузки договоров: {e}")
 
+        db_executor.submit(self.contracts_tree, fetch, key="contracts", on_error=on_error,
+                           on_done=lambda result: self._show_contracts(*result, then=then))
+
+    def _show_contracts(self, contracts, deadlines, then=None):
+        # Сохраняем весь набор для последующей фильтрации
+        self._all_contracts = contracts
+        self._contracts_index.load(contracts)
+        self._contract_deadlines = deadlines
+        self._deadline_scheduler.reset("contract", (
+            (contract_id, at) for contract_id, (status, deadline_ts) in deadlines.items()
+            for at in _contract_tag_transitions(status, deadline_ts)))
+
+        # Получаем текущий текст поиска
+        search_text = ""
+        if hasattr(self, 'search_var') and self.search_var and not self._search_has_placeholder:
+            search_text = self.search_var.get().strip()
+
+        # Применяем фильтр (если есть) к обновленным данным; отложенные запросы к старому списку отменяются
+        self._search_scheduler.run_now(search_text)
+
+        # После загрузки выставляем ширину колонок (цвета уже рассчитаны фильтром)
+        self._adjust_contracts_columns()
+        if then is not None:
+            then()
+
     def refresh_contracts_with_filter(self):
         """Обновить договоры с сохранением текущего фильтра"""
         self.load_contracts()  # Теперь load_contracts сам сохраняет фильтр
 
     def load_tasks(self):
-        for item in self.tasks_tree.get_children():
-            self.tasks_tree.delete(item)
+        """Загружает задачи в фоне; строки и теги готовятся там же"""
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            if self.is_admin:
-                cur.execute('''
-                    SELECT t.id, c.contract_number, c.title, t.step_order, t.role_name, 
-                           t.status, t.deadline_at, c.file_path
-                    FROM approval_tasks t
-                    JOIN approval_instances i ON t.instance_id = i.id
-                    JOIN contracts c ON i.contract_id = c.id
-                    LEFT JOIN organizations o ON c.counterparty = o.id
-                    WHERE t.status = 'pending' AND c.status != 'Согласован'
-                    ORDER BY t.deadline_at
-                ''')
-            else:
-                cur.execute('''
-                    SELECT t.id, c.contract_number, c.title, t.step_order, t.role_name, 
-                           t.status, t.deadline_at, c.file_path  -- ДОБАВЛЯЕМ file_path
-                    FROM approval_tasks t
-                    JOIN approval_instances i ON t.instance_id = i.id
-                    JOIN contracts c ON i.contract_id = c.id
-                    WHERE t.assigned_user_id = ? AND t.status = 'pending' AND c.status != 'Согласован'
-                    ORDER BY t.deadline_at
-                ''', (self.user_id,))
-
-            tasks = cur.fetchall()
-            conn.close()
+        def fetch():
+            tasks = fetch_tasks(self.user_id, self.is_admin)
 
+            now = time.time()
+            rows = []
+            deadlines = {}
             for task in tasks:
                 task_id, number, title_text, step_num, role, status, deadline, file_path = task
                 deadline_str = deadline[:16] if deadline else "Не указан"
-
-                # Вставляем в таблицу только необходимые для отображения данные
-                self.tasks_tree.insert("", "end", values=(
-                    task_id, number, title_text, step_num, role, status, deadline_str
-                ))
-
-            # Обновляем цвета после загрузки
-            self.update_task_colors()
-
-        except sqlite3.Error as e:
+                deadline_ts = parse_deadline(deadline)
+                deadlines[task_id] = (status, deadline_ts)
+
+                # В таблицу попадают только необходимые для отображения данные
+                rows.append(((task_id, number, title_text, step_num, role, status, deadline_str),
+                             (_get_task_tag(status, deadline_ts, now),)))
+            return rows, deadlines
+
+        def on_done(result):
+            rows, self._task_deadlines = result
+            self.tasks_tree.set_rows(rows)
+            self._deadline_scheduler.reset("task", (
+                (task_id, at) for task_id, (status, deadline_ts) in self._task_deadlines.items()
+                for at in _task_tag_transitions(status, deadline_ts)))
+
+        def on_error(e):
             messagebox.showerror("Ошибка", f"Не удалось загрузить задачи: {e}")
             log_message(f"Ошибка загрузки задач: {e}")
 
+        db_executor.submit(self.tasks_tree, fetch, key="tasks", on_done=on_done, on_error=on_error)
+
     def create_contract(self):
-        dialog = ContractDialog(self.root, self.user_id, self.department)
-        self.root.wait_window(dialog.win)
-        self.load_contracts()
+        ContractDialog(self.root, self.user_id, self.department, on_saved=self.load_contracts)
 
     def edit_contract(self):
         selection = self.contracts_tree.selection()
@@ -2820,39 +6851,31 @@ class FastlandApp(TextShortcutsMixin):
         item = self.contracts_tree.item(selection[0])
         contract_id = item['values'][0]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM contracts WHERE id = ?", (contract_id,))
-            contract = cur.fetchone()
-
-            if contract:
-                contract_status = contract[5]  # Статус договора
-
-                # Если договор согласован, сбрасываем статус на Черновик
-                if contract_status == 'Согласован':
-                    if messagebox.askyesno("Подтверждение",
-                                           "Договор уже согласован. Редактирование приведет к сбросу статуса в 'Черновик' и потребует нового согласования. Продолжить?"):
-                        cur.execute('''
-                            UPDATE contracts SET status = 'Черновик', updated_at = CURRENT_TIMESTAMP
-                            WHERE id = ?
-                        ''', (contract_id,))
-                        conn.commit()
-                        # Перезагружаем договор с обновленным статусом
-                        cur.execute("SELECT * FROM contracts WHERE id = ?", (contract_id,))
-                        contract = cur.fetchone()
-                        log_message(f"Договор {contract[1]} сброшен в статус 'Черновик' для редактирования")
-                    else:
-                        conn.close()
-                        return
+        def open_dialog(contract):
+            # Без wait_window: колбэк исполнителя не должен запускать вложенный цикл событий
+            ContractDialog(self.root, self.user_id, self.department, contract, on_saved=self.load_contracts)
 
-                conn.close()
-                dialog = ContractDialog(self.root, self.user_id, self.department, contract)
-                self.root.wait_window(dialog.win)
-                self.load_contracts()
+        def on_reset(contract):
+            self.load_contracts()
+            open_dialog(contract)
+
+        def on_loaded(contract):
+            # Если договор согласован, сбрасываем статус на Черновик
+            if contract[5] != 'Согласован':
+                open_dialog(contract)
+            elif messagebox.askyesno("Подтверждение",
+                                     "Договор уже согласован. Редактирование приведет к сбросу статуса в 'Черновик' и потребует нового согласования. Продолжить?"):
+                db_executor.submit(self.contracts_tree, reset_contract_to_draft, contract_id, write=True,
+                                   on_done=on_reset, on_error=on_error)
+
+        def on_error(e):
+            if isinstance(e, WorkflowError):
+                messagebox.showwarning("Внимание", str(e))
+            else:
+                messagebox.showerror("Ошибка", f"Не удалось загрузить данные договора: {e}")
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить данные договора: {e}")
+        db_executor.submit(self.contracts_tree, get_contract, contract_id, key="contract",
+                           on_done=on_loaded, on_error=on_error)
 
     def delete_contract(self):
         selection = self.contracts_tree.selection()
@@ -2863,20 +6886,18 @@ class FastlandApp(TextShortcutsMixin):
         item = self.contracts_tree.item(selection[0])
         contract_id, number, title_text = item['values'][0:3]
 
-        if messagebox.askyesno("Подтверждение", f"Удалить договор '{number} - {title_text}'?"):
-            try:
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-                cur.execute("DELETE FROM contracts WHERE id = ?", (contract_id,))
-                conn.commit()
-                conn.close()
+        if not messagebox.askyesno("Подтверждение", f"Удалить договор '{number} - {title_text}'?"):
+            return
 
-                messagebox.showinfo("Успех", "Договор удален")
-                self.load_contracts()
-                log_message(f"Удален договор: {number}")
+        def on_done(_):
+            messagebox.showinfo("Успех", "Договор удален")
+            self.load_contracts()
 
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось удалить договор: {e}")
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось удалить договор: {e}")
+
+        db_executor.submit(self.contracts_tree, remove_contract, contract_id, number, write=True,
+                           on_done=on_done, on_error=on_error)
 
     def open_contract_file(self):
         selection = self.contracts_tree.selection()
@@ -2887,24 +6908,20 @@ class FastlandApp(TextShortcutsMixin):
         item = self.contracts_tree.item(selection[0])
         contract_id = item['values'][0]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT file_path FROM contracts WHERE id = ?", (contract_id,))
-            result = cur.fetchone()
-            conn.close()
-
-            if result and result[0]:
-                file_path = result[0]
+        def on_done(file_path):
+            if file_path:
                 if open_file(file_path):
                     log_message(f"Открыт файл договора {contract_id}: {file_path}")
             else:
                 messagebox.showinfo("Информация", "Для выбранного договора файл не прикреплен")
 
-        except sqlite3.Error as e:
+        def on_error(e):
             messagebox.showerror("Ошибка", f"Не удалось открыть файл: {e}")
             log_message(f"Ошибка открытия файла договора {contract_id}: {e}")
 
+        db_executor.submit(self.contracts_tree, contract_file_path, contract_id, key="contract_file",
+                           on_done=on_done, on_error=on_error)
+
     def on_contract_double_click(self, event):
         item = self.contracts_tree.identify('item', event.x, event.y)
         if item:
@@ -2997,59 +7014,31 @@ class FastlandApp(TextShortcutsMixin):
             priority = priority_var.get()
             datetime_str = datetime_display.get().strip()
 
-            if priority == "custom" and not datetime_str:
-                messagebox.showwarning("Внимание", "Для ручного ввода необходимо выбрать дату и время")
-                return
-
             try:
                 # Формируем полную дату-время
-                if priority == "custom":
-                    deadline_dt = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-                else:
-                    days = 3 if priority == "standard" else 1
-                    deadline_dt = datetime.now() + timedelta(days=days)
-                    deadline_dt = deadline_dt.replace(hour=18, minute=0, second=0)
-
-                deadline_str = deadline_dt.strftime('%Y-%m-%d %H:%M:%S')
-
-                # Проверяем что дедлайн в будущем
-                if deadline_dt <= datetime.now():
-                    messagebox.showwarning("Внимание", "Дедлайн должен быть в будущем")
-                    return
-
-                # Сохраняем в базу данных
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-
-                cur.execute('''
-                    UPDATE contracts 
-                    SET priority = ?, deadline_at = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (priority, deadline_str, contract_id))
-
-                # Обновляем дедлайны всех активных задач для этого договора
-                cur.execute('''
-                    UPDATE approval_tasks 
-                    SET deadline_at = ?, deadline_notified = 0
-                    WHERE instance_id IN (
-                        SELECT id FROM approval_instances 
-                        WHERE contract_id = ? AND status = 'running'
-                    ) AND status = 'pending'
-                ''', (deadline_str, contract_id))
-
-                conn.commit()
-                conn.close()
+                deadline_str = compute_deadline(priority, datetime_str)
+            except WorkflowError as e:
+                messagebox.showwarning("Внимание", str(e))
+                return
+            except ValueError as e:
+                messagebox.showerror("Ошибка", f"Неверный формат даты: {e}")
+                return
 
+            def on_done(_number):
                 messagebox.showinfo("Успех", f"Дедлайн установлен на:\n{deadline_str[:16]}")
                 dialog.destroy()
                 self.load_contracts()
                 self.load_tasks()
-                log_message(f"Изменен дедлайн договора {number} на {deadline_str}")
 
-            except ValueError as e:
-                messagebox.showerror("Ошибка", f"Неверный формат даты: {e}")
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось изменить дедлайн: {e}")
+            def on_error(e):
+                if isinstance(e, WorkflowError):
+                    messagebox.showwarning("Внимание", str(e))
+                else:
+                    messagebox.showerror("Ошибка", f"Не удалось изменить дедлайн: {e}")
+
+            # Сохраняем в базу данных в фоне; закрытие диалога отменит доставку результата
+            db_executor.submit(dialog, set_contract_deadline, contract_id, priority, deadline_str,
+                               write=True, on_done=on_done, on_error=on_error)
 
         # Кнопки сохранения/отмены
         btn_frame = ttk.Frame(main_frame)
@@ -3070,121 +7059,51 @@ class FastlandApp(TextShortcutsMixin):
         center_window(dialog)
 
     def send_for_approval(self):
+        """Отправить на согласование выделенные черновики (можно несколько сразу)"""
         selection = self.contracts_tree.selection()
         if not selection:
             messagebox.showwarning("Внимание", "Выберите договор для отправки на согласование")
             return
 
-        item = self.contracts_tree.item(selection[0])
-        values = item['values']
-        contract_id = values[0]
-        number = values[1]
-        status = values[5]
+        numbers, drafts = {}, []
+        for iid in selection:
+            values = self.contracts_tree.item(iid)['values']
+            numbers[values[0]] = values[1]
+            if values[5] == 'Черновик':
+                drafts.append(values[0])
 
-        if status != 'Черновик':
+        if not drafts:
             messagebox.showwarning("Внимание", "Только договоры в статусе 'Черновик' можно отправить на согласование")
             return
+        if len(selection) > 1 and not messagebox.askyesno(
+                "Подтверждение", f"Отправить на согласование черновиков: {len(drafts)} из {len(selection)} выбранных?"):
+            return
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            # УДАЛЯЕМ ПРЕДЫДУЩИЕ ДАННЫЕ СОГЛАСОВАНИЯ (если есть)
-            cur.execute('''
-                SELECT i.id FROM approval_instances i 
-                WHERE i.contract_id = ? AND i.status != 'finished'
-            ''', (contract_id,))
-            existing_instance = cur.fetchone()
-
-            if existing_instance:
-                instance_id = existing_instance[0]
-                # Удаляем задачи согласования
-                cur.execute('DELETE FROM approval_tasks WHERE instance_id = ?', (instance_id,))
-                # Удаляем экземпляр согласования
-                cur.execute('DELETE FROM approval_instances WHERE id = ?', (instance_id,))
-                log_message(f"Удален предыдущий экземпляр согласования для договора {number}")
-
-            # Получаем отдел договора для определения маршрута
-            cur.execute("SELECT department, priority, deadline_at FROM contracts WHERE id = ?", (contract_id,))
-            result = cur.fetchone()
-            department = result[0] if result else "Общий"
-            priority = result[1] if result else "standard"
-            contract_deadline = result[2] if result else None
-
-            # Находим подходящий маршрут
-            cur.execute("SELECT id, steps FROM approval_flows WHERE department = ?", (department,))
-            flow = cur.fetchone()
-
-            if not flow:
-                cur.execute("SELECT id, steps FROM approval_flows WHERE department = 'Общий'")
-                flow = cur.fetchone()
-
-            if not flow:
-                messagebox.showerror("Ошибка", "Не найден подходящий маршрут согласования")
-                return
-
-            flow_id, steps_json = flow
-            steps = json.loads(steps_json)
-
-            # Создаем НОВЫЙ экземпляр согласования
-            cur.execute(
-                "INSERT INTO approval_instances (contract_id, flow_id, status) VALUES (?, ?, 'running')",
-                (contract_id, flow_id)
-            )
-            instance_id = cur.lastrowid
-
-            # Создаем задачи согласования только для первого этапа
-            first_step = min(step_data['step'] for step_data in steps)
-            first_steps = [step_data for step_data in steps if step_data['step'] == first_step]
-
-            # Рассчитываем дедлайн на основе приоритета
-            if contract_deadline:
-                deadline_str = contract_deadline
-            else:
-                if priority == "urgent":
-                    deadline_days = 1
-                elif priority == "custom":
-                    deadline_days = 3  # По умолчанию для custom
-                else:  # standard
-                    deadline_days = 3
-
-                deadline = (datetime.now() + timedelta(days=deadline_days)).strftime('%Y-%m-%d %H:%M:%S')
-                deadline_str = deadline
-
-            for step_data in first_steps:
-                role_name = step_data['role']
-                assigned_user_id = self.auto_assign_service.get_next_user_by_round_robin(role_name)
-
-                cur.execute('''
-                    INSERT INTO approval_tasks 
-                    (instance_id, step_order, role_name, assigned_user_id, status, deadline_at)
-                    VALUES (?, ?, ?, ?, 'pending', ?)
-                ''', (instance_id, step_data['step'], role_name, assigned_user_id, deadline_str))
-
-            # Обновляем статус договора
-            cur.execute(
-                "UPDATE contracts SET status = 'На согласовании', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (contract_id,)
-            )
-
-            # Записываем действия пользователя
-            cur.execute(
-                "INSERT INTO audit_log (user_id, action, details) VALUES (?, ?, ?)",
-                (self.user_id, 'send_for_approval', f'Договор {number} отправлен на согласование')
-            )
-
-            conn.commit()
-            conn.close()
-
-            messagebox.showinfo("Успех", "Договор отправлен на согласование")
+        def on_done(result):
+            sent, skipped = result
+            # Таблицы обновляются один раз на весь пакет
             self.load_contracts()
             self.load_tasks()
-            log_message(f"Договор {number} отправлен на согласование")
-
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось отправить договор на согласование: {e}")
+            if len(selection) == 1:
+                if sent:
+                    messagebox.showinfo("Успех", "Договор отправлен на согласование")
+                else:
+                    messagebox.showwarning("Внимание", str(skipped[drafts[0]]))
+                return
+            results = [(number, "Отправлен на согласование", True) for _, number in sent]
+            results += [(numbers[contract_id], str(error), False) for contract_id, error in skipped.items()]
+            results += [(numbers[contract_id], "Не черновик", False)
+                        for contract_id in numbers if contract_id not in drafts]
+            show_bulk_report(self.root, "Отправка на согласование",
+                             f"Отправлено на согласование: {len(sent)} из {len(selection)}", results)
+
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось отправить договоры на согласование: {e}")
             log_message(f"Ошибка отправки на согласование: {e}")
 
+        db_executor.submit(self.root, start_approvals, drafts, self.user_id, self.auto_assign_service,
+                           write=True, on_done=on_done, on_error=on_error)
+
     def show_approval_status(self):
         selection = self.contracts_tree.selection()
         if not selection:
@@ -3194,48 +7113,16 @@ class FastlandApp(TextShortcutsMixin):
         item = self.contracts_tree.item(selection[0])
         contract_id, number, title_text = item['values'][0:3]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            # Получаем ВСЕ экземпляры согласования для этого договора
-            cur.execute('''
-                SELECT i.id, f.name, i.status, i.started_at, i.finished_at
-                FROM approval_instances i
-                JOIN approval_flows f ON i.flow_id = f.id
-                WHERE i.contract_id = ?
-                ORDER BY i.started_at DESC
-            ''', (contract_id,))
-
-            instances = cur.fetchall()
-
-            if not instances:
+        def on_done(timeline):
+            if not timeline:
                 messagebox.showinfo("Статус", "Договор не находится на согласовании")
                 return
+            self.show_status_dialog(number, title_text, timeline)
 
-            # Собираем все задачи согласования для всех экземпляров
-            all_tasks = []
-            for instance in instances:
-                instance_id = instance[0]
-                cur.execute('''
-                    SELECT t.step_order, t.role_name, u.full_name, t.status, 
-                           t.completed_at, t.comment, t.assigned_at, t.deadline_at
-                    FROM approval_tasks t
-                    LEFT JOIN users u ON t.assigned_user_id = u.id
-                    WHERE t.instance_id = ?
-                    ORDER BY t.step_order, t.assigned_at
-                ''', (instance_id,))
-                tasks = cur.fetchall()
-                all_tasks.extend(tasks)
-
-            conn.close()
-
-            self.show_status_dialog(number, title_text, instances, all_tasks)
+        db_executor.submit(self.root, get_approval_timeline, contract_id, key="approval_status", on_done=on_done, on_error=lambda e: messagebox.showerror(
+            "Ошибка", f"Не удалось получить статус согласования: {e}"))
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось получить статус согласования: {e}")
-
-    def show_status_dialog(self, number, title_text, instances, tasks):
+    def show_status_dialog(self, number, title_text, timeline):
         dialog = tk.Toplevel(self.root)
         dialog.title(f"Статус согласования - {number}")
         dialog.transient(self.root)
@@ -3253,7 +7140,7 @@ class FastlandApp(TextShortcutsMixin):
         ttk.Label(info_frame, text=f"Наименование: {title_text}").pack(anchor="w")
 
         # Информация о текущем согласовании
-        current_instance = instances[0]  # Последний экземпляр
+        current_instance = timeline[0][0]  # Последний экземпляр
         instance_id, flow_name, status, started_at, finished_at = current_instance
         ttk.Label(info_frame, text=f"Текущий маршрут: {flow_name}").pack(anchor="w")
         ttk.Label(info_frame, text=f"Статус: {status}").pack(anchor="w")
@@ -3275,7 +7162,7 @@ class FastlandApp(TextShortcutsMixin):
             tree.heading(col, text=header)
             tree.column(col, width=width)
 
-        for task in tasks:
+        for task in (task for _, tasks in timeline for task in tasks):
             step_num, role, user, status, completed, comment, assigned, deadline = task
             assigned_str = assigned[:10] if assigned else ""
             completed_str = completed[:10] if completed else ""
@@ -3313,24 +7200,39 @@ class FastlandApp(TextShortcutsMixin):
         self._process_task(False)
 
     def _process_task(self, approve: bool):
+        """Утвердить или отклонить выделенные задачи (можно несколько сразу) с общим комментарием"""
         selection = self.tasks_tree.selection()
         if not selection:
             messagebox.showwarning("Внимание", "Выберите задачу для обработки")
             return
 
-        item = self.tasks_tree.item(selection[0])
-        task_id, contract_number, title_text, step_num, role = item['values'][0:5]
+        tasks = {}  # id задачи -> (договор, этап, роль)
+        for iid in selection:
+            task_id, contract_number, _, step_num, role = self.tasks_tree.item(iid)['values'][0:5]
+            tasks[task_id] = (contract_number, step_num, role)
+        task_ids = list(tasks)
 
         dialog = tk.Toplevel(self.root)
-        dialog.title("Утверждение задачи" if approve else "Отклонение задачи")
+        if len(task_ids) == 1:
+            dialog.title("Утверждение задачи" if approve else "Отклонение задачи")
+        else:
+            dialog.title(f"{'Утверждение' if approve else 'Отклонение'} задач: {len(task_ids)}")
         dialog.transient(self.root)
         dialog.grab_set()
 
         main_frame = ttk.Frame(dialog, padding=15)
         main_frame.pack(fill="both", expand=True)
 
-        ttk.Label(main_frame, text=f"Договор: {contract_number}", font=('Arial', 10, 'bold')).pack(anchor="w")
-        ttk.Label(main_frame, text=f"Этап: {step_num} - {role}").pack(anchor="w", pady=(5, 0))
+        if len(task_ids) == 1:
+            contract_number, step_num, role = tasks[task_ids[0]]
+            ttk.Label(main_frame, text=f"Договор: {contract_number}", font=('Arial', 10, 'bold')).pack(anchor="w")
+            ttk.Label(main_frame, text=f"Этап: {step_num} - {role}").pack(anchor="w", pady=(5, 0))
+        else:
+            numbers = ", ".join(str(tasks[task_id][0]) for task_id in task_ids[:5])
+            if len(task_ids) > 5:
+                numbers += f" и еще {len(task_ids) - 5}"
+            ttk.Label(main_frame, text=f"Задач: {len(task_ids)}", font=('Arial', 10, 'bold')).pack(anchor="w")
+            ttk.Label(main_frame, text=f"Договоры: {numbers}", wraplength=400).pack(anchor="w", pady=(5, 0))
 
         ttk.Label(main_frame, text="Комментарий:").pack(anchor="w", pady=(15, 5))
         comment_text = tk.Text(main_frame, height=6, width=50)
@@ -3340,120 +7242,34 @@ class FastlandApp(TextShortcutsMixin):
         def process():
             comment = comment_text.get("1.0", "end-1c").strip()
 
-            # Автоматическая подстановка комментария если поле пустое
-            if not comment:
-                if approve:
-                    comment = "Согласовано"
-                else:
-                    comment = "Отклонено"
-
-            try:
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-
-                new_status = "approved" if approve else "rejected"
-                completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                cur.execute('''
-                    UPDATE approval_tasks 
-                    SET status = ?, completed_at = ?, comment = ?
-                    WHERE id = ?
-                ''', (new_status, completed_at, comment, task_id))
-
-                # Получаем информацию о задаче
-                cur.execute('''
-                    SELECT t.instance_id, t.step_order, i.contract_id, i.flow_id 
-                    FROM approval_tasks t
-                    JOIN approval_instances i ON t.instance_id = i.id
-                    WHERE t.id = ?
-                ''', (task_id,))
-                task_info = cur.fetchone()
-                instance_id, current_step, contract_id, flow_id = task_info
-
-                if approve:
-                    # Проверяем, все ли задачи текущего этапа завершены
-                    cur.execute('''
-                        SELECT COUNT(*) FROM approval_tasks 
-                        WHERE instance_id = ? AND step_order = ? AND status = 'pending'
-                    ''', (instance_id, current_step))
-                    pending_count = cur.fetchone()[0]
-
-                    if pending_count == 0:
-                        # Все задачи текущего этапа завершены, проверяем следующий этап
-                        cur.execute('''
-                            SELECT steps FROM approval_flows WHERE id = ?
-                        ''', (flow_id,))
-                        flow_result = cur.fetchone()
-
-                        if flow_result:
-                            steps = json.loads(flow_result[0])
-                            next_step = current_step + 1
-                            next_steps = [step_data for step_data in steps if step_data['step'] == next_step]
-
-                            if next_steps:
-                                # Создаем задачи для следующего этапа
-                                for step_data in next_steps:
-                                    role_name = step_data['role']
-                                    deadline_days = step_data.get('deadline_days', 3)
-                                    deadline = (datetime.now() + timedelta(days=deadline_days)).strftime(
-                                        '%Y-%m-%d %H:%M:%S')
-
-                                    assigned_user_id = self.auto_assign_service.get_next_user_by_round_robin(role_name)
-
-                                    cur.execute('''
-                                        INSERT INTO approval_tasks 
-                                        (instance_id, step_order, role_name, assigned_user_id, status, deadline_at)
-                                        VALUES (?, ?, ?, ?, 'pending', ?)
-                                    ''', (instance_id, next_step, role_name, assigned_user_id, deadline))
-                            else:
-                                # Нет следующих этапов - завершаем согласование
-                                cur.execute('''
-                                    UPDATE approval_instances SET status = 'finished', finished_at = CURRENT_TIMESTAMP
-                                    WHERE id = ?
-                                ''', (instance_id,))
-
-                                cur.execute('''
-                                    UPDATE contracts SET status = 'Согласован', updated_at = CURRENT_TIMESTAMP
-                                    WHERE id = ?
-                                ''', (contract_id,))
-                else:
-                    # Задача отклонена - ВАЖНОЕ ИСПРАВЛЕНИЕ: отменяем ВСЕ задачи для этого договора
-                    cur.execute('''
-                        UPDATE approval_tasks 
-                        SET status = 'cancelled', completed_at = CURRENT_TIMESTAMP, 
-                            comment = CONCAT(COALESCE(comment, ''), ?)
-                        WHERE instance_id = ? AND status = 'pending'
-                    ''', (f" | Отменено из-за отклонения отделом {role}", instance_id))
-
-                    cur.execute('''
-                        UPDATE approval_instances SET status = 'finished', finished_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (instance_id,))
-
-                    cur.execute('''
-                        UPDATE contracts SET status = 'Отклонён', updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (contract_id,))
-
-                # Записываем действие пользователя
-                action = "approve_task" if approve else "reject_task"
-                cur.execute(
-                    "INSERT INTO audit_log (user_id, action, details) VALUES (?, ?, ?)",
-                    (self.user_id, action, f'Задача {task_id} для договора {contract_number}')
-                )
-
-                conn.commit()
-                conn.close()
-
-                messagebox.showinfo("Успех", "Задача обработана")
+            def on_done(result):
+                done, failed = result
                 dialog.destroy()
+                # Таблицы обновляются один раз на весь пакет
                 self.load_tasks()
                 self.load_contracts()
-                log_message(f"Задача {task_id} {'утверждена' if approve else 'отклонена'} с комментарием: {comment}")
-
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось обработать задачу: {e}")
-                log_message(f"Ошибка обработки задачи: {e}")
+                if len(task_ids) == 1:
+                    if done:
+                        messagebox.showinfo("Успех", "Задача обработана")
+                    else:
+                        messagebox.showwarning("Внимание", str(failed[task_ids[0]]))
+                    return
+                result_text = "Утверждена" if approve else "Отклонена"
+                results = [(f"{number}, этап {tasks[task_id][1]} - {tasks[task_id][2]}", result_text, True)
+                           for task_id, number in done]
+                results += [(f"{tasks[task_id][0]}, этап {tasks[task_id][1]} - {tasks[task_id][2]}", str(error), False)
+                            for task_id, error in failed.items()]
+                show_bulk_report(self.root, "Обработка задач",
+                                 f"{'Утверждено' if approve else 'Отклонено'} задач: {len(done)} из {len(task_ids)}",
+                                 results, item_header="Задача")
+
+            def on_error(e):
+                messagebox.showerror("Ошибка", f"Не удалось обработать задачи: {e}")
+                log_message(f"Ошибка обработки задач: {e}")
+
+            db_executor.submit(dialog, functools.partial(complete_tasks, is_admin=self.is_admin), task_ids,
+                               self.user_id, approve, comment, self.auto_assign_service,
+                               write=True, on_done=on_done, on_error=on_error)
 
         btn_frame = ttk.Frame(main_frame)
         btn_frame.pack(fill="x", pady=10)
@@ -3473,56 +7289,164 @@ class FastlandApp(TextShortcutsMixin):
         UserManagementDialog(self.root)
 
     def reset_database(self):
-        if messagebox.askyesno("Подтверждение","ВНИМАНИЕ! Это действие удалит все данные и создает новую базу с тестовыми данными. Продолжить?"):
-            try:
-                if os.path.exists(DB_FILE):
-                    os.remove(DB_FILE)
-                init_database()
-                messagebox.showinfo("Успех", "База данных сброшена")
-                self.load_contracts()
-                self.load_tasks()
-                log_message("База данных сброшена администратором")
-            except (OSError, sqlite3.Error) as e:
-                messagebox.showerror("Ошибка", f"Не удалось сбросить базу данных: {e}")
+        if not messagebox.askyesno("Подтверждение","ВНИМАНИЕ! Это действие удалит все данные и создает новую базу с тестовыми данными. Продолжить?"):
+            return
 
-    @staticmethod
-    def create_backup():
-        import shutil
-        try:
-            if not os.path.exists(BACKUP_DIR):
-                os.makedirs(BACKUP_DIR)
+        def on_done(_):
+            messagebox.showinfo("Успех", "База данных сброшена")
+            self.load_contracts()
+            self.load_tasks()
+
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось сбросить базу данных: {e}")
+
+        # Через очередь записи: пересоздание не пересечется с другими изменениями
+        db_executor.submit(self.root, recreate_database, self.auto_assign_service, write=True,
+                           on_done=on_done, on_error=on_error)
+
+    def create_backup(self):
+        """Бэкап в фоновом потоке с окном прогресса; клиенты продолжают работать с базой"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Создание бэкапа")
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+        # Окно модальное: второй бэкап не запустить, пока идет первый
+        dialog.grab_set()
+
+        main_frame = ttk.Frame(dialog, padding=20)
+        main_frame.pack(fill="both", expand=True)
+        stage_label = ttk.Label(main_frame, text="Подготовка...", width=45)
+        stage_label.pack(anchor="w")
+        progress_bar = ttk.Progressbar(main_frame, length=350, mode="determinate", maximum=100)
+        progress_bar.pack(fill="x", pady=(10, 0))
+        cancel_button = ttk.Button(main_frame, text="Отмена")
+        cancel_button.pack(anchor="e", pady=(10, 0))
+        center_window(dialog)
+
+        # Поток копирования только записывает состояние, окно перечитывает его по таймеру
+        state = {"stage": "Подготовка", "done": 0, "total": 0, "cancelled": False}
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = os.path.join(BACKUP_DIR, f"backup_{timestamp}.db")
+        def progress(stage, done, total):
+            # Отмена срабатывает на следующем шаге копирования; недописанный файл удаляется
+            if state["cancelled"]:
+                raise BackupError("Создание бэкапа отменено")
+            state.update(stage=stage, done=done, total=total)
 
-            shutil.copy2(DB_FILE, backup_file)
+        def cancel():
+            # Окно закрывается, когда фоновый поток остановится (on_error)
+            state["cancelled"] = True
+            cancel_button.configure(state="disabled")
+            stage_label.configure(text="Отмена...")
 
-            messagebox.showinfo("Успех", f"Бэкап создан: {backup_file}")
-            log_message(f"Создан бэкап: {backup_file}")
+        cancel_button.configure(command=cancel)
+        dialog.protocol("WM_DELETE_WINDOW", cancel)
+
+        def refresh():
+            if not dialog.winfo_exists() or state["cancelled"]:
+                return
+            percent = state["done"] * 100 / state["total"] if state["total"] else 0
+            stage_label.configure(text=f"{state['stage']}... {percent:.0f}%")
+            progress_bar["value"] = percent
+            dialog.after(100, refresh)
+
+        def on_done(backup_file):
+            dialog.destroy()
+            messagebox.showinfo("Успех", f"Бэкап создан и проверен: {backup_file}")
 
-        except (OSError, shutil.Error) as e:
+        def on_error(e):
+            dialog.destroy()
+            if state["cancelled"]:
+                log_message("Создание бэкапа отменено пользователем")
+                return
             messagebox.showerror("Ошибка", f"Не удалось создать бэкап: {e}")
+            log_message(f"Ошибка создания бэкапа: {e}")
 
-    @staticmethod
-    def show_statistics():
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
+        refresh()
+        db_executor.submit(dialog, backup_database, progress, on_done=on_done, on_error=on_error)
+
+    def manage_snapshots(self):
+        """Список инкрементальных снимков: снять новый, восстановить выбранный в отдельный файл"""
+        if db.backend != "sqlite":
+            messagebox.showinfo("Снимки базы", "Инкрементальные снимки доступны только для SQLite — "
+                                               "для PostgreSQL используйте «Создать бэкап» (pg_dump)")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Снимки базы данных")
+        dialog.transient(self.root)
 
-            cur.execute("SELECT COUNT(*) FROM contracts")
-            total_contracts = cur.fetchone()[0]
+        main_frame = ttk.Frame(dialog, padding=15)
+        main_frame.pack(fill="both", expand=True)
+        ttk.Label(main_frame, text=f"Хранение: последние {BACKUP_KEEP_HOURLY} ч, {BACKUP_KEEP_DAILY} дн., "
+                                   f"{BACKUP_KEEP_WEEKLY} нед.", foreground="gray").pack(anchor="w", pady=(0, 10))
 
-            cur.execute("SELECT COUNT(*) FROM contracts WHERE status = 'На согласовании'")
-            pending_contracts = cur.fetchone()[0]
+        tree_frame = ttk.Frame(main_frame)
+        tree_frame.pack(fill="both", expand=True)
+        columns = ("created", "size", "stored")
+        tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=12, selectmode="browse")
+        for column, text, width in (("created", "Снимок", 160), ("size", "Размер базы, МБ", 120),
+                                    ("stored", "Записано нового, МБ", 140)):
+            tree.heading(column, text=text)
+            tree.column(column, width=width)
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
 
-            cur.execute("SELECT COUNT(*) FROM approval_tasks WHERE status = 'pending'")
-            pending_tasks = cur.fetchone()[0]
+        def on_error(e):
+            messagebox.showerror("Ошибка", str(e), parent=dialog)
+            log_message(f"Ошибка работы со снимками базы: {e}")
+
+        def show(snapshots):
+            tree.delete(*tree.get_children())
+            for manifest in snapshots:
+                tree.insert("", "end", iid=manifest["id"], values=(
+                    manifest["created_at"], f"{manifest['size'] / 1024 / 1024:.1f}",
+                    f"{manifest['stored_bytes'] / 1024 / 1024:.1f}"))
+
+        def load():
+            db_executor.submit(dialog, snapshot_store.snapshots, key="snapshots", on_done=show, on_error=on_error)
+
+        def create():
+            def snapshot():
+                manifest = snapshot_store.create()
+                snapshot_store.prune()
+                return manifest
+
+            def on_done(manifest):
+                load()
+                messagebox.showinfo("Успех", f"Снимок создан: новых блоков {manifest['new_chunks']} "
+                                             f"из {len(manifest['chunks'])}", parent=dialog)
+
+            db_executor.submit(dialog, snapshot, key="snapshot-create", on_done=on_done, on_error=on_error)
+
+        def restore():
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("Внимание", "Выберите снимок", parent=dialog)
+                return
+            target = filedialog.asksaveasfilename(
+                parent=dialog, title="Восстановить снимок в файл", defaultextension=".db",
+                initialfile=f"restored_{selection[0]}.db", filetypes=[("База SQLite", "*.db"), ("Все файлы", "*.*")])
+            if not target:
+                return
+            db_executor.submit(dialog, snapshot_store.restore, selection[0], target, key="snapshot-restore",
+                               on_error=on_error,
+                               on_done=lambda path: messagebox.showinfo(
+                                   "Успех", f"Снимок восстановлен и проверен: {path}", parent=dialog))
 
-            cur.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
-            active_users = cur.fetchone()[0]
+        btn_frame = ttk.Frame(main_frame)
+        btn_frame.pack(fill="x", pady=(10, 0))
+        ttk.Button(btn_frame, text="📸 Снять снимок", command=create).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="♻ Восстановить в файл...", command=restore).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Закрыть", command=dialog.destroy).pack(side="right", padx=5)
 
-            conn.close()
+        center_window(dialog)
+        load()
 
+    def show_statistics(self):
+        def on_done(counts):
+            total_contracts, pending_contracts, pending_tasks, active_users = counts
             stats = f"""Статистика системы:
 
 • Всего договоров: {total_contracts}
@@ -3534,8 +7458,8 @@ class FastlandApp(TextShortcutsMixin):
 
             messagebox.showinfo("Статистика системы", stats)
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось получить статистику: {e}")
+        db_executor.submit(self.root, fetch_statistics, key="statistics", on_done=on_done,
+                           on_error=lambda e: messagebox.showerror("Ошибка", f"Не удалось получить статистику: {e}"))
 
     def confirm_exit(self):
         """Единый метод подтверждения выхода для всех способов закрытия"""
@@ -3607,16 +7531,17 @@ class FastlandApp(TextShortcutsMixin):
 
 # ======================= ДИАЛОГ РЕДАКТИРОВАНИЯ ДОГОВОРА =======================
 class ContractDialog(TextShortcutsMixin):
-    def __init__(self, parent, user_id, user_department, contract=None):
+    def __init__(self, parent, user_id, user_department, contract=None, on_saved=None):
         super().__init__()
         self.counterparty_var = None
         self.counterparty_combo = None
-        self.organizations_map = None
+        self.organizations_map = {}
         self.parent = parent
         self.user_id = user_id
         self.user_department = user_department
         self.contract = contract
         self.is_edit = contract is not None
+        self.on_saved = on_saved
 
         # Инициализация атрибутов UI
         self.number_entry = None
@@ -3662,15 +7587,9 @@ class ContractDialog(TextShortcutsMixin):
                                                width=37, state="readonly")
         self.counterparty_combo.grid(row=2, column=1, sticky="w", pady=5, padx=(10, 0))
 
-        # Загружаем организации в combobox
-        organizations = get_all_organizations()
-        if organizations:
-            org_display = [f"{org[1]} (ИНН: {org[2]})" for org in organizations]
-            self.counterparty_combo['values'] = org_display
-            self.organizations_map = {display: org[0] for display, org in zip(org_display, organizations)}
-        else:
-            self.counterparty_combo['values'] = ["Нет доступных организаций"]
-            self.organizations_map = {}
+        # Организации загружаются в фоне, список заполнится по готовности
+        db_executor.submit(self.counterparty_combo, get_all_organizations, key="contract_organizations",
+                           on_done=self.show_organizations)
 
         ttk.Label(main_frame, text="Сумма:").grid(row=3, column=0, sticky="w", pady=5)
         self.amount_entry = AmountEntry(main_frame, width=40)
@@ -3765,22 +7684,6 @@ class ContractDialog(TextShortcutsMixin):
             self.number_entry.insert(0, number)
             self.title_entry.insert(0, title_text)
 
-            # Загружаем название контрагента вместо ID
-            if counterparty:
-                try:
-                    conn = sqlite3.connect(DB_FILE)
-                    cur = conn.cursor()
-                    cur.execute("SELECT name, inn FROM organizations WHERE id = ?", (counterparty,))
-                    org_data = cur.fetchone()
-                    conn.close()
-
-                    if org_data:
-                        org_name, org_inn = org_data
-                        display_text = f"{org_name} (ИНН: {org_inn})"
-                        self.counterparty_var.set(display_text)
-                except sqlite3.Error as e:
-                    log_message(f"Ошибка загрузки данных контрагента: {e}")
-
             self.amount_entry.insert(0, format_amount(amount))
             self.department_combo.set(department)
             self.file_path.set(file_path or "")
@@ -3793,6 +7696,22 @@ class ContractDialog(TextShortcutsMixin):
                 self.datetime_display.insert(0, deadline)
                 self.datetime_display.config(state="readonly")
 
+    def show_organizations(self, organizations):
+        if organizations:
+            org_display = [f"{org[1]} (ИНН: {org[2]})" for org in organizations]
+            self.counterparty_combo['values'] = org_display
+            self.organizations_map = {display: org[0] for display, org in zip(org_display, organizations)}
+        else:
+            self.counterparty_combo['values'] = ["Нет доступных организаций"]
+            self.organizations_map = {}
+
+        # Название контрагента вместо ID, если пользователь еще ничего не выбрал
+        if self.contract and self.contract[3] and not self.counterparty_var.get():
+            for display, org_id in self.organizations_map.items():
+                if org_id == self.contract[3]:
+                    self.counterparty_var.set(display)
+                    break
+
     def browse_file(self):
         filename = filedialog.askopenfilename(
             title="Выберите файл договора",
@@ -3845,41 +7764,25 @@ class ContractDialog(TextShortcutsMixin):
             deadline_dt = datetime.now() + timedelta(days=days)
             deadline_str = deadline_dt.replace(hour=18, minute=0, second=0).strftime('%Y-%m-%d %H:%M:%S')
 
-        try:
-            amount = parse_amount(amount_text) if amount_text else 0.0
-
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-
-            if self.is_edit:
-                cur.execute('''
-                    UPDATE contracts 
-                    SET contract_number = ?, title = ?, counterparty = ?, amount = ?, 
-                        department = ?, file_path = ?, priority = ?, deadline_at = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (number, title_text, counterparty_id, amount, department, file_path or None,
-                      priority, deadline_str, self.contract[0]))
-                action_msg = "Договор обновлен"
-            else:
-                cur.execute('''
-                    INSERT INTO contracts 
-                    (contract_number, title, counterparty, amount, owner_id, department, file_path, status, priority, deadline_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, 'Черновик', ?, ?)
-                ''', (number, title_text, counterparty_id, amount, self.user_id, department, file_path or None,
-                      priority, deadline_str))
-                action_msg = "Договор создан"
-
-            conn.commit()
-            conn.close()
-
-            messagebox.showinfo("Успех", action_msg)
-            log_message(f"{action_msg}: {number}")
+        amount = parse_amount(amount_text) if amount_text else 0.0
+
+        def on_done(action_msg):
+            messagebox.showinfo("Успех", action_msg, parent=self.win)
             self.win.destroy()
+            if self.on_saved:
+                self.on_saved()
+
+        def on_error(e):
+            if isinstance(e, WorkflowError):
+                messagebox.showwarning("Внимание", str(e), parent=self.win)
+            elif isinstance(e, DB_INTEGRITY_ERRORS):
+                messagebox.showerror("Ошибка", "Договор с таким номером уже существует", parent=self.win)
+            else:
+                messagebox.showerror("Ошибка", f"Не удалось сохранить договор: {e}", parent=self.win)
 
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Ошибка", "Договор с таким номером уже существует")
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить договор: {e}")
+        db_executor.submit(self.win, store_contract, self.contract[0] if self.is_edit else None, number, title_text,
+                           counterparty_id, amount, self.user_id, department, file_path, priority, deadline_str,
+                           write=True, on_done=on_done, on_error=on_error)
 
 
 # ======================= ДИАЛОГ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ =======================
@@ -3933,33 +7836,21 @@ class UserManagementDialog(TextShortcutsMixin):
         scrollbar.pack(side="right", fill="y")
 
     def load_users(self):
-        for item in self.users_tree.get_children():
-            self.users_tree.delete(item)
-
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT u.id, u.username, u.full_name, u.department, u.position, 
-                       CASE WHEN u.is_active = 1 THEN 'Активен' ELSE 'Неактивен' END as status,
-                       GROUP_CONCAT(r.name, ', ') as roles
-                FROM users u
-                LEFT JOIN user_roles ur ON u.id = ur.user_id
-                LEFT JOIN roles r ON ur.role_id = r.id
-                GROUP BY u.id
-                ORDER BY u.full_name
-            ''')
-            users = cur.fetchall()
-            conn.close()
+        def on_done(users):
+            # Обновляем только изменившиеся строки: выделение и прокрутка сохраняются
+            reconcile_treeview(self.users_tree, ((user[0], user, ()) for user in users))
 
-            for user in users:
-                self.users_tree.insert("", "end", values=user)
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось загрузить пользователей: {e}", parent=self.win)
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить пользователей: {e}")
+        db_executor.submit(self.users_tree, list_users, key="users", on_done=on_done, on_error=on_error)
 
     def add_user(self):
-        self._show_user_dialog()
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось загрузить роли: {e}", parent=self.win)
+
+        db_executor.submit(self.users_tree, list_roles, key="user", on_done=self._show_user_dialog,
+                           on_error=on_error)
 
     def edit_user(self):
         selection = self.users_tree.selection()
@@ -3970,25 +7861,18 @@ class UserManagementDialog(TextShortcutsMixin):
         item = self.users_tree.item(selection[0])
         user_id = item['values'][0]
 
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            user = cur.fetchone()
-
-            cur.execute('''
-                SELECT r.name 
-                FROM roles r 
-                JOIN user_roles ur ON r.id = ur.role_id 
-                WHERE ur.user_id = ?
-            ''', (user_id,))
-            user_roles = [row[0] for row in cur.fetchall()]
-            conn.close()
+        def on_done(result):
+            user, user_roles, all_roles = result
+            self._show_user_dialog(all_roles, user, user_roles)
 
-            self._show_user_dialog(user, user_roles)
+        def on_error(e):
+            if isinstance(e, WorkflowError):
+                messagebox.showwarning("Внимание", str(e), parent=self.win)
+            else:
+                messagebox.showerror("Ошибка", f"Не удалось загрузить данные пользователя: {e}", parent=self.win)
 
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить данные пользователя: {e}")
+        db_executor.submit(self.users_tree, get_user_for_edit, user_id, key="user", on_done=on_done,
+                           on_error=on_error)
 
     def delete_user(self):
         selection = self.users_tree.selection()
@@ -3999,27 +7883,20 @@ class UserManagementDialog(TextShortcutsMixin):
         item = self.users_tree.item(selection[0])
         user_id, username, full_name = item['values'][0:3]
 
-        if messagebox.askyesno("Подтверждение",f"Удалить пользователя '{full_name}' ({username})?\n\nВнимание: Это действие нельзя отменить."):
-            try:
-                conn = sqlite3.connect(DB_FILE)
-                cur = conn.cursor()
-
-                # Удаляем связи с ролями
-                cur.execute("DELETE FROM user_roles WHERE user_id = ?", (user_id,))
-                # Удаляем пользователя
-                cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        if not messagebox.askyesno("Подтверждение",f"Удалить пользователя '{full_name}' ({username})?\n\nВнимание: Это действие нельзя отменить."):
+            return
 
-                conn.commit()
-                conn.close()
+        def on_done(_):
+            messagebox.showinfo("Успех", "Пользователь удален", parent=self.win)
+            self.load_users()
 
-                messagebox.showinfo("Успех", "Пользователь удален")
-                self.load_users()
-                log_message(f"Удален пользователь: {full_name} ({username})")
+        def on_error(e):
+            messagebox.showerror("Ошибка", f"Не удалось удалить пользователя: {e}", parent=self.win)
 
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось удалить пользователя: {e}")
+        db_executor.submit(self.users_tree, remove_user, user_id, username, full_name, write=True,
+                           on_done=on_done, on_error=on_error)
 
-    def _show_user_dialog(self, user=None, user_roles=None):
+    def _show_user_dialog(self, all_roles, user=None, user_roles=None):
         dialog = tk.Toplevel(self.win)
         dialog.title("Редактирование пользователя" if user else "Добавление пользователя")
         dialog.transient(self.win)
@@ -4064,16 +7941,6 @@ class UserManagementDialog(TextShortcutsMixin):
         roles_frame = ttk.Frame(main_frame)
         roles_frame.grid(row=6, column=1, columnspan=2, sticky="w", pady=5, padx=(10, 0))
 
-        # Получаем все доступные роли
-        try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT id, name FROM roles ORDER BY name")
-            all_roles = cur.fetchall()
-            conn.close()
-        except sqlite3.Error:
-            all_roles = []
-
         role_vars = {}
         for i, (role_id, role_name) in enumerate(all_roles):
             var = tk.BooleanVar()
@@ -4109,54 +7976,26 @@ class UserManagementDialog(TextShortcutsMixin):
                 messagebox.showwarning("Внимание", "Введите пароль для нового пользователя")
                 return
 
-            try:
-                db_connection = sqlite3.connect(DB_FILE)
-                db_cursor = db_connection.cursor()
-
-                if user:
-                    # Обновление существующего пользователя
-                    update_data = [username_input, full_name_input, department_input or None, position_input or None,
-                                   is_active_input, user[0]]
-                    if password_input and password_input != "        ":  # Если пароль изменен
-                        update_sql = '''UPDATE users SET username=?, full_name=?, password=?, 
-                                      department=?, position=?, is_active=? WHERE id=?'''
-                        update_data.insert(2, hash_password(password_input))
-                    else:
-                        update_sql = '''UPDATE users SET username=?, full_name=?, department=?, 
-                                      position=?, is_active=? WHERE id=?'''
+            # Заглушка означает, что пароль не менялся
+            new_password = password_input if password_input and password_input != "        " else None
+            role_ids = [role_id_value for role_id_value, role_var in role_vars.items() if role_var.get()]
 
-                    db_cursor.execute(update_sql, update_data)
-                    current_user_id = user[0]
-                    action_msg = "Пользователь обновлен"
-                else:
-                    # Создание нового пользователя
-                    hashed_password = hash_password(password_input)
-                    db_cursor.execute('''INSERT INTO users (username, full_name, password, department, position, is_active)
-                                VALUES (?, ?, ?, ?, ?, ?)''',
-                                      (username_input, full_name_input, hashed_password, department_input or None,
-                                       position_input or None, is_active_input))
-                    current_user_id = db_cursor.lastrowid
-                    action_msg = "Пользователь создан"
-
-                # Обновляем роли
-                db_cursor.execute("DELETE FROM user_roles WHERE user_id = ?", (current_user_id,))
-                for role_id_value, role_var in role_vars.items():
-                    if role_var.get():
-                        db_cursor.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)",
-                                          (current_user_id, role_id_value))
-
-                db_connection.commit()
-                db_connection.close()
-
-                messagebox.showinfo("Успех", action_msg)
+            def on_done(action_msg):
+                messagebox.showinfo("Успех", action_msg, parent=self.win)
                 self.load_users()
                 dialog.destroy()
-                log_message(f"{action_msg}: {full_name_input} ({username_input})")
 
-            except sqlite3.IntegrityError:
-                messagebox.showerror("Ошибка", "Пользователь с таким логином уже существует")
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка", f"Не удалось сохранить пользователя: {e}")
+            def on_error(e):
+                if isinstance(e, WorkflowError):
+                    messagebox.showwarning("Внимание", str(e), parent=dialog)
+                elif isinstance(e, DB_INTEGRITY_ERRORS):
+                    messagebox.showerror("Ошибка", "Пользователь с таким логином уже существует", parent=dialog)
+                else:
+                    messagebox.showerror("Ошибка", f"Не удалось сохранить пользователя: {e}", parent=dialog)
+
+            db_executor.submit(dialog, store_user, user[0] if user else None, username_input, full_name_input,
+                               new_password, department_input, position_input, is_active_input, role_ids,
+                               write=True, on_done=on_done, on_error=on_error)
 
         # Кнопки
         button_frame = ttk.Frame(main_frame)
@@ -4173,8 +8012,62 @@ class UserManagementDialog(TextShortcutsMixin):
 
 # ======================= ЗАПУСК ПРИЛОЖЕНИЯ =======================
 def main():
+    parser = argparse.ArgumentParser(description="Система управления договорами")
+    parser.add_argument("--check-indexes", action="store_true",
+                        help="применить миграции и проверить планы горячих запросов, не запуская интерфейс")
+    parser.add_argument("--backup", action="store_true",
+                        help="создать проверенный бэкап базы в каталоге бэкапов, не запуская интерфейс")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="снять инкрементальный снимок базы и применить правила хранения снимков")
+    parser.add_argument("--restore-snapshot", nargs=2, metavar=("SNAPSHOT", "FILE"),
+                        help="восстановить снимок в новый файл базы")
+    parser.add_argument("--generate-dataset", type=int, metavar="CONTRACTS",
+                        help="добавить в базу синтетические данные на указанное число договоров")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="зерно генератора данных: с одним зерном получаются одни и те же данные")
+    args = parser.parse_args()
+
     init_database()
 
+    if args.generate_dataset:
+        try:
+            counts = generate_dataset(args.generate_dataset, args.seed, progress=lambda done, total: print(
+                f"\r{done}/{total}", end="\n" if done == total else "", flush=True))
+            for table, count in counts.items():
+                print(f"{table}: {count}")
+        except DB_ERRORS as e:
+            print(f"Ошибка генерации данных: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            db.close_all()
+        sys.exit(0)
+
+    if args.backup or args.snapshot or args.restore_snapshot:
+        try:
+            if args.backup:
+                print(backup_database())
+            if args.snapshot:
+                manifest = snapshot_store.create()
+                snapshot_store.prune()
+                print(manifest["id"])
+            if args.restore_snapshot:
+                print(snapshot_store.restore(*args.restore_snapshot))
+        except (BackupError, OSError, *DB_ERRORS) as e:
+            print(f"Ошибка резервного копирования: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            db.close_all()
+        sys.exit(0)
+
+    if args.check_indexes:
+        problems = check_query_plans()
+        for name in HOT_QUERIES:
+            print(f"{'FAIL' if name in problems else 'OK  '} {name}")
+            for detail in problems.get(name, []):
+                print(f"       {detail}")
+        db.close_all()
+        sys.exit(1 if problems else 0)
+
     root = tk.Tk()
     root.title("Система управления договорами - ООО «Фастлэнд»")
     # делаем окно резиновым (чтобы можно было растягивать)
@@ -4233,8 +8126,15 @@ def main():
 
     ttk.Label(start_frame, text=info_text, foreground="gray", justify="center").pack(side="bottom", pady=20)
 
+    # Автоматические снимки базы идут в фоновом потоке все время работы приложения
+    snapshots = SnapshotScheduler(snapshot_store)
+    snapshots.start()
+
     center_window(root)
     root.mainloop()
+    snapshots.stop()
+    db_executor.shutdown()
+    db.close_all()
 
 
 if __name__ == "__main__":